@@ -0,0 +1,291 @@
+import asyncio
+import datetime
+from threading import Lock
+
+from helpers import contract_from_details
+
+## keys for requests which IB doesn't give a reqId to; only one of each can be in flight
+POSITIONS_KEY = "positions"
+
+## no more than 50 requests open at once; IB's historical data pacing is kept by the app, see rate_limiter
+MAX_OPEN_REQUESTS = 50
+
+
+def accounts_key(accountName):
+    return ("accounts", accountName)
+
+
+class _PendingRequest(object):
+    def __init__(self, loop, future):
+        self.loop = loop
+        self.future = future
+        self.items = []
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+class PendingRequests(object):
+    """
+    Futures waiting on wrapper callbacks, keyed by reqId (or one of the keys above)
+
+    The wrapper calls add / finish / fail from the reader thread; futures are completed on their own
+    event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self):
+        self._requests = {}
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "%d pending requests" % len(self._requests)
+
+    def register(self, key, loop):
+        """
+        :param key: reqId or other key
+        :param loop: event loop the future belongs to
+        :return: future, which will get the list of items; shared if the key is already pending
+        """
+        with self._lock:
+            if key in self._requests:
+                return self._requests[key].future
+
+            future = loop.create_future()
+            self._requests[key] = _PendingRequest(loop, future)
+
+            return future
+
+    def is_pending(self, key):
+        return key in self._requests
+
+    def add(self, key, item):
+        """
+        :return: bool, True if someone was waiting for this item
+        """
+        with self._lock:
+            request = self._requests.get(key, None)
+            if request is None:
+                return False
+
+            request.items.append(item)
+
+        return True
+
+    def finish(self, key):
+        """
+        :return: bool, True if someone was waiting for this request
+        """
+        with self._lock:
+            request = self._requests.pop(key, None)
+
+        if request is None:
+            return False
+
+        request.loop.call_soon_threadsafe(_set_result, request.future, request.items)
+
+        return True
+
+    def fail(self, key, exception):
+        """
+        :return: bool, True if someone was waiting for this request
+        """
+        with self._lock:
+            request = self._requests.pop(key, None)
+
+        if request is None:
+            return False
+
+        request.loop.call_soon_threadsafe(_set_exception, request.future, exception)
+
+        return True
+
+    def abandon(self, key):
+        """
+        Stop waiting, eg after a timeout
+        :return: list of items received so far
+        """
+        with self._lock:
+            request = self._requests.pop(key, None)
+
+        if request is None:
+            return []
+
+        return request.items
+
+
+class AsyncTradeClient(object):
+    """
+    asyncio facade over a TradeApp: every request returns as soon as its End marker arrives, and
+    any number of them can be in flight at once from one thread
+
+    eg. data = await asyncio.gather(client.historical_data(c1), client.historical_data(c2))
+
+    No more than max_open_requests requests of any kind are waiting at once. Historical data requests are paced
+    to stay inside IB's limits by the app's OutboundScheduler, like every other request on the connection.
+    """
+
+    def __init__(self, app, max_open_requests=MAX_OPEN_REQUESTS):
+        self.app = app
+
+        self._open_requests = asyncio.Semaphore(max_open_requests)
+
+    def __repr__(self):
+        return "AsyncTradeClient with " + repr(self.app._my_pending)
+
+    def next_reqid(self):
+        return self.app.allocate_reqid()
+
+    async def _wait_for(self, key, future, timeout, description):
+        """
+        Wait for a pending request to finish; on timeout give up and return what we have, like FinishableQueue
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            print("Exceeded maximum wait for wrapper to confirm finished whilst getting %s" % description)
+            return self.app._my_pending.abandon(key)
+
+    def _register(self, key):
+        return self.app._my_pending.register(key, asyncio.get_running_loop())
+
+    async def positions(self, timeout=10):
+        """
+        Current positions held
+        :return: list of (account, localSymbol, position, avgCost)
+        """
+        future = self._register(POSITIONS_KEY)
+        self.app.reqPositions()
+
+        return await self._wait_for(POSITIONS_KEY, future, timeout, "positions")
+
+    async def accounting_data(self, accountName, timeout=10):
+        """
+        Subscribes to account updates, if the app isn't already, and returns what we have
+        :return: dict, keys are labels, see AccountData.seperate_into_dict
+        """
+        if self.app._subscribed_account != accountName:
+            key = accounts_key(accountName)
+            future = self._register(key)
+            self.app.reqAccountUpdates(True, accountName)
+            self.app._subscribed_account = accountName
+
+            # the wrapper files the data itself, we only wait for accountDownloadEnd
+            await self._wait_for(key, future, timeout, "accounting data")
+
+        return self.app.get_account_data(accountName).seperate_into_dict()
+
+    async def contract_details(self, ibcontract, timeout=10):
+        """
+        :return: list of ContractDetails
+        """
+        async with self._open_requests:
+            reqId = self.next_reqid()
+            future = self._register(reqId)
+            self.app.reqContractDetails(reqId, ibcontract)
+
+            return await self._wait_for(reqId, future, timeout, "contract details")
+
+    async def resolve_contract(self, ibcontract, timeout=10):
+        """
+        From a partially formed contract, returns a fully fledged version
+        :returns fully resolved IB contract
+        """
+        contract_cache = self.app._contract_cache
+        resolved_ibcontract = contract_cache.get(ibcontract)
+        if resolved_ibcontract is not None:
+            return resolved_ibcontract
+
+        new_contract_details = await self.contract_details(ibcontract, timeout=timeout)
+
+        if len(new_contract_details) == 0:
+            print("Failed to get additional contract details: returning unresolved contract")
+            return ibcontract
+
+        if len(new_contract_details) > 1:
+            print("got multiple contracts using first one")
+
+        resolved_ibcontract = contract_from_details(new_contract_details[0])
+        contract_cache.put(ibcontract, resolved_ibcontract)
+
+        return resolved_ibcontract
+
+    async def historical_data(self, ibcontract, durationStr="1 D", barSizeSetting="5 mins", timeout=20):
+        """
+        Returns historical prices for a contract, up to today
+        :returns list of bar tuples (date, open, high, low, close, volume)
+        """
+        async with self._open_requests:
+            tickerid = self.next_reqid()
+            future = self._register(tickerid)
+
+            self.app.reqHistoricalData(
+                tickerid,  # tickerId,
+                ibcontract,  # contract,
+                datetime.datetime.today().strftime("%Y%m%d %H:%M:%S %Z"),  # endDateTime,
+                durationStr,  # durationStr,
+                barSizeSetting,  # barSizeSetting,
+                "MIDPOINT",  # whatToShow,
+                1,  # useRTH,
+                1,  # formatDate
+                False,  # KeepUpToDate
+                []  ## chartoptions not used
+            )
+
+            historic_data = await self._wait_for(tickerid, future, timeout, "historical data")
+            self.app.cancelHistoricalData(tickerid)
+
+            return historic_data
+
+    async def subscribe_historical_data(self, ibcontract, callback=None, durationStr="1 D", barSizeSetting="5 mins",
+                                        tickerid=None, timeout=20, aggregator=None):
+        """
+        Backfills history, then keeps streaming new or updated bars; see TradeClient.subscribe_IB_historical_data
+        :returns BarStream
+        """
+        if tickerid is None:
+            tickerid = self.next_reqid()
+
+        async with self._open_requests:
+            future = self._register(tickerid)
+            bar_stream = self.app.init_bar_stream(tickerid)
+            if callback is not None:
+                bar_stream.add_subscriber(callback)
+            if aggregator is not None:
+                self.app.init_timeframes(tickerid, bar_stream, aggregator)
+
+            self.app.reqHistoricalData(
+                tickerid,  # tickerId,
+                ibcontract,  # contract,
+                "",  # endDateTime, must be blank with keepUpToDate
+                durationStr,  # durationStr,
+                barSizeSetting,  # barSizeSetting,
+                "MIDPOINT",  # whatToShow,
+                1,  # useRTH,
+                1,  # formatDate
+                True,  # KeepUpToDate
+                []  ## chartoptions not used
+            )
+
+            historic_data = await self._wait_for(tickerid, future, timeout, "historical data")
+
+        if aggregator is not None:
+            aggregator.backfill(historic_data)
+        bar_stream.backfill(historic_data)
+
+        return bar_stream
+
+    async def next_order_id(self, timeout=10):
+        """
+        Get next broker order id, from the app's order manager so it's never handed out twice
+        :return: broker order id, int; or None if unavailable
+        """
+        ## only waits if IB hasn't sent nextValidId yet
+        return await asyncio.get_running_loop().run_in_executor(None, self.app.get_order_manager().next_orderid,
+                                                                 timeout)
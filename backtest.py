@@ -0,0 +1,151 @@
+## Vectorized backtest of the SMA crossover strategy in TradeLogic
+## Everything is whole-array numpy operations, no loop over bars
+
+import numpy as np
+
+from bar_store import BAR_COLUMNS, parse_bar_date
+
+## column order for plain 2-D OHLCV arrays, as in the bar tuples after the date
+OHLCV_COLUMNS = ("open", "high", "low", "close", "volume")
+
+
+def load_csv(filename):
+    """
+    Load bars from a csv with a header line and columns date, open, high, low, close, volume; dates as IB sends them
+
+    :return: dict of column arrays, like BarStore.read
+    """
+    bar_strings = np.loadtxt(filename, delimiter=",", skiprows=1, dtype=str, ndmin=2)
+
+    bar_arrays = dict(time=np.array([parse_bar_date(bar_date) for bar_date in bar_strings[:, 0]], dtype=np.int64))
+    for column_index, (column_name, dtype) in enumerate(BAR_COLUMNS[1:]):
+        bar_arrays[column_name] = bar_strings[:, column_index + 1].astype(dtype)
+
+    return bar_arrays
+
+
+def get_closes(bars):
+    """
+    :param bars: dict of column arrays (BarStore.read, load_csv), or 2-D array with columns open high low close volume
+    :return: 1-D float array of closes
+    """
+    if isinstance(bars, dict):
+        return np.asarray(bars["close"], dtype=np.float64)
+
+    return np.asarray(bars, dtype=np.float64)[:, OHLCV_COLUMNS.index("close")]
+
+
+def sma(data, period):
+    """
+    Simple moving average along the last axis via cumulative sums, like talib.SMA
+
+    :param data: float array, 1-D or 2-D (series x bars)
+    :return: array of the same shape, NaN until there are period values
+    """
+    data = np.asarray(data, dtype=np.float64)
+    cumulative = np.cumsum(data, axis=-1)
+
+    averages = np.full(data.shape, np.nan)
+    if data.shape[-1] < period:
+        return averages
+
+    averages[..., period - 1] = cumulative[..., period - 1]
+    averages[..., period:] = cumulative[..., period:] - cumulative[..., :-period]
+
+    averages[..., period - 1:] /= period
+
+    return averages
+
+
+def cross_signals(closes, short_period=20, long_period=50):
+    """
+    :return: tuple: bool array, True where short SMA is above long SMA (cross_signal for each bar);
+                    bool array, True where both averages exist
+    """
+    ma_short = sma(closes, short_period)
+    ma_long = sma(closes, long_period)
+
+    valid = ~np.isnan(ma_long) & ~np.isnan(ma_short)
+    signals = valid & (ma_short > ma_long)
+
+    return signals, valid
+
+
+def target_positions(signals, valid, pos_volume):
+    """
+    Position after TradeLogic.trade_logic has acted on each bar's signal. It only ever goes flat -> +/-pos_volume
+    or reverses with abs(position) + pos_volume, so the result is always +pos_volume on a long signal and
+    -pos_volume on a short one.
+
+    Unlike the live code, which goes short on the NaN comparison, we stay flat until the long SMA exists
+
+    :return: float array of positions
+    """
+    return np.where(valid, np.where(signals, pos_volume, -pos_volume), 0).astype(np.float64)
+
+
+class BacktestResult(object):
+    """
+    Per bar arrays from a backtest, and a summary of them
+
+    order_sizes are signed, positive to BUY; pnl[i] is the pnl over bar i of the position held coming into it
+    """
+
+    def __init__(self, closes, signals, positions, order_sizes, pnl):
+        self.closes = closes
+        self.signals = signals
+        self.positions = positions
+        self.order_sizes = order_sizes
+        self.pnl = pnl
+        self.equity = np.cumsum(pnl)
+
+    def __repr__(self):
+        return "BacktestResult " + ", ".join(["%s=%s" % (key, str(value)) for key, value in self.summary().items()])
+
+    def summary(self):
+        equity = self.equity
+        if len(equity) == 0:
+            max_drawdown = 0.0
+        else:
+            max_drawdown = float(np.max(np.maximum.accumulate(equity) - equity))
+
+        pnl_std = float(np.std(self.pnl))
+        if pnl_std > 0:
+            sharpe = float(np.mean(self.pnl)) / pnl_std * np.sqrt(len(self.pnl))
+        else:
+            sharpe = 0.0
+
+        return dict(total_pnl=float(np.sum(self.pnl)),
+                    orders=int(np.count_nonzero(self.order_sizes)),
+                    traded_volume=float(np.sum(np.abs(self.order_sizes))),
+                    max_drawdown=max_drawdown,
+                    sharpe=sharpe)
+
+
+def run_backtest(bars, short_period=20, long_period=50, pos_volume=5000, commission_per_unit=0.0):
+    """
+    Run the SMA crossover strategy over bars. Orders are filled at the close of the bar whose signal triggered them
+
+    :param bars: dict of column arrays or 2-D OHLCV array, see get_closes
+    :param commission_per_unit: cost per unit traded, in the quote currency
+    :return: BacktestResult
+    """
+    closes = get_closes(bars)
+
+    signals, valid = cross_signals(closes, short_period=short_period, long_period=long_period)
+    positions = target_positions(signals, valid, pos_volume)
+
+    order_sizes = np.diff(positions, prepend=0.0)
+
+    pnl = np.zeros(len(closes))
+    pnl[1:] = positions[:-1] * np.diff(closes)
+    pnl -= np.abs(order_sizes) * commission_per_unit
+
+    return BacktestResult(closes, signals, positions, order_sizes, pnl)
+
+
+if __name__ == '__main__':
+    import sys
+
+    bar_arrays = load_csv(sys.argv[1])
+    print(run_backtest(bar_arrays))
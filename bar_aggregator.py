@@ -0,0 +1,339 @@
+import numpy as np
+
+from bar_buffer import BarBuffer
+from bar_store import BAR_COLUMNS, format_bar_time, parse_bar_date
+
+## seconds per unit of an IB barSizeSetting
+BAR_SIZE_UNITS = {"sec": 1, "secs": 1, "min": 60, "mins": 60, "hour": 3600, "hours": 3600, "day": 86400,
+                  "days": 86400}
+
+
+def bar_size_seconds(barSizeSetting):
+    """
+    :param barSizeSetting: str as IB has them, eg '5 mins', '1 hour'
+    :return: int seconds
+    """
+    number, unit = barSizeSetting.split()
+    if unit not in BAR_SIZE_UNITS:
+        raise Exception("Can't aggregate to bar size %s" % barSizeSetting)
+
+    return int(number) * BAR_SIZE_UNITS[unit]
+
+
+def _bars_to_arrays(bars):
+    # dict of column arrays from a list of bar tuples, dates parsed once
+    if isinstance(bars, dict):
+        return bars
+
+    bar_arrays = dict([(column_name, np.empty(len(bars), dtype=dtype)) for column_name, dtype in BAR_COLUMNS])
+    if len(bars) == 0:
+        return bar_arrays
+
+    bar_columns = list(zip(*bars))
+    bar_arrays["time"][:] = [parse_bar_date(bar_date) for bar_date in bar_columns[0]]
+    for (column_name, dtype), column in zip(BAR_COLUMNS[1:], bar_columns[1:]):
+        bar_arrays[column_name][:] = column
+
+    return bar_arrays
+
+
+class BarAggregator(object):
+    """
+    Builds bigger bars out of completed base bars, one at a time with add_bar or many at once with add_arrays
+
+    Completed bars are kept in a BarBuffer, bars; the one still forming is forming_bar(). Close subscribers are
+    called with (name, bar tuple) as each bar completes. Subclasses say which bar each base bar belongs to.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.bars = BarBuffer()
+
+        ## [time, open, high, low, close, volume] of the bar being built, and which one it is
+        self._forming = None
+        self._group = None
+        self._close_subscribers = []
+
+    def __repr__(self):
+        return "%s %s with %d bars" % (self.__class__.__name__, self.name, len(self.bars))
+
+    def add_close_subscriber(self, callback):
+        self._close_subscribers.append(callback)
+
+    def forming_bar(self):
+        """
+        :return: tuple (date, open, high, low, close, volume) of the bar not yet complete, or None
+        """
+        if self._forming is None:
+            return None
+
+        return tuple([format_bar_time(self._forming[0])] + self._forming[1:])
+
+    def _groups_of(self, bar_time, bar_volume):
+        """
+        :return: tuple (group, closes): which bar this base bar belongs to, and whether it's the last base bar in it
+        """
+        raise Exception("You need to set this method in an inherited class")
+
+    def _groups_of_arrays(self, bar_times, bar_volumes):
+        """
+        :return: tuple of arrays (groups, closes), like _groups_of for each base bar
+        """
+        raise Exception("You need to set this method in an inherited class")
+
+    def _bar_times(self, groups, bar_times):
+        # time of each bar from its group and the time of its first base bar; that time by default
+        return bar_times
+
+    def _close(self, publish):
+        self.bars.append(*self._forming)
+        completed_bar = self.forming_bar()
+        self._forming = None
+
+        if publish:
+            for callback in self._close_subscribers:
+                callback(self.name, completed_bar)
+
+    def _add(self, group, closes, bar_time, bar_open, bar_high, bar_low, bar_close, bar_volume, publish):
+        forming = self._forming
+        if forming is not None and group != self._group:
+            ## the base bar which would have completed it never came, eg a gap in the data
+            self._close(publish)
+            forming = None
+
+        if forming is None:
+            bar_time = int(self._bar_times(np.array([group]), np.array([bar_time]))[0])
+            self._forming = [bar_time, bar_open, bar_high, bar_low, bar_close, max(bar_volume, 0.0)]
+            self._group = group
+        else:
+            forming[2] = max(forming[2], bar_high)
+            forming[3] = min(forming[3], bar_low)
+            forming[4] = bar_close
+            forming[5] += max(bar_volume, 0.0)
+
+        if closes:
+            self._close(publish)
+
+    def add_bar(self, bar, publish=True):
+        """
+        :param bar: completed base bar, tuple (date, open, high, low, close, volume); date str or int seconds
+        :return: nothing
+        """
+        bar_date, bar_open, bar_high, bar_low, bar_close, bar_volume = bar
+        if isinstance(bar_date, str):
+            bar_date = parse_bar_date(bar_date)
+
+        group, closes = self._groups_of(bar_date, bar_volume)
+        self._add(group, closes, bar_date, bar_open, bar_high, bar_low, bar_close, bar_volume, publish)
+
+    def add_arrays(self, bar_arrays, publish=False):
+        """
+        Many completed base bars at once, eg a backfill: whole bars are built with numpy, only the ends go through
+        add_bar's path
+
+        :param bar_arrays: dict of column arrays, oldest first, like BarBuffer.view or BarStore.read
+        :param publish: call close subscribers for the bars completed; off by default, history isn't news
+        :return: nothing
+        """
+        bar_times = bar_arrays["time"]
+        bar_count = len(bar_times)
+        if bar_count == 0:
+            return
+
+        columns = [bar_arrays[column_name] for column_name, dtype in BAR_COLUMNS]
+        bar_volumes = np.maximum(columns[5], 0.0)
+        groups, closes = self._groups_of_arrays(bar_times, bar_volumes)
+
+        ## start of each bar, and one past its end
+        starts = np.concatenate(([0], np.flatnonzero((groups[1:] != groups[:-1]) | closes[:-1]) + 1))
+        ends = np.append(starts[1:], bar_count)
+
+        first_bar = 0
+        if self._forming is not None and groups[0] == self._group:
+            ## finish the bar already forming
+            for bar_index in range(starts[0], ends[0]):
+                self._add(groups[bar_index], closes[bar_index], *[column[bar_index] for column in columns[:5]],
+                          bar_volumes[bar_index], publish=publish)
+            first_bar = 1
+            if self._forming is not None and len(starts) > 1:
+                ## the base bar which would have completed it never came, as in _add; close it before the bars
+                ## after it are built
+                self._close(publish)
+        elif self._forming is not None:
+            self._close(publish)
+
+        last_bar = len(starts)
+        if not closes[-1]:
+            ## still forming, goes through _add below
+            last_bar -= 1
+
+        if last_bar > first_bar:
+            range_start, range_end = starts[first_bar], ends[last_bar - 1]
+            bar_starts = starts[first_bar:last_bar] - range_start
+            bar_ends = ends[first_bar:last_bar] - range_start
+
+            completed_arrays = dict(
+                time=self._bar_times(groups[range_start:range_end][bar_starts],
+                                     bar_times[range_start:range_end][bar_starts]),
+                open=columns[1][range_start:range_end][bar_starts],
+                high=np.maximum.reduceat(columns[2][range_start:range_end], bar_starts),
+                low=np.minimum.reduceat(columns[3][range_start:range_end], bar_starts),
+                close=columns[4][range_start:range_end][bar_ends - 1],
+                volume=np.add.reduceat(bar_volumes[range_start:range_end], bar_starts))
+            self.bars.extend(completed_arrays)
+
+            if publish:
+                for bar_index in range(len(bar_starts)):
+                    completed_bar = tuple([format_bar_time(completed_arrays["time"][bar_index])] +
+                                          [completed_arrays[column_name][bar_index]
+                                           for column_name, dtype in BAR_COLUMNS[1:]])
+                    for callback in self._close_subscribers:
+                        callback(self.name, completed_bar)
+
+        if last_bar < len(starts) and last_bar >= first_bar:
+            for bar_index in range(starts[last_bar], bar_count):
+                self._add(groups[bar_index], closes[bar_index], *[column[bar_index] for column in columns[:5]],
+                          bar_volumes[bar_index], publish=publish)
+
+
+class TimeBarAggregator(BarAggregator):
+    """
+    Bars of a longer bar size, eg 15 mins or 1 hour out of 5 min bars, aligned to multiples of the bar size
+    """
+
+    def __init__(self, barSizeSetting, base_barSizeSetting):
+        BarAggregator.__init__(self, barSizeSetting)
+        self.seconds = bar_size_seconds(barSizeSetting)
+        self.base_seconds = bar_size_seconds(base_barSizeSetting)
+
+        if self.seconds % self.base_seconds != 0:
+            raise Exception("Can't make %s bars out of %s bars" % (barSizeSetting, base_barSizeSetting))
+
+    def _groups_of(self, bar_time, bar_volume):
+        group = bar_time // self.seconds
+        ## complete once its last base bar is
+        return group, bar_time + self.base_seconds >= (group + 1) * self.seconds
+
+    def _groups_of_arrays(self, bar_times, bar_volumes):
+        groups = bar_times // self.seconds
+        return groups, bar_times + self.base_seconds >= (groups + 1) * self.seconds
+
+    def _bar_times(self, groups, bar_times):
+        return groups * self.seconds
+
+
+class CountBarAggregator(BarAggregator):
+    """
+    One bar out of every bar_count base bars
+    """
+
+    def __init__(self, bar_count):
+        BarAggregator.__init__(self, "%d bars" % bar_count)
+        self.bar_count = bar_count
+        self._base_bar_count = 0
+
+    def _groups_of(self, bar_time, bar_volume):
+        group = self._base_bar_count // self.bar_count
+        self._base_bar_count += 1
+        return group, self._base_bar_count % self.bar_count == 0
+
+    def _groups_of_arrays(self, bar_times, bar_volumes):
+        base_bar_numbers = np.arange(self._base_bar_count, self._base_bar_count + len(bar_times))
+        self._base_bar_count += len(bar_times)
+        return base_bar_numbers // self.bar_count, (base_bar_numbers + 1) % self.bar_count == 0
+
+
+class VolumeBarAggregator(BarAggregator):
+    """
+    A bar for every bar_volume traded: a base bar belongs to the bar in which the volume before it falls, and
+    completes it if its own volume reaches the next multiple. Needs real volumes; IB sends -1 for MIDPOINT bars,
+    which count as 0
+    """
+
+    def __init__(self, bar_volume):
+        BarAggregator.__init__(self, "%s volume" % str(bar_volume))
+        self.bar_volume = float(bar_volume)
+        self._total_volume = 0.0
+
+    def _groups_of(self, bar_time, bar_volume):
+        group = int(self._total_volume // self.bar_volume)
+        self._total_volume += max(bar_volume, 0.0)
+        return group, int(self._total_volume // self.bar_volume) > group
+
+    def _groups_of_arrays(self, bar_times, bar_volumes):
+        total_volumes = self._total_volume + np.cumsum(bar_volumes)
+        volumes_before = total_volumes - bar_volumes
+        self._total_volume = float(total_volumes[-1])
+
+        groups = (volumes_before // self.bar_volume).astype(np.int64)
+        return groups, (total_volumes // self.bar_volume).astype(np.int64) > groups
+
+
+class MultiTimeframeAggregator(object):
+    """
+    Every timeframe a strategy wants out of one base bar subscription: longer bar sizes, N bar and volume bars
+
+    Backfill it, then feed it each base bar as it closes (BarStream close subscriber); close subscribers are called
+    with (name, bar tuple) for every timeframe's completed bars. TradeClient.subscribe_IB_historical_data does both
+    when given one, and publishes TIMEFRAME_BAR_CLOSED events.
+    """
+
+    def __init__(self, base_barSizeSetting, barSizeSettings=(), bar_counts=(), bar_volumes=()):
+        self.base_barSizeSetting = base_barSizeSetting
+        self.aggregators = [TimeBarAggregator(barSizeSetting, base_barSizeSetting)
+                            for barSizeSetting in barSizeSettings]
+        self.aggregators += [CountBarAggregator(bar_count) for bar_count in bar_counts]
+        self.aggregators += [VolumeBarAggregator(bar_volume) for bar_volume in bar_volumes]
+
+    def __repr__(self):
+        return "MultiTimeframeAggregator from %s bars to %s" % (self.base_barSizeSetting, str(
+            [aggregator.name for aggregator in self.aggregators]))
+
+    def __getitem__(self, name):
+        for aggregator in self.aggregators:
+            if aggregator.name == name:
+                return aggregator
+
+        raise KeyError(name)
+
+    def add_close_subscriber(self, callback):
+        for aggregator in self.aggregators:
+            aggregator.add_close_subscriber(callback)
+
+    def backfill(self, bars, forming_last=True):
+        """
+        :param bars: list of bar tuples, or dict of column arrays like BarBuffer.view or BarStore.read
+        :param forming_last: the last bar is still forming, as at the end of a keepUpToDate backfill; it's left out
+                             and comes to add_bar once it closes
+        :return: nothing
+        """
+        bar_arrays = _bars_to_arrays(bars)
+        if forming_last:
+            bar_arrays = dict([(column_name, column[:-1]) for column_name, column in bar_arrays.items()])
+
+        for aggregator in self.aggregators:
+            aggregator.add_arrays(bar_arrays)
+
+    def add_bar(self, bar):
+        """
+        :param bar: completed base bar tuple
+        :return: nothing
+        """
+        bar_date = bar[0]
+        if isinstance(bar_date, str):
+            ## parsed once for all the timeframes
+            bar = (parse_bar_date(bar_date),) + tuple(bar[1:])
+
+        for aggregator in self.aggregators:
+            aggregator.add_bar(bar)
+
+    def attach(self, bar_stream, publish_function=None):
+        """
+        Feed it the bars bar_stream closes; call before the stream is backfilled
+
+        :param publish_function: called with (name, bar tuple) for completed bars, eg to publish an event
+        :return: nothing
+        """
+        bar_stream.add_close_subscriber(self.add_bar)
+        if publish_function is not None:
+            self.add_close_subscriber(publish_function)
@@ -0,0 +1,124 @@
+import numpy as np
+
+from bar_store import BAR_COLUMNS, parse_bar_date, to_bar_tuples
+
+DEFAULT_BAR_CAPACITY = 1024
+
+
+class BarBuffer(object):
+    """
+    Bars from one historical data request, appended straight into typed column arrays as they arrive: int64 times
+    (see bar_store.parse_bar_date) and float64 OHLCV. The arrays are preallocated and double when they fill up.
+    The dates are also kept as IB sent them, since daily bars and dates with a timezone don't format back the same
+
+    view() hands the bars out as numpy views without copying them; to_bar_tuples() gives the old list of tuples
+    """
+
+    def __init__(self, capacity=DEFAULT_BAR_CAPACITY):
+        self._columns = [np.empty(capacity, dtype=dtype) for column_name, dtype in BAR_COLUMNS]
+        self._column_indexes = dict([(column_name, column_index)
+                                     for column_index, (column_name, dtype) in enumerate(BAR_COLUMNS)])
+        ## str as IB sent it, or None if we were only given the time
+        self._dates = []
+        self._count = 0
+        self._make_read_only_columns()
+
+    def __repr__(self):
+        return "BarBuffer with %d bars" % self._count
+
+    def __len__(self):
+        return self._count
+
+    def _make_read_only_columns(self):
+        ## slices of a read only view are read only too, which is much cheaper than setting the flag on every slice
+        self._read_only_columns = []
+        for column in self._columns:
+            read_only_column = column.view()
+            read_only_column.flags.writeable = False
+            self._read_only_columns.append(read_only_column)
+
+    def _grow(self):
+        new_capacity = max(len(self._columns[0]) * 2, 1)
+        for column_index, column in enumerate(self._columns):
+            new_column = np.empty(new_capacity, dtype=column.dtype)
+            new_column[:self._count] = column[:self._count]
+            self._columns[column_index] = new_column
+        self._make_read_only_columns()
+
+    def append(self, bar_date, bar_open, bar_high, bar_low, bar_close, bar_volume):
+        """
+        :param bar_date: str as IB sends it, or int seconds
+        :return: nothing
+        """
+        count = self._count
+        time_column, open_column, high_column, low_column, close_column, volume_column = self._columns
+        if count == len(time_column):
+            self._grow()
+            time_column, open_column, high_column, low_column, close_column, volume_column = self._columns
+
+        if isinstance(bar_date, str):
+            self._dates.append(bar_date)
+            bar_date = parse_bar_date(bar_date)
+        else:
+            self._dates.append(None)
+
+        time_column[count] = bar_date
+        open_column[count] = bar_open
+        high_column[count] = bar_high
+        low_column[count] = bar_low
+        close_column[count] = bar_close
+        volume_column[count] = bar_volume
+
+        self._count = count + 1
+
+    def extend(self, bar_arrays):
+        """
+        :param bar_arrays: dict of column arrays of equal length, like view()
+        :return: nothing
+        """
+        count = self._count
+        new_count = count + len(bar_arrays["time"])
+        while new_count > len(self._columns[0]):
+            self._grow()
+
+        for (column_name, dtype), column in zip(BAR_COLUMNS, self._columns):
+            column[count:new_count] = bar_arrays[column_name]
+
+        self._dates.extend([None] * (new_count - count))
+        self._count = new_count
+
+    def append_bar(self, bar):
+        """
+        :param bar: ibapi BarData
+        :return: nothing
+        """
+        self.append(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
+
+    def view(self, column_names=None):
+        """
+        :param column_names: columns wanted, default all of them
+        :return: dict, keys are column names, values are read only views onto the buffer, like BarStore.read
+        """
+        bar_arrays = {}
+        for (column_name, dtype), read_only_column in zip(BAR_COLUMNS, self._read_only_columns):
+            if column_names is not None and column_name not in column_names:
+                continue
+
+            bar_arrays[column_name] = read_only_column[:self._count]
+
+        return bar_arrays
+
+    def column(self, column_name):
+        """
+        One column without building a dict, for callers on the path of every bar
+
+        :return: read only view onto the buffer
+        """
+        return self._read_only_columns[self._column_indexes[column_name]][:self._count]
+
+    def to_bar_tuples(self):
+        """
+        :return: list of (date, open, high, low, close, volume) tuples, dates as IB sent them; in IB's intraday
+                 format for bars we were only given the time of
+        """
+        return to_bar_tuples(self.view(), bar_dates=self._dates)
@@ -0,0 +1,245 @@
+import calendar
+import datetime
+import functools
+import math
+import os
+import time
+
+import numpy as np
+
+## one file per column, appended to as bars arrive
+BAR_COLUMNS = (("time", np.int64), ("open", np.float64), ("high", np.float64),
+               ("low", np.float64), ("close", np.float64), ("volume", np.float64))
+
+## how IB formats bar dates with formatDate=1
+IB_BAR_TIME_FORMAT = "%Y%m%d  %H:%M:%S"
+IB_BAR_DAY_FORMAT = "%Y%m%d"
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+## longest duration IB accepts in seconds, and in days; beyond that it has to be years
+MAX_DURATION_SECONDS = 86400
+MAX_DURATION_DAYS = 365
+
+
+@functools.lru_cache(maxsize=4096)
+def _day_seconds(day_string):
+    return (datetime.date(int(day_string[0:4]), int(day_string[4:6]), int(day_string[6:8])).toordinal() -
+            EPOCH_ORDINAL) * 86400
+
+
+@functools.lru_cache(maxsize=4096)
+def _time_of_day_seconds(time_string):
+    return int(time_string[0:2]) * 3600 + int(time_string[3:5]) * 60 + int(time_string[6:8])
+
+
+def parse_bar_date(bar_date):
+    """
+    IB bar dates are wall clock time in the TWS timezone. We store them as if they were UTC, so they sort and
+    difference correctly. Any timezone on the end is dropped, and daily bars become midnight, so format_bar_time
+    only gives back what IB sent for intraday bars with formatDate=1
+
+    :param bar_date: str, eg '20180315  14:35:00', '20180315' for daily bars, optionally with a timezone on the end
+    :return: int, seconds
+    """
+    if len(bar_date) == 18 and bar_date[8] == " ":
+        ## the usual intraday format; this is on the path of every bar, so don't go through strptime
+        return _day_seconds(bar_date[:8]) + _time_of_day_seconds(bar_date[10:])
+
+    date_parts = bar_date.split()
+    if len(date_parts) == 1:
+        if len(bar_date) > 8:
+            ## formatDate=2, already seconds since the epoch
+            return int(bar_date)
+        bar_datetime = datetime.datetime.strptime(bar_date, IB_BAR_DAY_FORMAT)
+    else:
+        bar_datetime = datetime.datetime.strptime(date_parts[0] + "  " + date_parts[1], IB_BAR_TIME_FORMAT)
+
+    return calendar.timegm(bar_datetime.timetuple())
+
+
+@functools.lru_cache(maxsize=4096)
+def _day_string(days):
+    return datetime.date.fromordinal(days + EPOCH_ORDINAL).strftime(IB_BAR_DAY_FORMAT)
+
+
+def format_bar_time(bar_time):
+    """
+    :param bar_time: int seconds, see parse_bar_date
+    :return: str, eg '20180315  14:35:00', IB's intraday format whatever the bar size
+    """
+    days, seconds = divmod(int(bar_time), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+
+    return "%s  %02d:%02d:%02d" % (_day_string(days), hours, minutes, seconds)
+
+
+def to_bar_tuples(bar_arrays, bar_dates=None):
+    """
+    :param bar_arrays: dict of column arrays, as returned by BarStore.read
+    :param bar_dates: list of date strings to use instead of formatting the times, None where there isn't one
+    :return: list of (date, open, high, low, close, volume) tuples, as returned by get_IB_historical_data
+    """
+    if bar_dates is None:
+        bar_dates = [None] * len(bar_arrays["time"])
+
+    return [(format_bar_time(bar_time) if bar_date is None else bar_date, bar_open, bar_high, bar_low, bar_close,
+             bar_volume)
+            for bar_date, bar_time, bar_open, bar_high, bar_low, bar_close, bar_volume in
+            zip(bar_dates, *[bar_arrays[column_name].tolist() for column_name, dtype in BAR_COLUMNS])]
+
+
+class BarStore(object):
+    """
+    Local store of historical bars: a directory per contract and bar size, holding an append-only file per
+    column (int64 times, float64 OHLCV). Reads are memory mapped, so they don't copy anything
+    """
+
+    def __init__(self, root_directory):
+        self.root_directory = root_directory
+
+    def __repr__(self):
+        return "BarStore in " + self.root_directory
+
+    def _series_directory(self, ibcontract, barSizeSetting):
+        if ibcontract.localSymbol:
+            contract_name = ibcontract.localSymbol
+        else:
+            contract_name = "%s.%s" % (ibcontract.symbol, ibcontract.currency)
+
+        contract_name = "%s_%s_%d" % (contract_name, ibcontract.secType, ibcontract.conId)
+
+        return os.path.join(self.root_directory, contract_name.replace(" ", "_"), barSizeSetting.replace(" ", "_"))
+
+    def _column_filename(self, series_directory, column_name):
+        return os.path.join(series_directory, column_name + ".bin")
+
+    def _row_count(self, series_directory):
+        # a crash half way through an append can leave columns different lengths, so trust the shortest
+        row_counts = []
+        for column_name, dtype in BAR_COLUMNS:
+            column_filename = self._column_filename(series_directory, column_name)
+            if not os.path.exists(column_filename):
+                return 0
+            row_counts.append(os.path.getsize(column_filename) // np.dtype(dtype).itemsize)
+
+        return min(row_counts)
+
+    def read(self, ibcontract, barSizeSetting):
+        """
+        :return: dict, keys are column names, values are read only arrays memory mapped onto the store
+        """
+        series_directory = self._series_directory(ibcontract, barSizeSetting)
+        row_count = self._row_count(series_directory)
+
+        bar_arrays = {}
+        for column_name, dtype in BAR_COLUMNS:
+            if row_count == 0:
+                ## can't memory map an empty file
+                bar_arrays[column_name] = np.empty(0, dtype=dtype)
+            else:
+                bar_arrays[column_name] = np.memmap(self._column_filename(series_directory, column_name),
+                                                    dtype=dtype, mode="r", shape=(row_count,))
+
+        return bar_arrays
+
+    def last_bar_time(self, ibcontract, barSizeSetting):
+        """
+        :return: int seconds, or None if we have nothing stored
+        """
+        bar_times = self.read(ibcontract, barSizeSetting)["time"]
+        if len(bar_times) == 0:
+            return None
+
+        return int(bar_times[-1])
+
+    def append(self, ibcontract, barSizeSetting, bars_list):
+        """
+        Add bars newer than the last one stored. A bar with the same time as the last one replaces it, since
+        the last bar we stored may still have been forming
+
+        :param bars_list: list of (date, open, high, low, close, volume) tuples, oldest first
+        :return: int, number of bars written
+        """
+        bar_arrays = {}
+        for column_index, (column_name, dtype) in enumerate(BAR_COLUMNS):
+            if column_name == "time":
+                bar_arrays[column_name] = np.array([parse_bar_date(bar[0]) for bar in bars_list], dtype=dtype)
+            else:
+                bar_arrays[column_name] = np.array([bar[column_index] for bar in bars_list], dtype=dtype)
+
+        return self.append_arrays(ibcontract, barSizeSetting, bar_arrays)
+
+    def append_arrays(self, ibcontract, barSizeSetting, bar_arrays):
+        """
+        As append, for bars already in column arrays, eg BarBuffer.view()
+
+        :param bar_arrays: dict of column arrays, times sorted
+        :return: int, number of bars written
+        """
+        series_directory = self._series_directory(ibcontract, barSizeSetting)
+        row_count = self._row_count(series_directory)
+        last_bar_time = self.last_bar_time(ibcontract, barSizeSetting)
+
+        new_bars_start = 0
+        if last_bar_time is not None:
+            new_bars_start = int(np.searchsorted(bar_arrays["time"], last_bar_time, side="left"))
+
+        new_bar_count = len(bar_arrays["time"]) - new_bars_start
+        if new_bar_count <= 0:
+            return 0
+
+        if last_bar_time is not None and bar_arrays["time"][new_bars_start] == last_bar_time:
+            ## overwrite the last row
+            row_count -= 1
+
+        os.makedirs(series_directory, exist_ok=True)
+
+        for column_name, dtype in BAR_COLUMNS:
+            column_data = np.asarray(bar_arrays[column_name][new_bars_start:], dtype=dtype)
+            column_filename = self._column_filename(series_directory, column_name)
+
+            with open(column_filename, "ab") as column_file:
+                column_file.truncate(row_count * np.dtype(dtype).itemsize)
+                column_file.write(column_data.tobytes())
+
+        return new_bar_count
+
+    def duration_since_last_bar(self, ibcontract, barSizeSetting, default_durationStr="1 D"):
+        """
+        IB duration string covering the gap between the last stored bar and now, including the last bar itself
+
+        :return: str, eg '3600 S', '3 D' or '2 Y'; default_durationStr if nothing is stored
+        """
+        last_bar_time = self.last_bar_time(ibcontract, barSizeSetting)
+        if last_bar_time is None:
+            return default_durationStr
+
+        ## bar times are wall clock time stored as if UTC, so compare with local wall clock time the same way
+        time_now = calendar.timegm(time.localtime())
+        gap_seconds = max(time_now - last_bar_time, 0) + 60
+
+        if gap_seconds <= MAX_DURATION_SECONDS:
+            return "%d S" % gap_seconds
+
+        gap_days = math.ceil(gap_seconds / MAX_DURATION_SECONDS) + 1
+        if gap_days <= MAX_DURATION_DAYS:
+            return "%d D" % gap_days
+
+        return "%d Y" % math.ceil(gap_days / MAX_DURATION_DAYS)
+
+    def sync(self, app, ibcontract, barSizeSetting="5 mins"):
+        """
+        Fetch only the bars we're missing from IB and store them
+
+        :param app: TradeApp
+        :param ibcontract: resolved contract
+        :return: dict of column arrays, as read()
+        """
+        durationStr = self.duration_since_last_bar(ibcontract, barSizeSetting)
+        bar_buffer = app.get_IB_historical_bars(ibcontract, durationStr=durationStr, barSizeSetting=barSizeSetting)
+
+        self.append_arrays(ibcontract, barSizeSetting, bar_buffer.view())
+
+        return self.read(ibcontract, barSizeSetting)
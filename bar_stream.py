@@ -0,0 +1,91 @@
+from threading import Lock
+
+
+class BarStream(object):
+    """
+    Fan out bars from one keepUpToDate historical data request to any number of subscribers
+
+    Subscribers are callables taking a single bar tuple (date, open, high, low, close, volume).
+    They get the backfill first, then only bars that are new or have changed since the last one pushed.
+
+    Close subscribers are called with the completed bar once the next one starts, but only for
+    bars which close after the backfill, so they can be used to trigger trading.
+    """
+
+    def __init__(self, tickerid):
+        self.tickerid = tickerid
+        self.last_bar = None
+
+        self._subscribers = []
+        self._close_subscribers = []
+        self._lock = Lock()
+
+        ## updates can arrive from the reader thread before we've finished handing out the backfill
+        self._live = False
+        self._pending_updates = []
+
+    def __repr__(self):
+        return "BarStream %d with %d subscribers, last bar %s" % (self.tickerid, len(self._subscribers),
+                                                                  str(self.last_bar))
+
+    def add_subscriber(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def remove_subscriber(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def add_close_subscriber(self, callback):
+        with self._lock:
+            self._close_subscribers.append(callback)
+
+    def backfill(self, bars_list):
+        """
+        Push the initial history to subscribers, then any updates which came in while we were waiting
+
+        :param bars_list: list of bar tuples, oldest first
+        :return: nothing
+        """
+        with self._lock:
+            for bar in bars_list:
+                self._push(bar)
+
+            ## from here on bars are closing in real time
+            self._live = True
+
+            for bar in self._pending_updates:
+                self._push(bar)
+
+            self._pending_updates = []
+
+    def update(self, bar):
+        """
+        Called from the wrapper for every historicalDataUpdate
+
+        :param bar: tuple (date, open, high, low, close, volume)
+        :return: nothing
+        """
+        with self._lock:
+            if not self._live:
+                self._pending_updates.append(bar)
+                return
+
+            self._push(bar)
+
+    def _push(self, bar):
+        if bar == self.last_bar:
+            ## IB repeats the forming bar even when nothing has changed
+            return
+
+        last_bar = self.last_bar
+        self.last_bar = bar
+
+        if self._live and last_bar is not None and bar[0] != last_bar[0]:
+            ## a new bar has started, so the previous one is complete
+            for callback in self._close_subscribers:
+                callback(last_bar)
+
+        for callback in self._subscribers:
+            callback(bar)
@@ -0,0 +1,150 @@
+import json
+import os
+import time
+from threading import Lock
+
+from ibapi.contract import Contract as IBcontract
+
+from helpers import Cache
+
+## these identify a contract; anything we didn't fill in is blank and still part of the key
+CONTRACT_KEY_FIELDS = ("secType", "symbol", "currency", "exchange", "primaryExchange",
+                       "lastTradeDateOrContractMonth", "strike", "right", "multiplier", "localSymbol", "conId")
+
+## contract details almost never change intraday
+DEFAULT_CONTRACT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_CONTRACT_CAPACITY = 10000
+
+
+def contract_key(ibcontract):
+    return tuple(str(getattr(ibcontract, field_name, "")) for field_name in CONTRACT_KEY_FIELDS)
+
+
+def contract_to_dict(ibcontract):
+    # only the plain fields, combo legs and delta neutral contracts aren't worth storing
+    return dict([(field_name, value) for field_name, value in vars(ibcontract).items()
+                 if isinstance(value, (str, int, float, bool))])
+
+
+def contract_from_dict(contract_dict):
+    ibcontract = IBcontract()
+    for field_name, value in contract_dict.items():
+        setattr(ibcontract, field_name, value)
+
+    return ibcontract
+
+
+class ContractCache(object):
+    """
+    Resolved contracts, keyed by the identifying fields of the contract we asked about, with a conId index
+
+    Entries expire after ttl_seconds, and once there are capacity of them the least recently used go first.
+    If a filename is given the cache is loaded from it and saved on every change, so resolutions survive a restart.
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_CONTRACT_TTL_SECONDS, filename=None, capacity=DEFAULT_CONTRACT_CAPACITY):
+        self.ttl_seconds = ttl_seconds
+        self.filename = filename
+
+        ## key -> resolved contract
+        self._contracts = Cache(capacity=capacity, ttl_seconds=ttl_seconds)
+        ## conId -> key
+        self._conId_index = {}
+        self._save_lock = Lock()
+
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def __repr__(self):
+        return "ContractCache with %d contracts" % len(self._contracts)
+
+    def get(self, ibcontract):
+        """
+        :param ibcontract: partially or fully formed contract
+        :return: resolved contract, or None if we don't have it or it's expired
+        """
+        return self._contracts.get(contract_key(ibcontract))
+
+    def get_by_conId(self, conId):
+        key = self._conId_index.get(conId, None)
+        if key is None:
+            return None
+
+        return self._contracts.get(key)
+
+    def get_or_resolve(self, ibcontract, resolve_function):
+        """
+        Resolved contract from the cache, or from resolve_function(ibcontract). Threads asking for the same contract
+        at the same time share one call to resolve_function
+
+        :param resolve_function: function returning the resolved contract, or None if it couldn't
+        :return: resolved contract, or None
+        """
+
+        def _resolve():
+            resolved_ibcontract = resolve_function(ibcontract)
+            if resolved_ibcontract is not None:
+                self.put(ibcontract, resolved_ibcontract)
+
+            return resolved_ibcontract
+
+        return self._contracts.get_or_load(contract_key(ibcontract), _resolve)
+
+    def put(self, ibcontract, resolved_ibcontract):
+        """
+        Store a resolution under both the contract we asked about and the resolved one
+
+        :param ibcontract: contract as passed to resolve_ib_contract
+        :param resolved_ibcontract: contract returned by IB
+        :return: nothing
+        """
+        resolved_key = contract_key(resolved_ibcontract)
+
+        self._contracts.put(contract_key(ibcontract), resolved_ibcontract)
+        self._contracts.put(resolved_key, resolved_ibcontract)
+
+        if resolved_ibcontract.conId:
+            self._conId_index[resolved_ibcontract.conId] = resolved_key
+
+        if self.filename is not None:
+            self.save()
+
+    def evict_expired(self):
+        self._contracts.evict_expired()
+
+        for conId, key in list(self._conId_index.items()):
+            if self._contracts.peek(key) is None:
+                self._conId_index.pop(conId, None)
+
+    def stats(self):
+        return self._contracts.stats()
+
+    def save(self):
+        # we keep expiry times, the file has the time each contract was stored
+        cache_list = [dict(key=list(key), contract=contract_to_dict(resolved_ibcontract),
+                           time_stored=expiry_time - self.ttl_seconds)
+                      for key, resolved_ibcontract, expiry_time in self._contracts.items()]
+
+        # write to a temporary file first so a crash can't leave half a cache behind
+        with self._save_lock:
+            temp_filename = self.filename + ".tmp"
+            with open(temp_filename, "w") as cache_file:
+                json.dump(cache_list, cache_file)
+            os.replace(temp_filename, self.filename)
+
+    def load(self):
+        with open(self.filename) as cache_file:
+            cache_list = json.load(cache_file)
+
+        time_now = time.time()
+        for cache_entry in cache_list:
+            ttl_seconds = self.ttl_seconds - (time_now - cache_entry["time_stored"])
+            if ttl_seconds <= 0:
+                continue
+
+            key = tuple(cache_entry["key"])
+            resolved_ibcontract = contract_from_dict(cache_entry["contract"])
+
+            self._contracts.put(key, resolved_ibcontract, ttl_seconds=ttl_seconds)
+            if resolved_ibcontract.conId:
+                self._conId_index[resolved_ibcontract.conId] = contract_key(resolved_ibcontract)
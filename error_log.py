@@ -0,0 +1,109 @@
+import collections
+import time
+
+## reqId IB uses for notices which aren't about any one request
+NO_REQID = -1
+
+## codes 2100 to 2199 are warnings, they don't mean the request failed; nor do these, from outside that range:
+## 399 order message (eg held until the market opens), 10167 delayed market data shown instead
+WARNING_CODE_MIN = 2100
+WARNING_CODE_MAX = 2199
+WARNING_CODES = frozenset([399, 10167])
+
+## market data / HMDS / sec-def farm connection status, sent on every connect and whenever a farm comes and goes;
+## nothing to act on, so they're only counted
+BENIGN_ERROR_CODES = frozenset([2104, 2106, 2107, 2108, 2119, 2158])
+
+DEFAULT_ERROR_CAPACITY = 1000
+
+
+class ErrorRecord(object):
+    """
+    One error callback
+    """
+
+    def __init__(self, reqId, errorCode, errorString, error_time=None):
+        if error_time is None:
+            error_time = time.time()
+
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
+        self.time = error_time
+
+    def __repr__(self):
+        if self.reqId == NO_REQID:
+            return "Notify (%d): Code=%d Message=%s" % (self.reqId, self.errorCode, self.errorString)
+
+        return "Error (%d): Code=%d Message=%s" % (self.reqId, self.errorCode, self.errorString)
+
+    def is_warning(self):
+        return WARNING_CODE_MIN <= self.errorCode <= WARNING_CODE_MAX or self.errorCode in WARNING_CODES
+
+
+class ErrorLog(object):
+    """
+    Errors from IB, kept by the reqId of the request they're about; notices with no reqId go into a ring buffer of
+    the last capacity. Benign codes are only counted
+
+    Everything is appended without taking a lock, so the reader thread never waits here
+    """
+
+    def __init__(self, capacity=DEFAULT_ERROR_CAPACITY, benign_codes=BENIGN_ERROR_CODES):
+        self.capacity = capacity
+        self.benign_codes = benign_codes
+        self.benign_count = 0
+
+        self._notices = collections.deque(maxlen=capacity)
+        ## reqId -> list of ErrorRecords; oldest reqIds are dropped beyond capacity
+        self._request_errors = {}
+
+    def __repr__(self):
+        return "ErrorLog with %d notices, errors for %d requests, %d benign" % (
+            len(self._notices), len(self._request_errors), self.benign_count)
+
+    def add(self, error_record):
+        """
+        :return: bool, False if the error was benign and dropped
+        """
+        if error_record.errorCode in self.benign_codes:
+            self.benign_count += 1
+            return False
+
+        if error_record.reqId == NO_REQID:
+            self._notices.append(error_record)
+            return True
+
+        request_errors = self._request_errors
+        if error_record.reqId not in request_errors and len(request_errors) >= self.capacity:
+            request_errors.pop(next(iter(request_errors)), None)
+        request_errors.setdefault(error_record.reqId, []).append(error_record)
+
+        return True
+
+    def get_request_errors(self, reqId):
+        """
+        :return: list of ErrorRecords for the request, oldest first
+        """
+        return list(self._request_errors.get(reqId, []))
+
+    def pop_request_errors(self, reqId):
+        return self._request_errors.pop(reqId, [])
+
+    def get_notices(self):
+        """
+        :return: list of the ErrorRecords with no reqId still in the ring buffer, oldest first
+        """
+        return list(self._notices)
+
+    def has_notice(self):
+        return len(self._notices) > 0
+
+    def pop_notice(self):
+        """
+        :return: oldest ErrorRecord with no reqId, taking it out of the ring buffer; None if there isn't one
+        """
+        try:
+            return self._notices.popleft()
+        except IndexError:
+            return None
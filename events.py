@@ -0,0 +1,88 @@
+import queue
+from threading import Thread
+
+## event types published by TradeWrapper
+BAR_UPDATE = "bar_update"
+BAR_CLOSED = "bar_closed"
+POSITION = "position"
+POSITION_END = "position_end"
+NEXT_VALID_ID = "next_valid_id"
+## data is (accountName, label, key, value), see AccountData
+ACCOUNT_UPDATE = "account_update"
+## data is the order_manager.ManagedOrder which changed
+ORDER_STATUS = "order_status"
+## data is (tickerid, timeframe name, bar tuple), from a bar_aggregator.MultiTimeframeAggregator
+TIMEFRAME_BAR_CLOSED = "timeframe_bar_closed"
+
+## marker to stop the dispatcher
+STOP = object()
+
+
+class EventDispatcher(object):
+    """
+    Hands events published from the IB reader thread to handlers, one at a time, on a single thread
+
+    Handlers are called in the order events were published, so a strategy never sees two events at once.
+    The dispatcher sleeps on its queue until something arrives; there are no polling wakeups.
+    """
+
+    def __init__(self):
+        self._events = queue.Queue()
+        self._handlers = {}
+        self._thread = None
+
+    def __repr__(self):
+        return "EventDispatcher handling " + ",".join(self._handlers.keys())
+
+    def subscribe(self, event_type, handler):
+        """
+        :param event_type: str, one of the event types above
+        :param handler: callable taking the event data
+        :return: nothing
+        """
+        self._handlers.setdefault(event_type, []).append(handler)
+
+    def publish(self, event_type, data=None):
+        """
+        Safe to call from any thread
+
+        :param event_type: str
+        :param data: anything, passed to handlers as is
+        :return: nothing
+        """
+        self._events.put((event_type, data))
+
+    def run(self):
+        """
+        Dispatch events until stop() is called
+        :return: nothing
+        """
+        while True:
+            event = self._events.get()
+            if event is STOP:
+                return
+
+            event_type, data = event
+            for handler in self._handlers.get(event_type, []):
+                try:
+                    handler(data)
+                except Exception as e:
+                    ## one bad handler shouldn't kill the strategy
+                    print("Error handling %s event:" % event_type, e)
+
+    def start(self):
+        """
+        Run the dispatcher on its own thread
+        :return: thread
+        """
+        thread = self._thread = Thread(target=self.run, daemon=True)
+        thread.start()
+
+        return thread
+
+    def stop(self):
+        self._events.put(STOP)
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
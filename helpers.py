@@ -1,12 +1,201 @@
-from threading import Thread
+from threading import Event, Thread, Lock
+import collections
+import itertools
 import queue
 import time
+
+import numpy as np
 from ibapi.order import Order
 
 ## marker for when queue is finished
 FINISHED = object()
 STARTED = object()
 TIME_OUT = object()
+## marker for nothing in the cache, since None can be a value
+MISSING = object()
+
+class ReqIdAllocator(object):
+    """
+    Hands out unique request ids, so any number of requests can be in flight on one connection
+    """
+    def __init__(self, first_id=1):
+        self._ids = itertools.count(first_id)
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "ReqIdAllocator"
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+
+def contract_from_details(contract_details):
+    # ContractDetails.summary was renamed to contract in later API versions
+    if hasattr(contract_details, "summary"):
+        return contract_details.summary
+
+    return contract_details.contract
+
+
+## labels for the different kinds of account data
+ACCOUNT_UPDATE_FLAG = "update"
+ACCOUNT_VALUE_FLAG = "value"
+ACCOUNT_TIME_FLAG = "time"
+
+## currency for account value lookups when none is given; values with no currency, eg AccountType, need ""
+DEFAULT_ACCOUNT_CURRENCY = "BASE"
+
+
+def parse_account_value(val):
+    """
+    IB sends every account value as a string; most of them are numbers
+
+    :return: float, or the string if it isn't one (eg AccountType)
+    """
+    try:
+        return float(val)
+    except ValueError:
+        return val
+
+
+class AccountData(object):
+    """
+    Live state of one account, sorted by kind as updates arrive rather than in one list sorted afterwards
+
+    Values are keyed by (key, currency) and parsed to floats once as they arrive, portfolio updates by conId (a
+    later update for a contract replaces the earlier one), and we keep the last update time. IB streams changes
+    for as long as we're subscribed, and they are applied in place.
+
+    Subscribers are callables taking (label, key, value), with label one of the ACCOUNT_ flags; they are called on
+    the IB reader thread, only when something has changed
+    """
+
+    def __init__(self, accountName):
+        self.accountName = accountName
+        self._values = {}
+        self._portfolio = {}
+        self._time = None
+        self._subscribers = []
+        # written by the reader thread, read by everyone else
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "AccountData for %s: %d values, %d portfolio items" % (self.accountName, len(self._values),
+                                                                       len(self._portfolio))
+
+    def add_subscriber(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def remove_subscriber(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def update_value(self, key, val, currency):
+        """
+        :return: bool, True if the value is new or has changed
+        """
+        val = parse_account_value(val)
+
+        with self._lock:
+            value_key = (key, currency)
+            if self._values.get(value_key, None) == val:
+                return False
+            self._values[value_key] = val
+
+        self._notify(ACCOUNT_VALUE_FLAG, value_key, val)
+
+        return True
+
+    def update_portfolio(self, contract, portfolio_data):
+        """
+        :param portfolio_data: tuple (contract, position, marketPrice, marketValue, averageCost, unrealizedPNL,
+                               realizedPNL)
+        :return: bool, True if the item is new or has changed
+        """
+        with self._lock:
+            # contracts don't compare by value, so leave them out
+            last_portfolio_data = self._portfolio.get(contract.conId, None)
+            if last_portfolio_data is not None and last_portfolio_data[1:] == portfolio_data[1:]:
+                return False
+            self._portfolio[contract.conId] = portfolio_data
+
+        self._notify(ACCOUNT_UPDATE_FLAG, contract.conId, portfolio_data)
+
+        return True
+
+    def update_time(self, timeStamp):
+        """
+        :return: bool, True if the time has changed
+        """
+        with self._lock:
+            if self._time == timeStamp:
+                return False
+            self._time = timeStamp
+
+        self._notify(ACCOUNT_TIME_FLAG, None, timeStamp)
+
+        return True
+
+    def _notify(self, label, key, value):
+        for callback in list(self._subscribers):
+            callback(label, key, value)
+
+    def get_value(self, key, currency=DEFAULT_ACCOUNT_CURRENCY):
+        """
+        :return: float, str if it isn't a number, or None if we haven't had this value
+        """
+        return self._values.get((key, currency), None)
+
+    def get_portfolio_item(self, conId):
+        return self._portfolio.get(conId, None)
+
+    def get_time(self):
+        return self._time
+
+    def get_values(self):
+        """
+        :return: dict, copy of (key, currency) -> value
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def get_values_array(self):
+        """
+        All values, for analytics
+
+        :return: numpy structured array with fields key, currency, value; value is NaN for values that aren't numbers
+        """
+        with self._lock:
+            value_items = list(self._values.items())
+
+        key_length = max([len(key) for (key, currency), val in value_items] + [1])
+        currency_length = max([len(currency) for (key, currency), val in value_items] + [1])
+        values_dtype = [("key", "U%d" % key_length), ("currency", "U%d" % currency_length), ("value", np.float64)]
+
+        return np.array([(key, currency, val if isinstance(val, float) else np.nan)
+                         for (key, currency), val in value_items], dtype=values_dtype)
+
+    def get_portfolio(self):
+        """
+        :return: list of portfolio tuples
+        """
+        with self._lock:
+            return list(self._portfolio.values())
+
+    def seperate_into_dict(self):
+        """
+        Snapshot of everything
+
+        :return: dict, ACCOUNT_VALUE_FLAG: dict (key, currency) -> value; ACCOUNT_UPDATE_FLAG: list of portfolio
+                 tuples; ACCOUNT_TIME_FLAG: time string
+        """
+        return {ACCOUNT_VALUE_FLAG: self.get_values(),
+                ACCOUNT_UPDATE_FLAG: self.get_portfolio(),
+                ACCOUNT_TIME_FLAG: self._time}
+
 
 class identifed_as(object):
     # сортировка ответов от api
@@ -31,116 +220,216 @@ class list_of_identified_items(list):
         :return: dict, keys are labels, each element is a list of items matching label
         """
 
-        all_labels = [element.label for element in self]
-        dict_data = dict([
-            (label,
-             [element.data for element in self if element.label == label])
-            for label in all_labels])
+        dict_data = {}
+        for element in self:
+            dict_data.setdefault(element.label, []).append(element.data)
 
         return dict_data
 
-class SimpleCache(object):
+class _Flight(object):
+    # one load in progress, which other callers for the same key wait on
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.exception = None
+
+
+class Cache(object):
     """
-    Cache is stored in _cache in nested dict, outer key is accountName, inner key is cache label
+    Thread safe cache with a time to live for each entry and least recently used eviction once there are capacity
+    entries
+
+    get_or_load is single flight: if several threads ask for the same missing key at once only one of them calls the
+    load function, and the others wait for its result rather than sending the same request to IB.
+
+    Counts hits, misses, loads, evictions and load latency, see stats()
     """
-    def __init__(self, max_staleness_seconds):
-        self._cache = dict()
-        self._cache_updated_local_time = dict()
 
-        self._max_staleness_seconds = max_staleness_seconds
+    def __init__(self, capacity=None, ttl_seconds=None):
+        """
+        :param capacity: int, most entries to keep; None for no limit
+        :param ttl_seconds: default time to live; None for entries which never expire
+        """
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+
+        ## key -> (value, expiry time or None), least recently used first
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+        self._lock = Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._loads = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._load_seconds_total = 0.0
+        self._load_seconds_max = 0.0
 
     def __repr__(self):
-        return "Cache with labels"+",".join(self._cache.keys())
-
-    def update_data(self, accountName):
-        raise Exception("You need to set this method in an inherited class")
+        return "Cache with %d entries" % len(self._entries)
 
-    def _get_last_updated_time(self, accountName, cache_label):
-        if accountName not in self._cache_updated_local_time.keys():
-            return None
+    def __len__(self):
+        return len(self._entries)
 
-        if cache_label not in self._cache_updated_local_time[accountName]:
-            return None
+    def _lookup(self, key, time_now):
+        # call with the lock held
+        cache_entry = self._entries.get(key, None)
+        if cache_entry is None:
+            return MISSING
 
-        return self._cache_updated_local_time[accountName][cache_label]
+        value, expiry_time = cache_entry
+        if expiry_time is not None and time_now >= expiry_time:
+            del self._entries[key]
+            self._expirations += 1
+            return MISSING
 
+        return value
 
-    def _set_time_of_updated_cache(self, accountName, cache_label):
-        # make sure we know when the cache was updated
-        if accountName not in self._cache_updated_local_time.keys():
-            self._cache_updated_local_time[accountName]={}
+    def get(self, key, default=None):
+        """
+        :return: cached value, or default if it's missing or expired
+        """
+        with self._lock:
+            value = self._lookup(key, time.time())
+            if value is MISSING:
+                self._misses += 1
+                return default
 
-        self._cache_updated_local_time[accountName][cache_label] = time.time()
+            self._hits += 1
+            self._entries.move_to_end(key)
 
+            return value
 
-    def _is_data_stale(self, accountName, cache_label, ):
+    def peek(self, key, default=None):
         """
-        Check to see if the cached data has been updated recently for a given account and label, or if it's stale
-
-        :return: bool
+        Like get, but doesn't count as a use
         """
-        STALE = True
-        NOT_STALE = False
+        with self._lock:
+            value = self._lookup(key, time.time())
 
-        last_update = self._get_last_updated_time(accountName, cache_label)
+        if value is MISSING:
+            return default
 
-        if last_update is None:
-            ## we haven't got any data, so by construction our data is stale
-            return STALE
+        return value
 
-        time_now = time.time()
-        time_since_updated = time_now - last_update
+    def put(self, key, value, ttl_seconds=None):
+        """
+        :param ttl_seconds: time to live for this entry, if not the default
+        :return: nothing
+        """
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
 
-        if time_since_updated > self._max_staleness_seconds:
-            return STALE
+        if ttl_seconds is None:
+            expiry_time = None
         else:
-            ## recently updated
-            return NOT_STALE
-
-    def _check_cache_empty(self, accountName, cache_label):
-        """
+            expiry_time = time.time() + ttl_seconds
 
-        :param accountName: str
-        :param cache_label: str
-        :return: bool
-        """
-        CACHE_EMPTY = True
-        CACHE_PRESENT = False
+        with self._lock:
+            self._entries[key] = (value, expiry_time)
+            self._entries.move_to_end(key)
 
-        cache = self._cache
-        if accountName not in cache.keys():
-            return CACHE_EMPTY
+            if self.capacity is not None:
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
 
-        cache_this_account = cache[accountName]
-        if cache_label not in cache_this_account.keys():
-            return CACHE_EMPTY
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
 
-        return CACHE_PRESENT
+    def evict_expired(self):
+        time_now = time.time()
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self._lookup(key, time_now)
 
-    def _return_cache_values(self, accountName, cache_label):
+    def items(self):
         """
-
-        :param accountName: str
-        :param cache_label: str
-        :return: None or cache contents
+        :return: list of (key, value, expiry time) for entries that haven't expired
         """
+        self.evict_expired()
+        with self._lock:
+            return [(key, value, expiry_time) for key, (value, expiry_time) in self._entries.items()]
 
-        if self._check_cache_empty(accountName, cache_label):
-            return None
-
-        return self._cache[accountName][cache_label]
+    def get_or_load(self, key, load_function, ttl_seconds=None):
+        """
+        Cached value if we have one, otherwise the result of load_function(), which is cached unless it's None
 
+        :param load_function: function with no arguments; exceptions it raises are raised in every waiting caller
+        :return: value
+        """
+        with self._lock:
+            value = self._lookup(key, time.time())
+            if value is not MISSING:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return value
+
+            self._misses += 1
+
+            flight = self._flights.get(key, None)
+            if flight is not None:
+                loading = False
+            else:
+                loading = True
+                flight = self._flights[key] = _Flight()
+
+        if not loading:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+
+            return flight.value
+
+        start_time = time.time()
+        try:
+            flight.value = load_function()
+            if flight.value is not None:
+                self.put(key, flight.value, ttl_seconds=ttl_seconds)
+        except Exception as exception:
+            flight.exception = exception
+            raise
+        finally:
+            load_seconds = time.time() - start_time
+            with self._lock:
+                del self._flights[key]
+                self._loads += 1
+                self._load_seconds_total += load_seconds
+                self._load_seconds_max = max(self._load_seconds_max, load_seconds)
+
+            flight.done.set()
+
+        return flight.value
+
+    def stats(self):
+        """
+        :return: dict of counters; load times in seconds
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return dict(entries=len(self._entries), hits=self._hits, misses=self._misses,
+                        hit_rate=self._hits / float(lookups) if lookups > 0 else 0.0,
+                        loads=self._loads, evictions=self._evictions, expirations=self._expirations,
+                        load_seconds_mean=self._load_seconds_total / self._loads if self._loads > 0 else 0.0,
+                        load_seconds_max=self._load_seconds_max)
 
-    def _create_cache_element(self, accountName, cache_label):
 
-        cache = self._cache
-        if accountName not in cache.keys():
-            cache[accountName] = {}
+class SimpleCache(object):
+    """
+    Cache keyed by accountName and cache label, refreshed all at once for an account by update_data when the label
+    we want is missing or older than max_staleness_seconds. Only one refresh runs at a time for each label
+    """
+    def __init__(self, max_staleness_seconds, capacity=None):
+        self._cache = Cache(capacity=capacity, ttl_seconds=max_staleness_seconds)
+        self._max_staleness_seconds = max_staleness_seconds
 
-        cache_this_account = cache[accountName]
-        if cache_label not in cache_this_account.keys():
-            cache[accountName][cache_label] = None
+    def __repr__(self):
+        return "SimpleCache with %d entries" % len(self._cache)
 
+    def update_data(self, accountName):
+        raise Exception("You need to set this method in an inherited class")
 
     def get_updated_cache(self, accountName, cache_label):
         """
@@ -150,12 +439,13 @@ class SimpleCache(object):
         :param cache_label:  str
         :return: updated part of cache
         """
+        cache_key = (accountName, cache_label)
 
-        if self._is_data_stale(accountName, cache_label) or self._check_cache_empty(accountName, cache_label):
+        def _update():
             self.update_data(accountName)
+            return self._cache.peek(cache_key)
 
-        return self._return_cache_values(accountName, cache_label)
-
+        return self._cache.get_or_load(cache_key, _update)
 
     def update_cache(self, accountName, dict_with_data):
         """
@@ -164,11 +454,8 @@ class SimpleCache(object):
         :param dict_with_data: dict, which has keynames with cache labels
         :return: nothing
         """
+        for cache_label, cache_value in dict_with_data.items():
+            self._cache.put((accountName, cache_label), cache_value)
 
-        all_labels = dict_with_data.keys()
-        for cache_label in all_labels:
-            self._create_cache_element(accountName, cache_label)
-            self._cache[accountName][cache_label] = dict_with_data[cache_label]
-            self._set_time_of_updated_cache(accountName, cache_label)
-
-
+    def stats(self):
+        return self._cache.stats()
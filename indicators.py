@@ -0,0 +1,246 @@
+## Incremental indicators, updated one bar at a time
+## Each new bar costs O(1), so we never recompute a moving average over the whole history
+
+import numpy as np
+
+from bar_store import parse_bar_date
+
+# индексы полей в кортеже бара (date, open, high, low, close, volume)
+BAR_DATE = 0
+BAR_CLOSE = 4
+
+
+class MovingAverage(object):
+    """
+    Simple moving average over a fixed window, backed by a ring buffer and a running sum
+    """
+
+    def __init__(self, period):
+        if period < 1:
+            raise Exception("Moving average period must be at least 1, got %s" % str(period))
+
+        self.period = period
+        self._values = [0.0] * period
+        self._position = 0
+        self._count = 0
+        self._sum = 0.0
+
+    def __repr__(self):
+        return "MovingAverage(%d) = %s" % (self.period, str(self.value))
+
+    def update(self, value):
+        """
+        Add a new value to the window, dropping the oldest one if the window is full
+
+        :param value: float
+        :return: current average, or None if we don't have a full window yet
+        """
+        position = self._position
+
+        if self._count == self.period:
+            self._sum -= self._values[position]
+        else:
+            self._count += 1
+
+        self._values[position] = value
+        self._sum += value
+
+        position += 1
+        if position == self.period:
+            position = 0
+            ## running sums drift with float rounding; resum once per lap, still O(1) amortised
+            self._sum = sum(self._values[:self._count])
+
+        self._position = position
+
+        return self.value
+
+    def update_many(self, values):
+        """
+        Add several values, oldest first. Only the last period of them can still be in the window, so that's all
+        we look at
+
+        :param values: sequence of floats, eg a numpy array
+        :return: current average, or None if we don't have a full window yet
+        """
+        if len(values) < self.period:
+            for value in values:
+                self.update(float(value))
+
+            return self.value
+
+        self._values = [float(value) for value in values[len(values) - self.period:]]
+        self._position = 0
+        self._count = self.period
+        self._sum = sum(self._values)
+
+        return self.value
+
+    def replace_last(self, value):
+        """
+        Overwrite the most recent value, eg when the last bar is still forming and gets revised
+
+        :param value: float
+        :return: current average, or None if we don't have a full window yet
+        """
+        if self._count == 0:
+            return self.update(value)
+
+        last_position = self._position - 1
+        if last_position < 0:
+            last_position = self.period - 1
+
+        self._sum += value - self._values[last_position]
+        self._values[last_position] = value
+
+        return self.value
+
+    def ready(self):
+        return self._count == self.period
+
+    @property
+    def value(self):
+        if not self.ready():
+            return None
+
+        return self._sum / self.period
+
+
+class SMACross(object):
+    """
+    Short / long moving average pair fed with bars, remembers the time of the last bar it has seen
+
+    Bars are (date, open, high, low, close, volume) tuples as returned by TradeClient.get_IB_historical_data.
+    Dates are compared as times (see bar_store.parse_bar_date), so bars formatted differently still line up
+    """
+
+    def __init__(self, short_period=20, long_period=50):
+        self.short_ma = MovingAverage(short_period)
+        self.long_ma = MovingAverage(long_period)
+
+        ## last bar in seconds, and its date string if it came as a tuple, so repeats of it needn't be parsed
+        self._last_time = None
+        self.last_date = None
+
+    def __repr__(self):
+        return "SMACross short %s long %s last bar %s" % (str(self.short_ma.value), str(self.long_ma.value),
+                                                         str(self._last_time))
+
+    def reset(self):
+        self.short_ma = MovingAverage(self.short_ma.period)
+        self.long_ma = MovingAverage(self.long_ma.period)
+        self._last_time = None
+        self.last_date = None
+
+    def _bar_time(self, bar_date):
+        if bar_date == self.last_date:
+            return self._last_time
+
+        return parse_bar_date(bar_date)
+
+    def add_bar(self, bar):
+        """
+        Feed one bar. A bar with the same date as the last one replaces it, older bars are ignored
+
+        :param bar: tuple (date, open, high, low, close, volume)
+        :return: nothing
+        """
+        bar_date = bar[BAR_DATE]
+        close = float(bar[BAR_CLOSE])
+        bar_time = self._bar_time(bar_date)
+
+        if self._last_time is not None:
+            if bar_time == self._last_time:
+                ## bar still forming, revise it in place
+                self.short_ma.replace_last(close)
+                self.long_ma.replace_last(close)
+                self.last_date = bar_date
+                return
+
+            if bar_time < self._last_time:
+                ## already seen this one
+                return
+
+        self.short_ma.update(close)
+        self.long_ma.update(close)
+        self._last_time = bar_time
+        self.last_date = bar_date
+
+    def add_bars(self, bars_list):
+        """
+        Feed only the bars we haven't seen yet from a date-sorted list of bars
+
+        :param bars_list: list of bar tuples, oldest first
+        :return: nothing
+        """
+        if self._last_time is None:
+            new_bars_start = 0
+        else:
+            ## walk back from the end until we reach the last bar we already have
+            new_bars_start = len(bars_list)
+            while new_bars_start > 0 and self._bar_time(bars_list[new_bars_start - 1][BAR_DATE]) >= self._last_time:
+                new_bars_start -= 1
+
+        for bar in bars_list[new_bars_start:]:
+            self.add_bar(bar)
+
+    def add_arrays(self, bar_times, closes):
+        """
+        Feed only the bars we haven't seen yet from time-sorted column arrays, eg a BarBuffer or BarStore view.
+        Nothing is copied, and however long the history only the last window of closes is read
+
+        :param bar_times: int array of seconds, see bar_store.parse_bar_date
+        :param closes: float array
+        :return: nothing
+        """
+        bar_count = len(bar_times)
+        if bar_count == 0:
+            return
+
+        new_bars_start = 0
+        last_time = self._last_time
+        if last_time is not None:
+            ## called as each bar arrives only the last row or two can be new, so look there before searching
+            if bar_times[bar_count - 1] <= last_time:
+                new_bars_start = bar_count - 1
+            elif bar_count > 1 and bar_times[bar_count - 2] <= last_time:
+                new_bars_start = bar_count - 2
+            else:
+                new_bars_start = int(np.searchsorted(bar_times, last_time, side="left"))
+
+            if bar_times[new_bars_start] == last_time:
+                ## bar still forming, revise it in place
+                close = float(closes[new_bars_start])
+                self.short_ma.replace_last(close)
+                self.long_ma.replace_last(close)
+                new_bars_start += 1
+            elif bar_times[new_bars_start] < last_time:
+                ## already seen
+                new_bars_start += 1
+
+        if new_bars_start == bar_count:
+            return
+
+        if bar_count - new_bars_start == 1:
+            close = float(closes[new_bars_start])
+            self.short_ma.update(close)
+            self.long_ma.update(close)
+        else:
+            new_closes = closes[new_bars_start:]
+            self.short_ma.update_many(new_closes)
+            self.long_ma.update_many(new_closes)
+
+        self._last_time = int(bar_times[bar_count - 1])
+        self.last_date = None
+
+    def ready(self):
+        return self.short_ma.ready() and self.long_ma.ready()
+
+    def signal(self):
+        """
+        :return: bool, True if the short average is above the long one; False until both windows are full
+        """
+        if not self.ready():
+            return False
+
+        return self.short_ma.value > self.long_ma.value
@@ -0,0 +1,323 @@
+import bisect
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+
+from ibapi.message import OUT
+from ibapi.server_versions import MIN_SERVER_VER_ORDER_CONTAINER
+
+## histogram bucket upper bounds, seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+## metric families
+REQUEST_LATENCY = "ibapi_request_latency_seconds"
+SIGNAL_LATENCY = "ibapi_signal_latency_seconds"
+FAMILY_HELP = {REQUEST_LATENCY: "Time from sending a request to its first (stage=first) and last (stage=last) "
+                                "callback",
+               SIGNAL_LATENCY: "Time from the bar callback to the trade signal, and on to placing the order"}
+
+## request types, and where to find the request id in the message; None if there can only be one at a time
+CONTRACT_DETAILS = "contract_details"
+HISTORICAL_DATA = "historical_data"
+POSITIONS = "positions"
+ACCOUNT = "account"
+ORDER_ID = "order_id"
+ORDER = "order"
+REQUEST_MESSAGES = {OUT.REQ_CONTRACT_DATA: (CONTRACT_DETAILS, 2), OUT.REQ_HISTORICAL_DATA: (HISTORICAL_DATA, 1),
+                    OUT.REQ_POSITIONS: (POSITIONS, None), OUT.REQ_ACCT_DATA: (ACCOUNT, None),
+                    OUT.REQ_IDS: (ORDER_ID, None), OUT.PLACE_ORDER: (ORDER, 1)}
+
+## marked on every bar callback of a stream, keyed by tickerid
+BAR_CALLBACK = "bar_callback"
+
+## stages of the callback to order path
+CALLBACK_TO_SIGNAL = "callback_to_signal"
+SIGNAL_TO_ORDER = "signal_to_order"
+CALLBACK_TO_ORDER = "callback_to_order"
+
+## requests which never get a last callback, eg after an error, are dropped oldest first beyond this
+MAX_IN_FLIGHT = 10000
+
+
+class LatencyHistogram(object):
+    """
+    Counts per bucket, like a Prometheus histogram, plus the largest value seen
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        ## one more than buckets, for +Inf
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return "LatencyHistogram count %d mean %f max %f" % (self.count, self.mean(), self.max)
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+
+        return self.sum / self.count
+
+    def cumulative_counts(self):
+        cumulative_count = 0
+        cumulative_counts = []
+        for bucket_count in self.bucket_counts:
+            cumulative_count += bucket_count
+            cumulative_counts.append(cumulative_count)
+
+        return cumulative_counts
+
+
+def _label_string(labels, extra_label=None):
+    label_pairs = list(labels)
+    if extra_label is not None:
+        label_pairs.append(extra_label)
+    if len(label_pairs) == 0:
+        return ""
+
+    return "{" + ",".join(['%s="%s"' % (label_name, str(label_value))
+                           for label_name, label_value in label_pairs]) + "}"
+
+
+class Metrics(object):
+    """
+    Latency histograms for the hot paths
+
+    Requests are timed from when TradeClient sends them (so time spent in the outbound queue counts) to their first
+    and last callback, per request type. StrategyRunner adds the time from the bar callback to the signal and the
+    order. Export with prometheus_text(), MetricsServer, or as_dict() / JsonMetricsDumper.
+    """
+
+    def __init__(self):
+        ## (family, labels) -> LatencyHistogram, labels a tuple of (name, value)
+        self._histograms = {}
+        ## (request type, request id) -> [time sent, time of first callback or None]
+        self._in_flight = {}
+        ## (name, key) -> time
+        self._marks = {}
+        ## family -> (label name, function returning dict of label value -> gauge value)
+        self._gauges = {}
+
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "Metrics with %d histograms, %d requests in flight" % (len(self._histograms), len(self._in_flight))
+
+    def observe(self, family, labels, seconds):
+        with self._lock:
+            histogram = self._histograms.get((family, labels), None)
+            if histogram is None:
+                histogram = self._histograms[(family, labels)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def observe_since(self, family, stage, start_time, now=None):
+        """
+        :param start_time: from time.perf_counter(); nothing is recorded if None
+        """
+        if start_time is None:
+            return
+
+        if now is None:
+            now = time.perf_counter()
+        self.observe(family, (("stage", stage),), now - start_time)
+
+    def get_histogram(self, family, labels):
+        return self._histograms.get((family, labels), None)
+
+    def message_sent(self, msg, server_version):
+        """
+        From TradeClient.sendMsg; starts timing the messages which are requests
+        """
+        fields = msg.split("\0", 3)
+        request_message = REQUEST_MESSAGES.get(int(fields[0]), None)
+        if request_message is None:
+            return
+
+        request_type, request_id_index = request_message
+        if request_id_index is None:
+            request_id = None
+        else:
+            if request_type == ORDER and server_version < MIN_SERVER_VER_ORDER_CONTAINER:
+                ## older servers have a version field first
+                request_id_index += 1
+            request_id = int(fields[request_id_index])
+
+        self.request_sent(request_type, request_id)
+
+    def request_sent(self, request_type, request_id=None):
+        in_flight = self._in_flight
+        if len(in_flight) >= MAX_IN_FLIGHT:
+            with self._lock:
+                in_flight.pop(next(iter(in_flight)), None)
+
+        in_flight[(request_type, request_id)] = [time.perf_counter(), None]
+
+    def request_response(self, request_type, request_id=None):
+        """
+        A callback for the request; only the first one after it was sent is timed
+        """
+        request_times = self._in_flight.get((request_type, request_id), None)
+        if request_times is None or request_times[1] is not None:
+            return
+
+        now = request_times[1] = time.perf_counter()
+        self.observe(REQUEST_LATENCY, (("request", request_type), ("stage", "first")), now - request_times[0])
+
+    def request_finished(self, request_type, request_id=None):
+        """
+        The last callback for the request, eg the End marker
+        """
+        self.request_response(request_type, request_id)
+
+        request_times = self._in_flight.pop((request_type, request_id), None)
+        if request_times is None:
+            return
+
+        self.observe(REQUEST_LATENCY, (("request", request_type), ("stage", "last")),
+                     time.perf_counter() - request_times[0])
+
+    def mark(self, name, key):
+        """
+        Remember when something happened, eg a bar callback, for observe_since later on another thread
+        """
+        self._marks[(name, key)] = time.perf_counter()
+
+    def marked_time(self, name, key):
+        return self._marks.get((name, key), None)
+
+    def add_gauges(self, family, label_name, gauge_function):
+        """
+        :param gauge_function: returns dict, label value -> gauge value; called on every export
+        """
+        self._gauges[family] = (label_name, gauge_function)
+
+    def prometheus_text(self):
+        """
+        :return: str, Prometheus text exposition format
+        """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+
+        lines = []
+        family_written = None
+        for (family, labels), histogram in histograms:
+            if family != family_written:
+                lines.append("# HELP %s %s" % (family, FAMILY_HELP.get(family, family)))
+                lines.append("# TYPE %s histogram" % family)
+                family_written = family
+
+            for bucket, cumulative_count in zip(histogram.buckets, histogram.cumulative_counts()):
+                lines.append("%s_bucket%s %d" % (family, _label_string(labels, ("le", repr(bucket))),
+                                                 cumulative_count))
+            lines.append("%s_bucket%s %d" % (family, _label_string(labels, ("le", "+Inf")), histogram.count))
+            lines.append("%s_sum%s %r" % (family, _label_string(labels), histogram.sum))
+            lines.append("%s_count%s %d" % (family, _label_string(labels), histogram.count))
+
+        for family, (label_name, gauge_function) in sorted(self._gauges.items()):
+            lines.append("# TYPE %s gauge" % family)
+            for label_value, gauge_value in sorted(gauge_function().items()):
+                lines.append("%s%s %r" % (family, _label_string(((label_name, label_value),)), gauge_value))
+
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        """
+        :return: dict, family -> list of dicts with labels, count, mean, max, sum and cumulative bucket counts;
+                 plus gauges, for json
+        """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+
+        metrics_dict = dict(time=time.time())
+        for (family, labels), histogram in histograms:
+            metrics_dict.setdefault(family, []).append(dict(labels=dict(labels), count=histogram.count,
+                                                            mean=histogram.mean(), max=histogram.max,
+                                                            sum=histogram.sum,
+                                                            buckets=dict(zip([repr(bucket) for bucket in
+                                                                              histogram.buckets] + ["+Inf"],
+                                                                             histogram.cumulative_counts()))))
+
+        for family, (label_name, gauge_function) in self._gauges.items():
+            metrics_dict[family] = gauge_function()
+
+        return metrics_dict
+
+    def write_json(self, filename):
+        with open(filename, "w") as metrics_file:
+            json.dump(self.as_dict(), metrics_file, indent=2)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        ## scraped every few seconds, not worth printing
+        pass
+
+
+class MetricsServer(object):
+    """
+    Serves Metrics.prometheus_text over http, on any path, for Prometheus to scrape
+    """
+
+    def __init__(self, metrics, port=8000, host="127.0.0.1"):
+        self._server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._server.metrics = metrics
+        self.port = self._server.server_address[1]
+
+    def __repr__(self):
+        return "MetricsServer on port %d" % self.port
+
+    def start(self):
+        thread = Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class JsonMetricsDumper(object):
+    """
+    Writes Metrics.as_dict to a json file every interval_seconds
+    """
+
+    def __init__(self, metrics, filename, interval_seconds=60):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval_seconds = interval_seconds
+        self._stopped = Event()
+
+    def __repr__(self):
+        return "JsonMetricsDumper to %s every %s seconds" % (self.filename, str(self.interval_seconds))
+
+    def start(self):
+        thread = Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        ## and once more, so the file has everything
+        self.metrics.write_json(self.filename)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_seconds):
+            self.metrics.write_json(self.filename)
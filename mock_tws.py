@@ -0,0 +1,469 @@
+## A stand-in for TWS / IB Gateway, speaking just enough of the wire protocol for TradeClient
+## Use it to run and benchmark the client offline: response delays, missing End markers and bar replay are scriptable
+
+import datetime
+import random
+import socket
+import struct
+import threading
+import time
+
+from ibapi import comm
+from ibapi.message import IN, OUT
+
+from backtest import load_csv
+from bar_store import format_bar_time
+
+## we answer as this server version whatever the client supports; it has keepUpToDate
+SERVER_VERSION = 124
+
+## End markers which can be left out, to reproduce clients waiting for something that never comes
+END_MARKERS = ("contractDetailsEnd", "historicalDataEnd", "positionEnd", "accountDownloadEnd")
+
+DEFAULT_ACCOUNT_VALUES = (("AccountType", "INDIVIDUAL", ""), ("CashBalance", "100000.00", "BASE"),
+                          ("NetLiquidation", "100000.00", "USD"), ("NetLiquidationByCurrency", "100000.00", "BASE"),
+                          ("TotalCashBalance", "100000.00", "BASE"), ("TotalCashValue", "100000.00", "USD"))
+
+BAR_SECONDS = 5 * 60
+
+
+def synthetic_bars(bar_count, seed=0):
+    """
+    Random walk five minute bars ending now
+
+    :return: dict of column arrays, like backtest.load_csv
+    """
+    random_generator = random.Random(seed)
+    time_now = int(time.time()) // BAR_SECONDS * BAR_SECONDS
+
+    closes = []
+    close = 0.88
+    for _ in range(bar_count):
+        close += random_generator.gauss(0.0, 0.0005)
+        closes.append(round(close, 5))
+
+    return dict(time=[time_now - BAR_SECONDS * (bar_count - bar_index - 1) for bar_index in range(bar_count)],
+                open=closes, high=closes, low=closes, close=closes, volume=[0] * bar_count)
+
+
+class MockTWS(object):
+    """
+    Listens on host:port and serves each client connection on its own thread
+
+    :param delays: dict, callback name (eg 'contractDetails', 'historicalData', 'position', 'nextValidId',
+                   'updateAccountValue', 'orderStatus') to seconds to wait before answering
+    :param drop_end_markers: names from END_MARKERS which are never sent
+    :param bar_files: dict, 'SYMBOL.CURRENCY' to csv filename (see backtest.load_csv) to replay bars from;
+                      other contracts get synthetic bars
+    :param stream_bars: with keepUpToDate, how many bars from the end are held back from the backfill and sent as
+                        historicalDataUpdate instead, one every update_interval seconds
+    :param positions: dict, 'SYMBOL.CURRENCY' to starting position
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, account="DU000000", next_valid_id=1, delays=None,
+                 drop_end_markers=(), bar_files=None, synthetic_bar_count=300, stream_bars=0, update_interval=1.0,
+                 positions=None, account_values=DEFAULT_ACCOUNT_VALUES):
+        self.host = host
+        self.port = port
+        self.account = account
+        self.next_valid_id = next_valid_id
+
+        self.delays = dict(delays or {})
+        self.drop_end_markers = set(drop_end_markers)
+        self.bar_files = dict(bar_files or {})
+        self.synthetic_bar_count = synthetic_bar_count
+        self.stream_bars = stream_bars
+        self.update_interval = update_interval
+
+        self.positions = dict(positions or {})
+        self.account_values = account_values
+
+        ## what we've been asked for, so tests and benchmarks can check
+        self.orders = {}
+        self.request_counts = {}
+
+        self._bars = {}
+        self._server_socket = None
+        self._threads = []
+        self._running = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "MockTWS on %s:%d" % (self.host, self.port)
+
+    def start(self):
+        """
+        Start listening. If port was 0 a free one is picked, see .port
+        :return: nothing
+        """
+        server_socket = self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(5)
+        self.port = server_socket.getsockname()[1]
+
+        self._running = True
+        thread = threading.Thread(target=self._accept_connections, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        self._running = False
+        if self._server_socket is not None:
+            self._server_socket.close()
+            self._server_socket = None
+
+    def _accept_connections(self):
+        while self._running:
+            try:
+                client_socket, address = self._server_socket.accept()
+            except OSError:
+                ## closed by stop()
+                return
+
+            connection = _MockConnection(self, client_socket)
+            thread = threading.Thread(target=connection.serve, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _count_request(self, request_name):
+        with self._lock:
+            self.request_counts[request_name] = self.request_counts.get(request_name, 0) + 1
+
+    def _get_bars(self, contract_name):
+        if contract_name not in self._bars:
+            if contract_name in self.bar_files:
+                bars = load_csv(self.bar_files[contract_name])
+            else:
+                bars = synthetic_bars(self.synthetic_bar_count, seed=_conId(contract_name) % 1000)
+
+            self._bars[contract_name] = [(format_bar_time(bar_time), float(bar_open), float(bar_high), float(bar_low),
+                                          float(bar_close), int(bar_volume))
+                                         for bar_time, bar_open, bar_high, bar_low, bar_close, bar_volume in
+                                         zip(bars["time"], bars["open"], bars["high"], bars["low"], bars["close"],
+                                             bars["volume"])]
+
+        return self._bars[contract_name]
+
+    def _allocate_orderid(self):
+        with self._lock:
+            orderid = self.next_valid_id
+            self.next_valid_id += 1
+
+            return orderid
+
+
+def _contract_name(symbol, currency):
+    return "%s.%s" % (symbol, currency)
+
+
+def _conId(contract_name):
+    # stable across runs, unlike hash()
+    return sum([ord(character) * (index + 1) for index, character in enumerate(contract_name)]) + 10000000
+
+
+class _MockConnection(object):
+    """
+    One client connection: decodes requests and sends back messages in the format SERVER_VERSION clients expect
+    """
+
+    def __init__(self, server, client_socket):
+        self.server = server
+        self._socket = client_socket
+        self._send_lock = threading.Lock()
+        self._positions_subscribed = False
+        self._account_subscribed = None
+        self._streaming = {}
+        self._held_orders = []
+
+    def serve(self):
+        buffer = b""
+        try:
+            buffer = self._handshake(buffer)
+            while self.server._running:
+                data = self._socket.recv(65536)
+                if len(data) == 0:
+                    break
+                buffer += data
+
+                while True:
+                    (size, msg, buffer) = comm.read_msg(buffer)
+                    if msg == "":
+                        break
+                    self._handle(comm.read_fields(msg))
+        except OSError:
+            pass
+        finally:
+            for replay_state in self._streaming.values():
+                replay_state["running"] = False
+            self._socket.close()
+
+    def _handshake(self, buffer):
+        while len(buffer) < 8 or len(buffer) < 8 + struct.unpack("!I", buffer[4:8])[0]:
+            data = self._socket.recv(65536)
+            if len(data) == 0:
+                raise OSError("client went away during handshake")
+            buffer += data
+
+        ## b"API\0" then the supported version range, which we ignore
+        (size, msg, buffer) = comm.read_msg(buffer[4:])
+
+        connection_time = datetime.datetime.now().strftime("%Y%m%d %H:%M:%S") + " EST"
+        self._send(SERVER_VERSION, connection_time)
+
+        return buffer
+
+    def _send(self, *fields):
+        msg = comm.make_msg("".join([comm.make_field(field) for field in fields]))
+        with self._send_lock:
+            self._socket.sendall(msg)
+
+    def _send_later(self, callback_name, send_function):
+        delay = self.server.delays.get(callback_name, 0)
+        if delay > 0:
+            threading.Timer(delay, self._send_safely, args=(send_function,)).start()
+        else:
+            send_function()
+
+    def _send_safely(self, send_function):
+        try:
+            send_function()
+        except OSError:
+            ## client disconnected while we were waiting
+            pass
+
+    def _end_marker_wanted(self, marker_name):
+        return marker_name not in self.server.drop_end_markers
+
+    def _handle(self, fields):
+        msg_id = int(fields[0])
+        fields = [field.decode() for field in fields]
+
+        handlers = {OUT.START_API: self._start_api,
+                    OUT.REQ_IDS: self._req_ids,
+                    OUT.REQ_POSITIONS: self._req_positions,
+                    OUT.CANCEL_POSITIONS: self._cancel_positions,
+                    OUT.REQ_ACCT_DATA: self._req_account_updates,
+                    OUT.REQ_CONTRACT_DATA: self._req_contract_details,
+                    OUT.REQ_HISTORICAL_DATA: self._req_historical_data,
+                    OUT.CANCEL_HISTORICAL_DATA: self._cancel_historical_data,
+                    OUT.PLACE_ORDER: self._place_order}
+
+        handler = handlers.get(msg_id, None)
+        if handler is None:
+            ## not something we pretend to support
+            return
+
+        self.server._count_request(handler.__name__[1:])
+        handler(fields)
+
+    def _start_api(self, fields):
+        self._send_next_valid_id()
+        self._send(IN.MANAGED_ACCTS, 1, self.server.account)
+
+    def _send_next_valid_id(self):
+        orderid = self.server.next_valid_id
+        self._send_later("nextValidId", lambda: self._send(IN.NEXT_VALID_ID, 1, orderid))
+
+    def _req_ids(self, fields):
+        self._send_next_valid_id()
+
+    def _position_messages(self):
+        return [(IN.POSITION_DATA, 3, self.server.account, _conId(contract_name), contract_name.split(".")[0], "CASH",
+                 "", 0.0, "", "", "IDEALPRO", contract_name.split(".")[1], contract_name, contract_name,
+                 float(position), 0.0)
+                for contract_name, position in self.server.positions.items()]
+
+    def _req_positions(self, fields):
+        self._positions_subscribed = True
+
+        def send_positions():
+            for position_message in self._position_messages():
+                self._send(*position_message)
+            if self._end_marker_wanted("positionEnd"):
+                self._send(IN.POSITION_END, 1)
+
+        self._send_later("position", send_positions)
+
+    def _cancel_positions(self, fields):
+        self._positions_subscribed = False
+
+    def _req_account_updates(self, fields):
+        subscribe = fields[2] == "1"
+        if not subscribe:
+            self._account_subscribed = None
+            return
+
+        server = self.server
+        account = self._account_subscribed = fields[3] or server.account
+
+        def send_account():
+            for key, value, currency in server.account_values:
+                self._send(IN.ACCT_VALUE, 2, key, value, currency, account)
+
+            for contract_name in server.positions.keys():
+                self._send_portfolio_value(contract_name, account)
+
+            self._send(IN.ACCT_UPDATE_TIME, 1, datetime.datetime.now().strftime("%H:%M"))
+            if self._end_marker_wanted("accountDownloadEnd"):
+                self._send(IN.ACCT_DOWNLOAD_END, 1, account)
+
+        self._send_later("updateAccountValue", send_account)
+
+    def _send_portfolio_value(self, contract_name, account):
+        symbol, currency = contract_name.split(".")
+        self._send(IN.PORTFOLIO_VALUE, 8, _conId(contract_name), symbol, "CASH", "", 0.0, "", "", "", currency,
+                   contract_name, contract_name, float(self.server.positions[contract_name]), 0.0, 0.0, 0.0, 0.0, 0.0,
+                   account)
+
+    def _req_contract_details(self, fields):
+        ## msgId, version, reqId, conId, symbol, secType, lastTradeDate, strike, right, multiplier, exchange,
+        ## primaryExchange, currency, localSymbol, ...
+        reqId = int(fields[2])
+        symbol, secType, exchange, currency = fields[4], fields[5], fields[10], fields[12]
+        contract_name = _contract_name(symbol, currency)
+
+        if symbol == "":
+            self._send(IN.ERR_MSG, 2, reqId, 200, "No security definition has been found for the request")
+            return
+
+        def send_contract_details():
+            self._send(IN.CONTRACT_DATA, 8, reqId, symbol, secType or "CASH", "", 0.0, "", exchange or "IDEALPRO",
+                       currency, contract_name, contract_name, contract_name, _conId(contract_name), 0.00005, 1, "",
+                       "LMT,MKT,STP", "IDEALPRO", 1, 0, "European Monetary Union euro", "", "", "", "", "", "EST",
+                       "", "", "", 0, 0, 1, "", "")
+            if self._end_marker_wanted("contractDetailsEnd"):
+                self._send(IN.CONTRACT_DATA_END, 1, reqId)
+
+        self._send_later("contractDetails", send_contract_details)
+
+    def _req_historical_data(self, fields):
+        ## msgId, reqId, conId, symbol, secType, lastTradeDate, strike, right, multiplier, exchange, primaryExchange,
+        ## currency, localSymbol, tradingClass, includeExpired, endDateTime, barSizeSetting, durationStr, useRTH,
+        ## whatToShow, formatDate, keepUpToDate, chartOptions
+        reqId = int(fields[1])
+        contract_name = _contract_name(fields[3], fields[11])
+        keepUpToDate = fields[21] == "1"
+
+        bars = self.server._get_bars(contract_name)
+        if keepUpToDate and self.server.stream_bars > 0:
+            backfill_bars = bars[:-self.server.stream_bars]
+            update_bars = bars[-self.server.stream_bars:]
+        else:
+            backfill_bars = bars
+            update_bars = []
+
+        def send_historical_data():
+            bar_fields = []
+            for bar_date, bar_open, bar_high, bar_low, bar_close, bar_volume in backfill_bars:
+                bar_fields += [bar_date, bar_open, bar_high, bar_low, bar_close, bar_volume, bar_close, 1]
+
+            if self._end_marker_wanted("historicalDataEnd"):
+                self._send(IN.HISTORICAL_DATA, reqId, backfill_bars[0][0], backfill_bars[-1][0], len(backfill_bars),
+                           *bar_fields)
+            else:
+                ## IB sends the bars and the end marker as one message; without it we can only send nothing
+                return
+
+            if keepUpToDate:
+                self._start_replay(reqId, update_bars)
+
+        self._send_later("historicalData", send_historical_data)
+
+    def _start_replay(self, reqId, update_bars):
+        replay_state = self._streaming[reqId] = dict(running=True)
+
+        def replay():
+            for bar_date, bar_open, bar_high, bar_low, bar_close, bar_volume in update_bars:
+                time.sleep(self.server.update_interval)
+                if not replay_state["running"]:
+                    return
+                self._send_safely(lambda: self._send(IN.HISTORICAL_DATA_UPDATE, reqId, 1, bar_date, bar_open,
+                                                     bar_close, bar_high, bar_low, bar_close, bar_volume))
+
+        threading.Thread(target=replay, daemon=True).start()
+
+    def _cancel_historical_data(self, fields):
+        replay_state = self._streaming.pop(int(fields[2]), None)
+        if replay_state is not None:
+            replay_state["running"] = False
+
+    def _place_order(self, fields):
+        ## msgId, version, orderId, conId, symbol, secType, lastTradeDate, strike, right, multiplier, exchange,
+        ## primaryExchange, currency, localSymbol, tradingClass, secIdType, secId, action, totalQuantity, orderType,
+        ## lmtPrice, auxPrice, tif, ocaGroup, account, openClose, origin, orderRef, transmit, parentId, ...
+        order = dict(orderId=int(fields[2]), contract_name=_contract_name(fields[4], fields[12]), action=fields[17],
+                     totalQuantity=float(fields[18]), orderType=fields[19], ocaGroup=fields[23],
+                     transmit=fields[28] == "1", parentId=int(fields[29] or 0))
+        self.server.orders[order["orderId"]] = order
+
+        if not order["transmit"]:
+            ## held until an order in the same batch is transmitted
+            self._held_orders.append(order)
+            self._send_later("orderStatus", lambda: self._send_order_status(order, "PreSubmitted", 0.0, 0.0))
+            return
+
+        orders_to_send = self._held_orders + [order]
+        self._held_orders = []
+
+        self._send_later("orderStatus", lambda: self._work_orders(orders_to_send))
+
+    def _work_orders(self, orders):
+        for order in orders:
+            self._send_order_status(order, "Submitted", 0.0, 0.0)
+
+        for order in orders:
+            if order["orderType"] == "MKT":
+                self._fill_order(order)
+
+    def _fill_order(self, order):
+        server = self.server
+        contract_name = order["contract_name"]
+        quantity = order["totalQuantity"]
+        fill_price = server._get_bars(contract_name)[-1][4]
+
+        if order["action"] == "BUY":
+            signed_quantity = quantity
+            side = "BOT"
+        else:
+            signed_quantity = -quantity
+            side = "SLD"
+
+        server.positions[contract_name] = server.positions.get(contract_name, 0.0) + signed_quantity
+
+        symbol, currency = contract_name.split(".")
+        execution_time = datetime.datetime.now().strftime("%Y%m%d  %H:%M:%S")
+        self._send(IN.EXECUTION_DATA, 10, -1, order["orderId"], _conId(contract_name), symbol, "CASH", "", 0.0, "", "",
+                   "IDEALPRO", currency, contract_name, contract_name, "%08d.01" % order["orderId"], execution_time,
+                   server.account, "IDEALPRO", side, quantity, fill_price, order["orderId"], 0, 0, quantity,
+                   fill_price, "", "", 0.0, "")
+        self._send_order_status(order, "Filled", quantity, fill_price)
+
+        if self._positions_subscribed:
+            for position_message in self._position_messages():
+                if position_message[12] == contract_name:
+                    self._send(*position_message)
+
+        if self._account_subscribed is not None:
+            ## streamed as a change to the account, like IB does
+            self._send_portfolio_value(contract_name, self._account_subscribed)
+
+    def _send_order_status(self, order, status, filled, fill_price):
+        remaining = order["totalQuantity"] - filled
+        self._send(IN.ORDER_STATUS, 6, order["orderId"], status, filled, remaining, fill_price, order["orderId"],
+                   order["parentId"], fill_price, 0, "")
+
+
+if __name__ == '__main__':
+    import sys
+
+    ## eg python mock_tws.py 7497 EUR.GBP=bars.csv
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 7497
+    bar_files = dict([argument.split("=") for argument in sys.argv[2:]])
+
+    server = MockTWS(port=port, bar_files=bar_files, stream_bars=10, update_interval=5.0)
+    server.start()
+    print("Mock TWS listening on port %d" % server.port)
+
+    while True:
+        time.sleep(60)
@@ -0,0 +1,123 @@
+## Parameter sweep for the SMA crossover strategy over all CPU cores
+## Bars are put in shared memory once; workers read them without anything being pickled per task
+
+import itertools
+import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from backtest import get_closes, run_backtest
+
+## set in each worker by _init_worker
+_worker_memory = None
+_worker_closes = None
+
+
+def parameter_grid(short_periods, long_periods, pos_volumes=(5000,)):
+    """
+    Every (short, long, pos_volume) combination where short < long
+
+    :return: list of tuples
+    """
+    return [(short_period, long_period, pos_volume)
+            for short_period, long_period, pos_volume in itertools.product(short_periods, long_periods, pos_volumes)
+            if short_period < long_period]
+
+
+def random_parameters(count, short_range=(5, 50), long_range=(20, 200), pos_volumes=(5000,), seed=None):
+    """
+    count random (short, long, pos_volume) combinations where short < long, without repeats
+
+    :param short_range: tuple, lowest and highest short period
+    :param long_range: tuple, lowest and highest long period
+    :return: list of tuples
+    """
+    all_parameters = parameter_grid(range(short_range[0], short_range[1] + 1),
+                                    range(long_range[0], long_range[1] + 1), pos_volumes)
+
+    return random.Random(seed).sample(all_parameters, min(count, len(all_parameters)))
+
+
+def _init_worker(memory_name, series_offsets):
+    global _worker_memory, _worker_closes
+
+    ## keep a reference to the shared memory, the arrays are views onto it
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    all_closes = np.ndarray((series_offsets[-1],), dtype=np.float64, buffer=_worker_memory.buf)
+
+    _worker_closes = [all_closes[start:end] for start, end in zip(series_offsets[:-1], series_offsets[1:])]
+
+
+def _evaluate(parameters, commission_per_unit):
+    """
+    Backtest one parameter set on every series
+    :return: list of summary dicts, one per series
+    """
+    short_period, long_period, pos_volume = parameters
+
+    return [run_backtest(dict(close=closes), short_period=short_period, long_period=long_period,
+                         pos_volume=pos_volume, commission_per_unit=commission_per_unit).summary()
+            for closes in _worker_closes]
+
+
+def optimize(bars_list, parameters, series_names=None, commission_per_unit=0.0, sort_by="total_pnl",
+             max_workers=None):
+    """
+    Evaluate every parameter set on every series of bars and rank them
+
+    :param bars_list: list of bars, one per pair; each a column dict or 2-D OHLCV array, see backtest.get_closes
+    :param parameters: list of (short, long, pos_volume) tuples, eg from parameter_grid or random_parameters
+    :param series_names: list of str, used in the per series table
+    :param sort_by: column to rank on, highest first
+    :param max_workers: processes to use, defaults to one per CPU
+    :return: tuple: DataFrame ranking parameter sets summed over all series, DataFrame with a row per series
+    """
+    if series_names is None:
+        series_names = [str(series_index) for series_index in range(len(bars_list))]
+
+    all_closes = [get_closes(bars) for bars in bars_list]
+    series_offsets = [0] + list(np.cumsum([len(closes) for closes in all_closes]))
+
+    memory = shared_memory.SharedMemory(create=True, size=max(series_offsets[-1], 1) * 8)
+    try:
+        shared_closes = np.ndarray((series_offsets[-1],), dtype=np.float64, buffer=memory.buf)
+        for closes, start in zip(all_closes, series_offsets[:-1]):
+            shared_closes[start:start + len(closes)] = closes
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(memory.name, series_offsets)) as executor:
+            all_summaries = list(executor.map(_evaluate, parameters, itertools.repeat(commission_per_unit),
+                                              chunksize=max(len(parameters) // 64, 1)))
+
+        del shared_closes
+    finally:
+        memory.close()
+        memory.unlink()
+
+    series_results = pd.DataFrame([dict(series=series_name, short_period=short_period, long_period=long_period,
+                                        pos_volume=pos_volume, **summary)
+                                   for (short_period, long_period, pos_volume), summaries in
+                                   zip(parameters, all_summaries)
+                                   for series_name, summary in zip(series_names, summaries)])
+
+    ranked_results = series_results.groupby(["short_period", "long_period", "pos_volume"]).agg(
+        total_pnl=("total_pnl", "sum"), orders=("orders", "sum"), traded_volume=("traded_volume", "sum"),
+        max_drawdown=("max_drawdown", "max"), sharpe=("sharpe", "mean")).reset_index()
+    ranked_results = ranked_results.sort_values(sort_by, ascending=False).reset_index(drop=True)
+
+    return ranked_results, series_results
+
+
+if __name__ == '__main__':
+    import sys
+
+    from backtest import load_csv
+
+    csv_filenames = sys.argv[1:]
+    ranked_results, series_results = optimize([load_csv(filename) for filename in csv_filenames],
+                                               parameter_grid(range(5, 55, 5), range(20, 210, 10)),
+                                               series_names=csv_filenames)
+    print(ranked_results.head(20))
@@ -0,0 +1,286 @@
+import time
+from threading import Event, Lock
+
+## order states, as IB reports them in orderStatus; CREATED is ours, for orders IB hasn't told us about yet
+CREATED = "Created"
+FILLED = "Filled"
+CANCELLED = "Cancelled"
+API_CANCELLED = "ApiCancelled"
+INACTIVE = "Inactive"
+DONE_STATES = (FILLED, CANCELLED, API_CANCELLED, INACTIVE)
+
+## error codes for an orderId which end the order; so does any other error before IB has acknowledged the order,
+## eg 110 price off the tick grid, 200 no security definition, 103 duplicate id, 321 invalid order
+ORDER_REJECTED_CODE = 201
+ORDER_CANCELLED_CODE = 202
+
+
+def default_order_key(ibcontract):
+    # one working order per contract, which is all the strategy ever needs
+    if ibcontract.conId:
+        return ibcontract.conId
+
+    return (ibcontract.symbol, ibcontract.currency, ibcontract.secType)
+
+
+class ManagedOrder(object):
+    """
+    An order we placed, and what IB has told us about it since
+    """
+
+    def __init__(self, orderId, ibcontract, order, key):
+        self.orderId = orderId
+        self.ibcontract = ibcontract
+        self.order = order
+        self.key = key
+
+        self.status = CREATED
+        self.filled = 0.0
+        self.remaining = float(order.totalQuantity)
+        self.avgFillPrice = 0.0
+        self.permId = 0
+        self.executions = []
+
+        self.time_placed = time.time()
+        self.time_updated = self.time_placed
+        ## set once the order is filled, cancelled or rejected
+        self.finished = Event()
+
+    def __repr__(self):
+        return "Order %d %s %s %s: %s, filled %s of %s" % (self.orderId, self.order.action,
+                                                           str(self.order.totalQuantity), str(self.key), self.status,
+                                                           str(self.filled), str(self.filled + self.remaining))
+
+    def is_done(self):
+        return self.status in DONE_STATES
+
+
+class OrderManager(object):
+    """
+    Places orders and follows them through orderStatus, openOrder and execDetails
+
+    IB gives us the next valid order id when we connect (nextValidId); after that ids are allocated here, so
+    placing an order doesn't wait for IB. Each order has a key, by default its contract, and an order isn't placed
+    while another with the same key is still working, so a signal seen twice doesn't trade twice. Orders placed
+    together with place_orders, eg a bracket, can share a key; it's free again once they're all done.
+    """
+
+    def __init__(self, app, publish_function=None):
+        """
+        :param app: TradeApp, or anything with placeOrder, cancelOrder and reqIds
+        :param publish_function: called with each ManagedOrder when it changes, eg to publish an event
+        """
+        self.app = app
+        self._publish_function = publish_function
+
+        self._next_orderid = None
+        self._have_orderid = Event()
+
+        ## orderId -> ManagedOrder
+        self._orders = {}
+        ## key -> set of orderIds still working
+        self._working = {}
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "OrderManager with %d orders, %d working, next id %s" % (len(self._orders), len(self._working),
+                                                                        str(self._next_orderid))
+
+    def update_next_valid_id(self, orderId):
+        # called for every nextValidId; ids we've already handed out stay used
+        with self._lock:
+            if self._next_orderid is None or orderId > self._next_orderid:
+                self._next_orderid = orderId
+
+        self._have_orderid.set()
+
+    def next_orderid(self, timeout=10):
+        """
+        :return: int, or None if IB hasn't sent nextValidId within timeout
+        """
+        orderids = self.next_orderids(1, timeout=timeout)
+        if orderids is None:
+            return None
+
+        return orderids[0]
+
+    def next_orderids(self, count, timeout=10):
+        """
+        :return: list of count consecutive ids, or None if IB hasn't sent nextValidId within timeout
+        """
+        if not self._have_orderid.is_set():
+            ## normally sent as we connect, ask in case it hasn't been
+            self.app.reqIds(-1)
+            if not self._have_orderid.wait(timeout):
+                return None
+
+        with self._lock:
+            orderid = self._next_orderid
+            self._next_orderid = orderid + count
+
+        return list(range(orderid, orderid + count))
+
+    def place_order(self, ibcontract, order, key=None, orderid=None):
+        """
+        :param key: what the order is for; default_order_key(ibcontract) if None
+        :param orderid: id to use, allocated if None
+        :return: int orderId; None if an order with this key is still working, or we've no order id
+        """
+        if orderid is None:
+            orderids = None
+        else:
+            orderids = [orderid]
+
+        return self.place_orders([(ibcontract, order)], key=key, orderids=orderids)[0]
+
+    def place_orders(self, contract_orders, key=None, orderids=None):
+        """
+        Place several orders back to back, with nothing waiting in between
+
+        :param contract_orders: list of (ibcontract, order), in the order they're to be placed
+        :param key: shared by all the orders if given, otherwise each has default_order_key(ibcontract)
+        :param orderids: ids to use, allocated if None
+        :return: list of orderIds, None for orders not placed as one with their key is still working
+        """
+        if orderids is None:
+            orderids = self.next_orderids(len(contract_orders))
+            if orderids is None:
+                print("Couldn't get an order id from IB")
+                return [None] * len(contract_orders)
+
+        if key is None:
+            keys = [default_order_key(ibcontract) for ibcontract, order in contract_orders]
+        else:
+            keys = [key] * len(contract_orders)
+
+        placed_orders = []
+        with self._lock:
+            ## keys already working before this batch; orders in the batch can share a key
+            working_keys = set([order_key for order_key in keys if order_key in self._working])
+            for orderid, order_key, (ibcontract, order) in zip(orderids, keys, contract_orders):
+                if order_key in working_keys:
+                    print("Orders %s for %s are still working, not placing another" % (
+                        str(sorted(self._working[order_key])), str(order_key)))
+                    placed_orders.append(None)
+                    continue
+
+                self._orders[orderid] = ManagedOrder(orderid, ibcontract, order, order_key)
+                self._working.setdefault(order_key, set()).add(orderid)
+                placed_orders.append((orderid, ibcontract, order))
+
+        for placed_order in placed_orders:
+            if placed_order is not None:
+                self.app.placeOrder(*placed_order)
+
+        return [placed_order if placed_order is None else placed_order[0] for placed_order in placed_orders]
+
+    def cancel_order(self, orderId):
+        self.app.cancelOrder(orderId)
+
+    def get_order(self, orderId):
+        """
+        :return: ManagedOrder, or None if we didn't place it
+        """
+        return self._orders.get(orderId, None)
+
+    def working_orders(self):
+        with self._lock:
+            return [self._orders[orderid] for orderids in self._working.values() for orderid in orderids]
+
+    def is_working(self, key):
+        return key in self._working
+
+    def wait_for_order(self, orderId, timeout=None):
+        """
+        :return: ManagedOrder once it's filled, cancelled or rejected; None if we didn't place it or timed out
+        """
+        managed_order = self.get_order(orderId)
+        if managed_order is None or not managed_order.finished.wait(timeout):
+            return None
+
+        return managed_order
+
+    def _update(self, managed_order, status=None):
+        # call with the lock held; returns the order so it can be published once the lock is released
+        if status is not None:
+            managed_order.status = status
+        managed_order.time_updated = time.time()
+
+        if managed_order.is_done():
+            working_orderids = self._working.get(managed_order.key, None)
+            if working_orderids is not None:
+                working_orderids.discard(managed_order.orderId)
+                if len(working_orderids) == 0:
+                    del self._working[managed_order.key]
+            managed_order.finished.set()
+
+        return managed_order
+
+    def _publish(self, managed_order):
+        if self._publish_function is not None and managed_order is not None:
+            self._publish_function(managed_order)
+
+    def order_status(self, orderId, status, filled, remaining, avgFillPrice, permId):
+        """
+        From the orderStatus callback
+        """
+        with self._lock:
+            managed_order = self._orders.get(orderId, None)
+            if managed_order is None:
+                return
+
+            managed_order.filled = float(filled)
+            managed_order.remaining = float(remaining)
+            managed_order.avgFillPrice = avgFillPrice
+            managed_order.permId = permId
+            self._update(managed_order, status)
+
+        self._publish(managed_order)
+
+    def open_order(self, orderId, ibcontract, order, orderState):
+        """
+        From the openOrder callback; we get these for orders placed before we connected too, which we don't track
+        """
+        with self._lock:
+            managed_order = self._orders.get(orderId, None)
+            if managed_order is None:
+                return
+
+            managed_order.ibcontract = ibcontract
+            self._update(managed_order, orderState.status or None)
+
+        self._publish(managed_order)
+
+    def execution(self, ibcontract, execution):
+        """
+        From the execDetails callback
+        """
+        with self._lock:
+            managed_order = self._orders.get(execution.orderId, None)
+            if managed_order is None:
+                return
+
+            managed_order.executions.append(execution)
+            self._update(managed_order)
+
+        self._publish(managed_order)
+
+    def order_error(self, orderId, errorCode):
+        """
+        From the error callback, for errors rather than warnings
+        :return: bool, True if the error was about one of our orders
+        """
+        with self._lock:
+            managed_order = self._orders.get(orderId, None)
+            if managed_order is None:
+                return False
+
+            if errorCode == ORDER_CANCELLED_CODE:
+                self._update(managed_order, CANCELLED)
+            elif errorCode == ORDER_REJECTED_CODE or managed_order.status == CREATED:
+                ## IB never took the order, so nothing more will come for it and its key must be freed
+                self._update(managed_order, INACTIVE)
+
+        self._publish(managed_order)
+
+        return True
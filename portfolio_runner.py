@@ -0,0 +1,136 @@
+import asyncio
+import json
+import sys
+
+from async_client import AsyncTradeClient
+from bar_store import BarStore
+from events import EventDispatcher
+from metrics import JsonMetricsDumper, MetricsServer
+from strategy_runner import StrategyRunner
+from trade_logic import TradeLogic
+
+
+def load_portfolio_config(config_filename):
+    """
+    Config is json: durationStr and barSizeSetting for the bar streams, optionally bar_store_directory to keep bars
+    in, metrics_port to serve latency metrics to Prometheus on and metrics_filename to dump them to as json every
+    metrics_interval seconds, and a list of contracts, each with symbol and currency, and optionally pos_volume,
+    short_period and long_period. See portfolio.json
+
+    :param config_filename: str
+    :return: dict
+    """
+    with open(config_filename) as config_file:
+        config = json.load(config_file)
+
+    return config
+
+
+class PortfolioRunner(object):
+    """
+    Trades many contracts from one connection, one StrategyRunner each, sharing a dispatcher and the order manager
+
+    Contracts are resolved and bar streams backfilled concurrently, so start up time doesn't grow linearly
+    with the number of contracts; after that everything is driven by events.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.durationStr = config.get("durationStr", "1 D")
+        self.barSizeSetting = config.get("barSizeSetting", "5 mins")
+
+        bar_store_directory = config.get("bar_store_directory", None)
+        if bar_store_directory is None:
+            self.bar_store = None
+        else:
+            self.bar_store = BarStore(bar_store_directory)
+
+        self.dispatcher = EventDispatcher()
+
+        self.runners = [self._create_runner(contract_config) for contract_config in config["contracts"]]
+
+    def __repr__(self):
+        return "PortfolioRunner with %d contracts" % len(self.runners)
+
+    def _create_runner(self, contract_config):
+        tr = TradeLogic(short_period=contract_config.get("short_period", 20),
+                        long_period=contract_config.get("long_period", 50))
+        tr.pos_volume = contract_config.get("pos_volume", tr.pos_volume)
+
+        ibcontract = tr.create_contract(contract_config["symbol"], contract_config["currency"])
+
+        return StrategyRunner(self.app, tr, ibcontract, dispatcher=self.dispatcher, bar_store=self.bar_store)
+
+    def start(self):
+        """
+        Open the subscriptions for every contract
+        :return: nothing
+        """
+        app = self.app
+        app.set_event_dispatcher(self.dispatcher)
+
+        # одна подписка на позиции на все контракты; order ids come from the app's order manager
+        app.subscribe_positions()
+
+        asyncio.run(self._start_streams())
+
+    async def _start_streams(self):
+        client = AsyncTradeClient(self.app)
+        runners = self.runners
+
+        resolved_contracts = await asyncio.gather(*[client.resolve_contract(runner.ibcontract)
+                                                    for runner in runners])
+        durations = []
+        for runner, resolved_ibcontract in zip(runners, resolved_contracts):
+            runner.resolved_ibcontract = resolved_ibcontract
+            durations.append(runner.warm_start(self.durationStr, self.barSizeSetting))
+
+        await asyncio.gather(*[client.subscribe_historical_data(runner.resolved_ibcontract,
+                                                                durationStr=durationStr,
+                                                                barSizeSetting=self.barSizeSetting,
+                                                                tickerid=runner.tickerid)
+                               for runner, durationStr in zip(runners, durations)])
+
+    def run(self):
+        self.dispatcher.run()
+
+    def stop(self):
+        for runner in self.runners:
+            runner.stop()
+
+
+if __name__ == '__main__':
+    from sma_cross_ibapi import TradeApp
+
+    if len(sys.argv) > 1:
+        config_filename = sys.argv[1]
+    else:
+        config_filename = "portfolio.json"
+
+    config = load_portfolio_config(config_filename)
+    app = TradeApp("127.0.0.1", 7497, 0, contract_cache_filename="contract_cache.json")
+    portfolio = PortfolioRunner(app, config)
+
+    metrics_exporters = []
+    if "metrics_port" in config:
+        metrics_exporters.append(MetricsServer(app.get_metrics(), port=config["metrics_port"]))
+    if "metrics_filename" in config:
+        metrics_exporters.append(JsonMetricsDumper(app.get_metrics(), config["metrics_filename"],
+                                                   interval_seconds=config.get("metrics_interval", 60)))
+
+    try:
+        for metrics_exporter in metrics_exporters:
+            metrics_exporter.start()
+
+        portfolio.start()
+        portfolio.run()
+
+    finally:
+        portfolio.stop()
+        app.disconnect()
+
+        for metrics_exporter in metrics_exporters:
+            metrics_exporter.stop()
+
+        for runner in portfolio.runners:
+            print(runner, runner.position())
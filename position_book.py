@@ -0,0 +1,187 @@
+from threading import Lock
+
+## execution sides, as IB reports them
+BOUGHT = "BOT"
+SOLD = "SLD"
+
+
+class PositionBook(object):
+    """
+    Positions on the connection, keyed by conId with a localSymbol index, kept up to date from callbacks rather
+    than asked for every time we need them
+
+    The reqPositions subscription (position) is the authority. In between, fills move the position as soon as we
+    hear about them, from execDetails or orderStatus, whichever comes first: for orders registered with
+    register_order we track the cumulative filled quantity, so a fill is only counted once. Executions of orders
+    we didn't register (placed in TWS, before a restart, ...) are applied once per execId, but only until position
+    callbacks start arriving: after that IB sends a new position for them anyway, and may already have.
+
+    IB doesn't promise position comes after the orderStatus / execDetails for the same fill. A change in position
+    we can't account for is taken to be fills of our unfilled orders on that contract, in the same direction, and
+    marked as applied, so they aren't counted again when their orderStatus / execDetails do arrive.
+    """
+
+    def __init__(self):
+        ## conId -> [account, localSymbol, position, avgCost]
+        self._positions = {}
+        ## localSymbol -> conId
+        self._symbol_index = {}
+
+        ## orderId -> [conId, localSymbol, 1 or -1, filled quantity applied so far, order quantity]
+        self._orders = {}
+        ## conId -> orderIds not yet fully applied, oldest first
+        self._unfilled_orders = {}
+        self._seen_execIds = set()
+        ## set by the first position callback; from then on positions come from the subscription
+        self._positions_streaming = False
+
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "PositionBook " + str(self.as_dict())
+
+    def _entry(self, contract, account=""):
+        # call with the lock held
+        conId = contract.conId
+        position_entry = self._positions.get(conId, None)
+        if position_entry is None:
+            position_entry = self._positions[conId] = [account, contract.localSymbol, 0.0, 0.0]
+            self._symbol_index[contract.localSymbol] = conId
+
+        return position_entry
+
+    def update_position(self, account, contract, position, avgCost):
+        """
+        From the position callback: replaces whatever we had
+        """
+        with self._lock:
+            position_entry = self._entry(contract, account)
+            self._mark_included_fills(contract.conId, float(position) - position_entry[2])
+            self._positions_streaming = True
+            position_entry[0] = account
+            position_entry[2] = float(position)
+            position_entry[3] = avgCost
+
+    def register_order(self, orderId, contract, action, quantity):
+        """
+        So orderStatus, which doesn't say which contract or which way, can move the position
+
+        :param contract: resolved contract
+        :param action: 'BUY' or 'SELL'
+        :param quantity: order totalQuantity
+        :return: nothing
+        """
+        if action == "BUY":
+            direction = 1
+        else:
+            direction = -1
+
+        with self._lock:
+            self._entry(contract)
+            self._orders[orderId] = [contract.conId, contract.localSymbol, direction, 0.0, float(quantity)]
+            self._unfilled_orders.setdefault(contract.conId, []).append(orderId)
+
+    def _set_filled_applied(self, orderId, order_fill, filled_applied):
+        # call with the lock held
+        order_fill[3] = filled_applied
+        if filled_applied >= order_fill[4]:
+            unfilled_orders = self._unfilled_orders.get(order_fill[0], [])
+            if orderId in unfilled_orders:
+                unfilled_orders.remove(orderId)
+
+    def _mark_included_fills(self, conId, position_change):
+        # call with the lock held; position_change is what the position callback moved us by
+        for orderId in list(self._unfilled_orders.get(conId, [])):
+            order_fill = self._orders[orderId]
+            direction = order_fill[2]
+            if direction * position_change <= 0:
+                ## a fill the other way, or nothing left to account for
+                continue
+
+            included_fill = min(abs(position_change), order_fill[4] - order_fill[3])
+            self._set_filled_applied(orderId, order_fill, order_fill[3] + included_fill)
+            position_change -= direction * included_fill
+
+    def _apply_order_fill(self, orderId, cumulative_filled):
+        # call with the lock held; returns False for orders we don't know
+        order_fill = self._orders.get(orderId, None)
+        if order_fill is None:
+            return False
+
+        conId, localSymbol, direction, filled_applied, quantity = order_fill
+        new_fill = float(cumulative_filled) - filled_applied
+        if new_fill > 0:
+            self._positions[conId][2] += direction * new_fill
+            self._set_filled_applied(orderId, order_fill, float(cumulative_filled))
+
+        return True
+
+    def update_order_status(self, orderId, status, filled):
+        """
+        From the orderStatus callback
+        """
+        with self._lock:
+            self._apply_order_fill(orderId, filled)
+
+    def update_execution(self, contract, execution):
+        """
+        From the execDetails callback
+        """
+        with self._lock:
+            if execution.execId in self._seen_execIds:
+                ## IB sends executions again when asked with reqExecutions, or after a reconnect
+                return
+            self._seen_execIds.add(execution.execId)
+
+            if self._apply_order_fill(execution.orderId, execution.cumQty):
+                return
+
+            if self._positions_streaming:
+                ## not ours; whenever it comes, the position callback for it is the one to trust
+                return
+
+            if execution.side == BOUGHT:
+                direction = 1
+            else:
+                direction = -1
+
+            self._entry(contract, execution.acctNumber)[2] += direction * float(execution.shares)
+
+    def get_position(self, conId):
+        """
+        :return: float, 0 if we hold nothing
+        """
+        position_entry = self._positions.get(conId, None)
+        if position_entry is None:
+            return 0.0
+
+        return position_entry[2]
+
+    def get_position_by_localSymbol(self, localSymbol):
+        conId = self._symbol_index.get(localSymbol, None)
+        if conId is None:
+            return 0.0
+
+        return self.get_position(conId)
+
+    def get_avgCost(self, conId):
+        position_entry = self._positions.get(conId, None)
+        if position_entry is None:
+            return None
+
+        return position_entry[3]
+
+    def as_dict(self):
+        """
+        :return: dict, localSymbol -> position, like TradeClient.get_positions_dict
+        """
+        with self._lock:
+            return dict([(localSymbol, position) for account, localSymbol, position, avgCost in
+                         self._positions.values()])
+
+    def as_list(self):
+        """
+        :return: list of (account, localSymbol, position, avgCost), like TradeClient.get_current_positions
+        """
+        with self._lock:
+            return [tuple(position_entry) for position_entry in self._positions.values()]
@@ -0,0 +1,332 @@
+import collections
+import time
+from threading import Condition, Thread
+
+from ibapi.message import OUT
+
+## IB disconnects clients sending more than 50 messages a second. 40 a second with bursts of up to 10 never puts
+## more than 50 into any one second
+MESSAGES_PER_SECOND = 40
+MESSAGE_BURST = 10
+
+## historical data pacing rules, see IB's "Historical Data Limitations"
+HISTORICAL_REQUESTS_PER_WINDOW = 60
+HISTORICAL_WINDOW_SECONDS = 600
+IDENTICAL_REQUEST_SECONDS = 15
+SAME_CONTRACT_REQUESTS = 5
+SAME_CONTRACT_SECONDS = 2
+
+## messages are sent in priority order, oldest first within a priority
+ORDER_PRIORITY = 0
+ACCOUNT_PRIORITY = 1
+DATA_PRIORITY = 2
+HISTORICAL_PRIORITY = 3
+PRIORITY_NAMES = ("orders", "account", "data", "historical")
+
+## anything not listed goes as DATA_PRIORITY. Cancels have the priority of the request they cancel, so they never
+## overtake it
+MESSAGE_PRIORITIES = {OUT.PLACE_ORDER: ORDER_PRIORITY, OUT.CANCEL_ORDER: ORDER_PRIORITY,
+                      OUT.REQ_GLOBAL_CANCEL: ORDER_PRIORITY, OUT.REQ_IDS: ORDER_PRIORITY,
+                      OUT.START_API: ORDER_PRIORITY,
+                      OUT.REQ_POSITIONS: ACCOUNT_PRIORITY, OUT.CANCEL_POSITIONS: ACCOUNT_PRIORITY,
+                      OUT.REQ_ACCT_DATA: ACCOUNT_PRIORITY, OUT.REQ_ACCOUNT_SUMMARY: ACCOUNT_PRIORITY,
+                      OUT.CANCEL_ACCOUNT_SUMMARY: ACCOUNT_PRIORITY,
+                      OUT.REQ_HISTORICAL_DATA: HISTORICAL_PRIORITY, OUT.CANCEL_HISTORICAL_DATA: HISTORICAL_PRIORITY}
+
+
+def message_priority(msgId):
+    return MESSAGE_PRIORITIES.get(msgId, DATA_PRIORITY)
+
+
+def historical_request_keys(fields):
+    """
+    :param fields: reqHistoricalData message split on \\0, as sent to server version 124 and up
+    :return: tuple (reqId, identical_key, contract_key): identical_key is the request without its reqId,
+             contract_key the contract plus whatToShow
+    """
+    ## msgId, reqId, conId, symbol, secType, lastTradeDate, strike, right, multiplier, exchange, primaryExchange,
+    ## currency, localSymbol, tradingClass, includeExpired, endDateTime, barSizeSetting, durationStr, useRTH,
+    ## whatToShow, ...
+    identical_key = tuple(fields[:1] + fields[2:])
+    contract_key = tuple(fields[2:14] + fields[19:20])
+
+    return fields[1], identical_key, contract_key
+
+
+class TokenBucket(object):
+    """
+    rate tokens a second, holding at most capacity
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._time = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def wait_time(self, now):
+        """
+        :return: seconds until a token is available, 0 if there is one now
+        """
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+
+        return (1 - self._tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+
+class HistoricalPacing(object):
+    """
+    Keeps historical data requests inside IB's pacing rules: no more than max_requests in window_seconds, nothing
+    identical within identical_seconds, and no more than max_same_contract for one contract and whatToShow within
+    same_contract_seconds
+    """
+
+    def __init__(self, max_requests=HISTORICAL_REQUESTS_PER_WINDOW, window_seconds=HISTORICAL_WINDOW_SECONDS,
+                 identical_seconds=IDENTICAL_REQUEST_SECONDS, max_same_contract=SAME_CONTRACT_REQUESTS,
+                 same_contract_seconds=SAME_CONTRACT_SECONDS):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.identical_seconds = identical_seconds
+        self.max_same_contract = max_same_contract
+        self.same_contract_seconds = same_contract_seconds
+
+        self._request_times = collections.deque()
+        ## identical_key -> time last sent
+        self._identical_times = {}
+        ## contract_key -> deque of times sent
+        self._contract_times = {}
+
+    def requests_in_window(self, now):
+        request_times = self._request_times
+        while request_times and request_times[0] <= now - self.window_seconds:
+            request_times.popleft()
+
+        return len(request_times)
+
+    def wait_time(self, identical_key, contract_key, now):
+        """
+        :return: seconds until the request can go, 0 if it can go now
+        """
+        wait_seconds = 0.0
+
+        if self.requests_in_window(now) >= self.max_requests:
+            wait_seconds = self._request_times[0] + self.window_seconds - now
+
+        last_identical_time = self._identical_times.get(identical_key, None)
+        if last_identical_time is not None:
+            wait_seconds = max(wait_seconds, last_identical_time + self.identical_seconds - now)
+
+        contract_times = self._contract_times.get(contract_key, None)
+        if contract_times is not None:
+            while contract_times and contract_times[0] <= now - self.same_contract_seconds:
+                contract_times.popleft()
+            if len(contract_times) >= self.max_same_contract:
+                wait_seconds = max(wait_seconds, contract_times[0] + self.same_contract_seconds - now)
+
+        return max(wait_seconds, 0.0)
+
+    def record(self, identical_key, contract_key, now):
+        self._request_times.append(now)
+        self._identical_times[identical_key] = now
+        self._contract_times.setdefault(contract_key, collections.deque()).append(now)
+
+        if len(self._identical_times) > self.max_requests:
+            ## only the last identical_seconds matter
+            self._identical_times = dict([(key, sent_time) for key, sent_time in self._identical_times.items()
+                                          if sent_time > now - self.identical_seconds])
+
+
+class OutboundScheduler(object):
+    """
+    Sits between TradeClient and the socket: every message takes a token from a TokenBucket, historical data
+    requests also wait for HistoricalPacing, and orders go before account requests, other data and then
+    historical data. Historical data requests held up by pacing don't hold up requests for other contracts, and
+    one cancelled before it was sent is never sent
+
+    When nothing of the same or higher priority is queued and a token is free a message goes straight out on the
+    caller's thread; otherwise it's queued and a sender thread sends it as soon as it may.
+    """
+
+    def __init__(self, send_function, messages_per_second=MESSAGES_PER_SECOND, burst=MESSAGE_BURST,
+                 historical_pacing=None):
+        """
+        :param send_function: sends one message, eg EClient.sendMsg
+        :param historical_pacing: HistoricalPacing, default IB's rules
+        """
+        self._send_function = send_function
+        self._bucket = TokenBucket(messages_per_second, burst)
+        if historical_pacing is None:
+            historical_pacing = HistoricalPacing()
+        self._pacing = historical_pacing
+
+        ## one deque per priority, of (time queued, msg, pacing keys or None), see historical_request_keys
+        self._queues = [collections.deque() for priority_name in PRIORITY_NAMES]
+        self._queued_count = 0
+        self._condition = Condition()
+        self._thread = None
+        self._stopped = False
+
+        self._sent = [0] * len(PRIORITY_NAMES)
+        self._sent_immediately = 0
+        self._max_queue_depth = 0
+        self._total_delay = 0.0
+        self._max_delay = 0.0
+
+    def __repr__(self):
+        return "OutboundScheduler with %d messages queued" % self._queued_count
+
+    def send(self, msg):
+        msgId = int(msg[:msg.index("\0")])
+        priority = message_priority(msgId)
+        if msgId == OUT.REQ_HISTORICAL_DATA:
+            pacing_keys = historical_request_keys(msg.split("\0"))
+        else:
+            pacing_keys = None
+
+        with self._condition:
+            if msgId == OUT.CANCEL_HISTORICAL_DATA and self._cancel_queued(msg.split("\0")[2]):
+                return
+
+            now = time.monotonic()
+            ## lower priorities queued, eg historical data waiting for pacing, don't hold this up
+            if not any(self._queues[:priority + 1]) and self._ready(pacing_keys, now) == 0:
+                self._send(msg, priority, pacing_keys, now)
+                self._sent_immediately += 1
+                return
+
+            self._queues[priority].append((now, msg, pacing_keys))
+            self._queued_count += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queued_count)
+
+            self._stopped = False
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self):
+        """
+        Drop anything still queued, eg on disconnect
+        """
+        with self._condition:
+            self._stopped = True
+            for message_queue in self._queues:
+                message_queue.clear()
+            self._queued_count = 0
+            self._condition.notify()
+
+    def _cancel_queued(self, reqId):
+        # call with the lock held; True if the request was still queued, and now won't be sent
+        historical_queue = self._queues[HISTORICAL_PRIORITY]
+        for queued_message in historical_queue:
+            pacing_keys = queued_message[2]
+            if pacing_keys is not None and pacing_keys[0] == reqId:
+                historical_queue.remove(queued_message)
+                self._queued_count -= 1
+                return True
+
+        return False
+
+    def _pacing_wait(self, pacing_keys, now):
+        if pacing_keys is None:
+            return 0.0
+
+        return self._pacing.wait_time(pacing_keys[1], pacing_keys[2], now)
+
+    def _ready(self, pacing_keys, now):
+        # call with the lock held; seconds until a message can go
+        return max(self._bucket.wait_time(now), self._pacing_wait(pacing_keys, now))
+
+    def _send(self, msg, priority, pacing_keys, now):
+        # call with the lock held, so messages go out in the order we decided
+        self._bucket.take(now)
+        if pacing_keys is not None:
+            self._pacing.record(pacing_keys[1], pacing_keys[2], now)
+        self._sent[priority] += 1
+
+        self._send_function(msg)
+
+    def _send_queued(self):
+        # call with the lock held; returns seconds to wait before trying again, None if nothing is queued
+        while self._queued_count > 0:
+            now = time.monotonic()
+            wait_seconds = self._bucket.wait_time(now)
+            if wait_seconds > 0:
+                return wait_seconds
+
+            ## the first message in priority order that may go; only historical data requests ever have to wait
+            queued_message = None
+            pacing_wait_seconds = []
+            for priority, message_queue in enumerate(self._queues):
+                for candidate_message in message_queue:
+                    pacing_wait = self._pacing_wait(candidate_message[2], now)
+                    if pacing_wait == 0:
+                        queued_message = candidate_message
+                        break
+                    pacing_wait_seconds.append(pacing_wait)
+
+                if queued_message is not None:
+                    break
+
+            if queued_message is None:
+                return min(pacing_wait_seconds)
+
+            message_queue.remove(queued_message)
+            self._queued_count -= 1
+            time_queued, msg, pacing_keys = queued_message
+
+            delay = now - time_queued
+            self._total_delay += delay
+            self._max_delay = max(self._max_delay, delay)
+
+            try:
+                self._send(msg, priority, pacing_keys, now)
+            except Exception as send_exception:
+                ## eg the connection went; the caller has long gone, so all we can do is say so
+                print("Couldn't send queued message: %s" % str(send_exception))
+
+        return None
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                self._condition.wait(self._send_queued())
+
+            self._thread = None
+
+    def queue_depth(self):
+        """
+        :return: dict, priority name -> messages queued
+        """
+        with self._condition:
+            return dict([(priority_name, len(message_queue)) for priority_name, message_queue in
+                         zip(PRIORITY_NAMES, self._queues)])
+
+    def stats(self):
+        """
+        :return: dict of counters: queued and sent by priority, how many went straight out, the deepest the queue
+                 has been, delays of queued messages in seconds, historical requests in the pacing window
+        """
+        with self._condition:
+            sent_count = sum(self._sent)
+            delayed_count = sent_count - self._sent_immediately
+            if delayed_count > 0:
+                mean_delay = self._total_delay / delayed_count
+            else:
+                mean_delay = 0.0
+
+            return dict(queued=dict([(priority_name, len(message_queue)) for priority_name, message_queue in
+                                     zip(PRIORITY_NAMES, self._queues)]),
+                        sent=dict(zip(PRIORITY_NAMES, self._sent)), sent_immediately=self._sent_immediately,
+                        delayed=delayed_count, max_queue_depth=self._max_queue_depth, mean_delay=mean_delay,
+                        max_delay=self._max_delay,
+                        historical_requests_in_window=self._pacing.requests_in_window(time.monotonic()))
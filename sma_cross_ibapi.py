@@ -1,25 +1,119 @@
+import collections
 import datetime
-import queue
-import time
-from threading import Thread
+from threading import Condition, Thread
 
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 
-from helpers import SimpleCache, identifed_as, list_of_identified_items
+from async_client import POSITIONS_KEY, PendingRequests, accounts_key
+from bar_buffer import BarBuffer
+from bar_store import BarStore
+from bar_stream import BarStream
+from contract_cache import ContractCache, contract_key
+from error_log import NO_REQID, ErrorLog, ErrorRecord
+from events import (ACCOUNT_UPDATE, BAR_CLOSED, BAR_UPDATE, NEXT_VALID_ID, ORDER_STATUS, POSITION, POSITION_END,
+                    TIMEFRAME_BAR_CLOSED)
+from helpers import (ACCOUNT_TIME_FLAG, ACCOUNT_UPDATE_FLAG, ACCOUNT_VALUE_FLAG, DEFAULT_ACCOUNT_CURRENCY, AccountData,
+                     Cache, ReqIdAllocator, contract_from_details)
+from metrics import ACCOUNT, BAR_CALLBACK, CONTRACT_DETAILS, HISTORICAL_DATA, ORDER, ORDER_ID, POSITIONS, Metrics
+from order_manager import DONE_STATES, OrderManager
+from position_book import PositionBook
+from rate_limiter import OutboundScheduler
+from strategy_runner import StrategyRunner
 from trade_logic import TradeLogic
 
-DEFAULT_HISTORIC_DATA_ID = 50
-DEFAULT_GET_CONTRACT_ID = 43
+## account value we report as the balance
+BALANCE_KEY = ("NetLiquidationByCurrency", "BASE")
 
-ACCOUNT_UPDATE_FLAG = "update"
-ACCOUNT_VALUE_FLAG = "value"
-ACCOUNT_TIME_FLAG = "time"
+## IB counts an identical historical data request within 15 seconds as a pacing violation, so we answer those
+## from the cache instead
+HISTORY_CACHE_SECONDS = 15
+HISTORY_CACHE_CAPACITY = 100
+
+## IB reports errors for requests and orders by the same id, and order ids count up from nextValidId, so request
+## ids start far above any order id we'll ever see
+FIRST_REQID = 100000000
 
 # marker for when queue is finished
 FINISHED = object()
 STARTED = object()
 TIME_OUT = object()
+## got what we asked for before the FINISHED marker turned up
+COMPLETE = object()
+## IB sent an error for the request; finishes it like FINISHED
+FAILED = object()
+
+
+class ResponseQueue(object):
+    """
+    Where the wrapper puts data for a request. Waiters sleep on a condition variable and are woken by each put
+    """
+
+    def __init__(self):
+        self._items = collections.deque()
+        self._finished_count = 0
+        self._condition = Condition()
+
+    def __repr__(self):
+        return "ResponseQueue with %d items" % len(self._items)
+
+    def put(self, item):
+        with self._condition:
+            self._items.append(item)
+            if item is FINISHED or item is FAILED:
+                self._finished_count += 1
+
+            self._condition.notify_all()
+
+    def fail(self):
+        """
+        The request failed: wake waiters now rather than at their timeout
+        """
+        self.put(FAILED)
+
+    def empty(self):
+        return len(self._items) == 0
+
+    def take(self, timeout, expected_count=None, until=None):
+        """
+        Wait until a FINISHED or FAILED marker arrives, or we have expected_count elements, or until(elements) is
+        True, or the timeout runs out - whichever is first. Takes elements up to and including the marker
+
+        :param timeout: overall deadline in seconds, not a gap between elements
+        :param expected_count: int or None
+        :param until: None, or function of the elements received so far returning bool
+        :return: tuple: list of elements, status FINISHED / FAILED / COMPLETE / TIME_OUT
+        """
+
+        def _is_complete():
+            if self._finished_count > 0:
+                return True
+
+            if expected_count is not None and len(self._items) >= expected_count:
+                return True
+
+            if until is not None and until(self._items):
+                return True
+
+            return False
+
+        with self._condition:
+            is_complete = self._condition.wait_for(_is_complete, timeout)
+
+            contents_of_queue = []
+            status = COMPLETE if is_complete else TIME_OUT
+
+            items = self._items
+            while len(items) > 0:
+                current_element = items.popleft()
+                if current_element is FINISHED or current_element is FAILED:
+                    self._finished_count -= 1
+                    status = current_element
+                    break
+
+                contents_of_queue.append(current_element)
+
+        return contents_of_queue, status
 
 
 class FinishableQueue(object):
@@ -28,170 +122,324 @@ class FinishableQueue(object):
         self._queue = queue_to_finish
         self.status = STARTED
 
-    def get(self, timeout):
+    def get(self, timeout, expected_count=None, until=None):
         """
-        Returns a list of queue elements once timeout is finished, or a FINISHED flag is received in the queue
-        :param timeout: how long to wait before giving up
+        Returns a list of queue elements once a FINISHED flag is received in the queue, once we have the
+        elements we want, or once timeout is finished
+        :param timeout: how long to wait in total before giving up
+        :param expected_count: stop early once we have this many elements
+        :param until: stop early once this function of the elements received so far returns True
         :return: list of queue elements
         """
-        contents_of_queue = []
-        finished = False
-
-        while not finished:
-            try:
-                current_element = self._queue.get(timeout=timeout)
-                if current_element is FINISHED:
-                    finished = True
-                    self.status = FINISHED
-                else:
-                    contents_of_queue.append(current_element)
-                    ## keep going and try and get more data
-
-            except queue.Empty:
-                ## If we hit a time out it's most probable we're not getting a finished element any time soon
-                ## give up and return what we have
-                finished = True
-                self.status = TIME_OUT
+        contents_of_queue, self.status = self._queue.take(timeout, expected_count=expected_count, until=until)
 
         return contents_of_queue
 
     def timed_out(self):
         return self.status is TIME_OUT
 
+    def failed(self):
+        return self.status is FAILED
+
 
 class TradeWrapper(EWrapper):
     def __init__(self):
         self._my_contract_details = {}
         self._my_historic_data_dict = {}
+        self._my_bar_buffers = {}
+        self._my_bar_streams = {}
         # на случай нескольких аккаунтов используем словарь
+        # the queues only carry the FINISHED marker, the data itself goes straight into AccountData
         self._my_accounts = {}
+        self._my_account_data = {}
+        # updateAccountTime doesn't tell us which account it's for
+        self._my_current_account = None
 
-        # We set these up as we could get things coming along before we run an init
-        self._my_positions = queue.Queue()
-        self._my_errors = queue.Queue()
-        self._my_orderid_data = queue.Queue()
+        # positions, kept up to date from the reqPositions subscription and from fills
+        self._my_position_book = PositionBook()
+        # only there while get_current_positions is waiting for positionEnd, the subscription streams forever
+        self._my_positions = None
 
-    def get_error(self, timeout=5):
-        if self.is_error():
-            try:
-                return self._my_errors.get(timeout=timeout)
-            except queue.Empty:
-                return None
+        # latency of requests and callbacks
+        self._my_metrics = Metrics()
+
+        # order ids, and the state of every order we place
+        self._my_order_manager = OrderManager(self, publish_function=lambda managed_order:
+                                              self._publish(ORDER_STATUS, managed_order))
+
+        # errors by reqId, and notices with no reqId in a ring buffer
+        self._my_error_log = ErrorLog()
 
-        return None
+        # callbacks are also published here if a dispatcher is set
+        self._my_events = None
+
+        # requests made through AsyncTradeClient; callbacks for these go to futures, not queues
+        self._my_pending = PendingRequests()
+
+    def set_event_dispatcher(self, dispatcher):
+        self._my_events = dispatcher
+
+    def _publish(self, event_type, data=None):
+        if self._my_events is not None:
+            self._my_events.publish(event_type, data)
+
+    def get_error(self, timeout=5):
+        """
+        Oldest notice not tied to a request, taken out of the ring buffer; errors for a request are kept by reqId,
+        see get_request_errors. Never waits, timeout is only there for old callers
+        :return: ErrorRecord, or None
+        """
+        return self._my_error_log.pop_notice()
 
     def is_error(self):
-        an_error_if = not self._my_errors.empty()
+        an_error_if = self._my_error_log.has_notice()
         return an_error_if
 
+    def get_request_errors(self, reqId):
+        """
+        :return: list of ErrorRecords for the request (or order id)
+        """
+        return self._my_error_log.get_request_errors(reqId)
+
+    def get_error_log(self):
+        return self._my_error_log
+
+    def _fail_request(self, reqId, error_record):
+        # orders first: an order rejection must never be taken for a failed request
+        if self._my_order_manager.order_error(reqId, error_record.errorCode):
+            print(error_record)
+            return
+
+        # so whatever is waiting for the request finds out now, rather than at its timeout
+        if self._my_pending.fail(reqId, Exception(str(error_record))):
+            return
+
+        response_queue = self._my_contract_details.get(reqId, None)
+        if response_queue is None:
+            response_queue = self._my_historic_data_dict.get(reqId, None)
+        if response_queue is not None:
+            response_queue.fail()
+
     def error(self, id, errorCode, errorString):
         # Overriden method
-        if id == -1:
-            msg = "Notify (%d): Code=%d Message=%s" % (id, errorCode, errorString)
-        else:
-            msg = "Error (%d): Code=%d Message=%s" % (id, errorCode, errorString)
-        self._my_errors.put(msg)
+        error_record = ErrorRecord(id, errorCode, errorString)
+        if not self._my_error_log.add(error_record):
+            ## farm connection status and the like
+            return
+
+        if id != NO_REQID and not error_record.is_warning():
+            self._fail_request(id, error_record)
 
     def position(self, account, contract, position, avgCost):
         # uses a simple tuple, but you could do other, fancier, things here
         position_object = (account, contract.localSymbol, position, avgCost)
+        self._my_metrics.request_response(POSITIONS)
+        self._my_position_book.update_position(account, contract, position, avgCost)
 
-        self._my_positions.put(position_object)
+        if not self._my_pending.add(POSITIONS_KEY, position_object):
+            positions_queue = self._my_positions
+            if positions_queue is not None:
+                positions_queue.put(position_object)
+        self._publish(POSITION, position_object)
 
     def positionEnd(self):
         # overriden method
-        self._my_positions.put(FINISHED)
+        self._my_metrics.request_finished(POSITIONS)
+        if not self._my_pending.finish(POSITIONS_KEY):
+            positions_queue = self._my_positions
+            if positions_queue is not None:
+                positions_queue.put(FINISHED)
+        self._publish(POSITION_END)
+
+    def orderStatus(self, orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice,
+                    clientId, whyHeld, mktCapPrice=0.0):
+        # overriden method
+        if status in DONE_STATES:
+            self._my_metrics.request_finished(ORDER, orderId)
+        else:
+            self._my_metrics.request_response(ORDER, orderId)
+        self._my_position_book.update_order_status(orderId, status, filled)
+        self._my_order_manager.order_status(orderId, status, filled, remaining, avgFillPrice, permId)
+
+    def openOrder(self, orderId, contract, order, orderState):
+        # overriden method
+        self._my_metrics.request_response(ORDER, orderId)
+        self._my_order_manager.open_order(orderId, contract, order, orderState)
+
+    def execDetails(self, reqId, contract, execution):
+        # overriden method
+        self._my_position_book.update_execution(contract, execution)
+        self._my_order_manager.execution(contract, execution)
 
     def init_accounts(self, accountName):
         # get accounting data
-        self._my_accounts[accountName] = queue.Queue()
+        self._my_accounts[accountName] = ResponseQueue()
 
         return self._my_accounts[accountName]
 
+    def get_account_data(self, accountName):
+        """
+        :return: AccountData, created empty if nothing has arrived for the account yet
+        """
+        account_data = self._my_account_data.get(accountName, None)
+        if account_data is None:
+            account_data = self._my_account_data.setdefault(accountName, AccountData(accountName))
+            account_data.add_subscriber(lambda label, key, value:
+                                        self._publish(ACCOUNT_UPDATE, (accountName, label, key, value)))
+
+        return account_data
+
     def updateAccountValue(self, key: str, val: str, currency: str, accountName: str):
-        # use this to seperate out different account data
-        data = identifed_as(ACCOUNT_VALUE_FLAG, (key, val, currency))
-        self._my_accounts[accountName].put(data)
+        self._my_metrics.request_response(ACCOUNT)
+        self._my_current_account = accountName
+        self.get_account_data(accountName).update_value(key, val, currency)
 
     def updatePortfolio(self, contract, position: float,
                         marketPrice: float, marketValue: float,
                         averageCost: float, unrealizedPNL: float,
                         realizedPNL: float, accountName: str):
 
-        # use this to seperate out different account data
-        data = identifed_as(ACCOUNT_UPDATE_FLAG, (contract, position, marketPrice, marketValue, averageCost,
-                                                  unrealizedPNL, realizedPNL))
-        self._my_accounts[accountName].put(data)
+        self._my_current_account = accountName
+        self.get_account_data(accountName).update_portfolio(contract, (contract, position, marketPrice, marketValue,
+                                                                       averageCost, unrealizedPNL, realizedPNL))
 
     def updateAccountTime(self, timeStamp: str):
-        # use this to seperate out different account data
-        data = identifed_as(ACCOUNT_TIME_FLAG, timeStamp)
-        self._my_accounts[accountName].put(data)
+        # doesn't tell us which account, so it's the one the last update was for
+        if self._my_current_account is not None:
+            self.get_account_data(self._my_current_account).update_time(timeStamp)
 
     def accountDownloadEnd(self, accountName: str):
-        self._my_accounts[accountName].put(FINISHED)
+        self._my_metrics.request_finished(ACCOUNT)
+        if self._my_pending.finish(accounts_key(accountName)):
+            return
+
+        if accountName in self._my_accounts.keys():
+            self._my_accounts[accountName].put(FINISHED)
 
     # Исторические данные
 
     # get contract details code
     def init_contractdetails(self, reqId):
-        self._my_contract_details[reqId] = queue.Queue()
+        self._my_contract_details[reqId] = ResponseQueue()
 
         return self._my_contract_details[reqId]
 
+    def finish_contractdetails(self, reqId):
+        # the caller has what it wants, or has given up; anything arriving later for the request is dropped
+        self._my_contract_details.pop(reqId, None)
+
     def contractDetails(self, reqId, contractDetails):
         # overridden method
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
+        self._my_metrics.request_response(CONTRACT_DETAILS, reqId)
+        if self._my_pending.add(reqId, contractDetails):
+            return
 
-        self._my_contract_details[reqId].put(contractDetails)
+        # every request gets a new reqId, so one we don't know is late and nobody is waiting for it
+        contract_details_queue = self._my_contract_details.get(reqId, None)
+        if contract_details_queue is not None:
+            contract_details_queue.put(contractDetails)
 
     def contractDetailsEnd(self, reqId):
         # overriden method
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
+        self._my_metrics.request_finished(CONTRACT_DETAILS, reqId)
+        if self._my_pending.finish(reqId):
+            return
 
-        self._my_contract_details[reqId].put(FINISHED)
+        contract_details_queue = self._my_contract_details.get(reqId, None)
+        if contract_details_queue is not None:
+            contract_details_queue.put(FINISHED)
 
     # Historic data code
+    # bars go straight into a BarBuffer; the queue only carries the FINISHED marker
     def init_historicprices(self, tickerid):
-        historic_data_queue = self._my_historic_data_dict[tickerid] = queue.Queue()
+        historic_data_queue = self._my_historic_data_dict[tickerid] = ResponseQueue()
+        self._my_bar_buffers[tickerid] = BarBuffer()
 
         return historic_data_queue
 
+    def finish_historicprices(self, tickerid):
+        # as finish_contractdetails; a stream carries on through historicalDataUpdate
+        self._my_historic_data_dict.pop(tickerid, None)
+        self._my_bar_buffers.pop(tickerid, None)
+
+    def get_bar_buffer(self, tickerid):
+        """
+        Take the bars received for a request; later ones go into a new buffer
+        :return: BarBuffer
+        """
+        bar_buffer = self._my_bar_buffers.pop(tickerid, None)
+        if bar_buffer is None:
+            return BarBuffer(capacity=0)
+
+        return bar_buffer
+
     def historicalData(self, tickerid, bar):
         # Overriden method
         # Note I'm choosing to ignore barCount, WAP and hasGaps but you could use them if you like
-        bardata = (bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
+        self._my_metrics.request_response(HISTORICAL_DATA, tickerid)
+        if self._my_pending.is_pending(tickerid):
+            self._my_pending.add(tickerid, (bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume))
+            return
 
-        historic_data_dict = self._my_historic_data_dict
+        bar_buffer = self._my_bar_buffers.get(tickerid, None)
+        if bar_buffer is None:
+            ## late, nobody is waiting for it
+            return
 
-        # Add on to the current data
-        if tickerid not in historic_data_dict.keys():
-            self.init_historicprices(tickerid)
-
-        historic_data_dict[tickerid].put(bardata)
+        bar_buffer.append(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
 
     def historicalDataEnd(self, tickerid, start: str, end: str):
         # overriden method
+        self._my_metrics.request_finished(HISTORICAL_DATA, tickerid)
+        if self._my_pending.finish(tickerid):
+            return
+
+        historic_data_queue = self._my_historic_data_dict.get(tickerid, None)
+        if historic_data_queue is not None:
+            historic_data_queue.put(FINISHED)
+
+    # Streaming bars, after the backfill of a keepUpToDate request
+    def init_bar_stream(self, tickerid):
+        bar_stream = self._my_bar_streams[tickerid] = BarStream(tickerid)
 
-        if tickerid not in self._my_historic_data_dict.keys():
-            self.init_historicprices(tickerid)
+        if self._my_events is not None:
+            bar_stream.add_subscriber(lambda bar: self._publish(BAR_UPDATE, (tickerid, bar)))
+            bar_stream.add_close_subscriber(lambda bar: self._publish(BAR_CLOSED, (tickerid, bar)))
 
-        self._my_historic_data_dict[tickerid].put(FINISHED)
+        return bar_stream
+
+    def init_timeframes(self, tickerid, bar_stream, aggregator):
+        # completed bars of every timeframe are published, as the stream's are
+        aggregator.attach(bar_stream, lambda name, bar: self._publish(TIMEFRAME_BAR_CLOSED, (tickerid, name, bar)))
+
+    def historicalDataUpdate(self, tickerid, bar):
+        # Overriden method
+        # IB sends the current bar again every few seconds while it's forming, then the next one
+        bar_stream = self._my_bar_streams.get(tickerid, None)
+        if bar_stream is None:
+            ## cancelled, or never asked for
+            return
+
+        # the update which closes a bar starts the callback to order timing, see StrategyRunner
+        self._my_metrics.mark(BAR_CALLBACK, tickerid)
+
+        bardata = (bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
+        bar_stream.update(bardata)
 
         # order id receiving
 
-    def init_nextvalidid(self):
-        self._my_orderid_data = queue.Queue()
+    def get_order_manager(self):
+        return self._my_order_manager
 
-        return self._my_orderid_data
+    def get_metrics(self):
+        return self._my_metrics
 
     def nextValidId(self, orderId):
-        if getattr(self, '_my_orderid_data', None) is None:
-            self.init_nextvalidid()
+        # sent once as we connect, after that order ids are allocated locally
+        self._my_metrics.request_finished(ORDER_ID)
+        self._my_order_manager.update_next_valid_id(orderId)
 
-        self._my_orderid_data.put(orderId)
+        self._publish(NEXT_VALID_ID, orderId)
 
 
 class TradeClient(EClient):
@@ -200,14 +448,56 @@ class TradeClient(EClient):
     We don't override native methods, but instead call them from our own wrappers
     """
 
-    def __init__(self, wrapper):
+    def __init__(self, wrapper, contract_cache_filename=None):
         ## Set up with a wrapper inside
         EClient.__init__(self, wrapper)
 
-        ## We use these to store accounting data
-        self._account_cache = SimpleCache(max_staleness_seconds=5 * 60)
-        ## override function
-        self._account_cache.update_data = self._update_accounting_data
+        ## resolved contracts, so we only ask IB once a day for each; optionally kept on disk between runs
+        self._contract_cache = ContractCache(filename=contract_cache_filename)
+
+        ## recent historical data requests, so callers asking for the same thing at once only send one
+        self._history_cache = Cache(capacity=HISTORY_CACHE_CAPACITY, ttl_seconds=HISTORY_CACHE_SECONDS)
+
+        ## account we're getting streaming updates for; IB only streams one at a time
+        self._subscribed_account = None
+
+        ## every request gets its own id, so several can be in flight at once
+        self._reqids = ReqIdAllocator(first_id=FIRST_REQID)
+
+        ## once we've called reqPositions IB keeps sending changes
+        self._positions_subscribed = False
+
+        ## every outgoing message goes through here, to stay inside IB's message rate and historical data pacing
+        self._outbound = OutboundScheduler(lambda msg: EClient.sendMsg(self, msg))
+        self._my_metrics.add_gauges("ibapi_outbound_queue_depth", "priority", self._outbound.queue_depth)
+
+    def sendMsg(self, msg):
+        # overriden method
+        self._my_metrics.message_sent(msg, self.serverVersion())
+        self._outbound.send(msg)
+
+    def disconnect(self):
+        # overriden method
+        self._outbound.stop()
+        EClient.disconnect(self)
+
+    def get_outbound_stats(self):
+        """
+        :return: dict, see OutboundScheduler.stats
+        """
+        return self._outbound.stats()
+
+    def allocate_reqid(self):
+        return self._reqids.next_id()
+
+    def _print_errors(self, reqId=None, caller="Wrapper error:"):
+        # errors for the request, then any notices which have come in; nothing here waits
+        if reqId is not None:
+            for error_record in self._my_error_log.pop_request_errors(reqId):
+                print(caller, error_record)
+
+        while self.wrapper.is_error():
+            print(caller, self.wrapper.get_error())
 
     def get_current_positions(self):
         """
@@ -215,52 +505,95 @@ class TradeClient(EClient):
         :return:
         """
         # Make a place to store the data we're going to return
+        self._my_positions = ResponseQueue()
         positions_queue = FinishableQueue(self._my_positions)
 
         # ask for the data
         self.reqPositions()
+        self._positions_subscribed = True
 
         # poll until we get a termination or die of boredom
         MAX_WAIT_SECONDS = 10
         positions_list = positions_queue.get(timeout=MAX_WAIT_SECONDS)
+        self._my_positions = None
 
-        while self.wrapper.is_error():
-            print("Wrapper error:", self.get_error())
+        self._print_errors()
 
         if positions_queue.timed_out():
             print("Exceeded maximum wait for wrapper to confirm finished whilst getting positions")
 
         return positions_list
 
-    def _update_accounting_data(self, accountName):
+    def subscribe_positions(self):
+        """
+        Positions are streamed once we've asked for them, so only the first call waits for IB
+        :return: PositionBook, which stays up to date
+        """
+        if not self._positions_subscribed:
+            self.get_current_positions()
+
+        return self._my_position_book
+
+    def get_position(self, ibcontract):
+        """
+        Position in a contract, without asking IB
+        :return: float
+        """
+        position_book = self.subscribe_positions()
+
+        resolved_ibcontract = self._resolved_from_cache(ibcontract)
+        if resolved_ibcontract.conId:
+            return position_book.get_position(resolved_ibcontract.conId)
+
+        return position_book.get_position_by_localSymbol(resolved_ibcontract.localSymbol)
+
+    def _resolved_from_cache(self, ibcontract):
+        if ibcontract.conId:
+            return ibcontract
+
+        resolved_ibcontract = self._contract_cache.get(ibcontract)
+        if resolved_ibcontract is None:
+            return ibcontract
+
+        return resolved_ibcontract
+
+    def subscribe_account(self, accountName):
         """
-        Update the accounting data in the cache
+        Subscribe to account updates. Only the first call for an account waits for the download; after that IB
+        streams changes, the wrapper applies them to the account's AccountData as they come, and reads don't wait
+
+        Subscribing to another account ends the subscription to this one, as IB only streams one at a time
+
         :param accountName: account we want to get data for
-        :return: nothing
+        :return: AccountData
         """
+        if self._subscribed_account == accountName:
+            return self.get_account_data(accountName)
+
         # Make a place to store the data we're going to return
         accounting_queue = FinishableQueue(self.init_accounts(accountName))
 
         # ask for the data
         self.reqAccountUpdates(True, accountName)
+        self._subscribed_account = accountName
 
-        # poll until we get a termination or die of boredom
+        # wait until the download is finished or die of boredom; the wrapper has already sorted the data out
         MAX_WAIT_SECONDS = 10
-        accounting_list = accounting_queue.get(timeout=MAX_WAIT_SECONDS)
+        accounting_queue.get(timeout=MAX_WAIT_SECONDS)
 
-        while self.wrapper.is_error():
-            print("Wrapper error:", self.get_error())
+        self._print_errors()
 
         if accounting_queue.timed_out():
             print("Exceeded maximum wait for wrapper to confirm finished whilst getting accounting data")
 
-        # seperate things out, because this is one big queue of data with different things in it
-        accounting_list = list_of_identified_items(accounting_list)
+        return self.get_account_data(accountName)
 
-        # update the cache with different elements
-        self._account_cache.update_cache(accountName, accounting_list.seperate_into_dict())
+    def unsubscribe_account(self):
+        if self._subscribed_account is None:
+            return
 
-        # return nothing, information is accessed via get_... methods
+        self.reqAccountUpdates(False, self._subscribed_account)
+        self._subscribed_account = None
 
     def get_accounting_time_from_server(self, accountName):
         """
@@ -268,36 +601,62 @@ class TradeClient(EClient):
         :return: accounting time as served up by IB
         """
 
-        # All these functions follow the same pattern: check if stale or missing, if not return cache, else update values
+        # All these functions follow the same pattern: subscribe if we haven't, then read what we have
 
-        return self._account_cache.get_updated_cache(accountName, ACCOUNT_TIME_FLAG)
+        return self.subscribe_account(accountName).get_time()
+
+    def get_account_value(self, accountName, key, currency=DEFAULT_ACCOUNT_CURRENCY):
+        """
+        One accounting value, without copying the rest; cheap enough to call on every tick
+        :return: float, str if it isn't a number, or None if IB hasn't sent it
+        """
+
+        return self.subscribe_account(accountName).get_value(key, currency)
 
     def get_accounting_values(self, accountName):
         """
         Get the accounting values from IB server
-        :return: accounting values as served up by IB
+        :return: dict, (key, currency) -> value, as a float if it's a number
         """
 
-        # All these functions follow the same pattern: check if stale, if not return cache, else update values
-
-        return self._account_cache.get_updated_cache(accountName, ACCOUNT_VALUE_FLAG)
+        return self.subscribe_account(accountName).get_values()
 
     def get_accounting_updates(self, accountName):
         """
         Get the accounting updates from IB server
-        :return: accounting updates as served up by IB
+        :return: list of portfolio tuples as served up by IB
         """
 
-        # All these functions follow the same pattern: check if stale, if not return cache, else update values
+        return self.subscribe_account(accountName).get_portfolio()
+
+    def get_accounting_values_array(self, accountName):
+        """
+        :return: numpy structured array of all the accounting values, see AccountData.get_values_array
+        """
 
-        return self._account_cache.get_updated_cache(accountName, ACCOUNT_UPDATE_FLAG)
+        return self.subscribe_account(accountName).get_values_array()
 
-    def resolve_ib_contract(self, ibcontract, reqId=DEFAULT_GET_CONTRACT_ID):
+    def resolve_ib_contract(self, ibcontract, reqId=None):
 
         """
         From a partially formed contract, returns a fully fledged version
         :returns fully resolved IB contract
         """
+        resolved_ibcontract = self._contract_cache.get_or_resolve(
+            ibcontract, lambda ibcontract: self._get_contract_from_server(ibcontract, reqId))
+
+        if resolved_ibcontract is None:
+            print("Failed to get additional contract details: returning unresolved contract")
+            return ibcontract
+
+        return resolved_ibcontract
+
+    def _get_contract_from_server(self, ibcontract, reqId=None):
+        """
+        :returns fully resolved IB contract, or None if IB didn't give us one
+        """
+        if reqId is None:
+            reqId = self.allocate_reqid()
 
         ## Make a place to store the data we're going to return
         # cjздаем декоратор для приема данных
@@ -308,58 +667,50 @@ class TradeClient(EClient):
 
         self.reqContractDetails(reqId, ibcontract)
 
-        ## Run until we get a valid contract(s) or get bored waiting
+        ## Run until we get a valid contract or get bored waiting
+        ## we only use the first one, so don't wait for contractDetailsEnd which doesn't always come
         MAX_WAIT_SECONDS = 10
-        # Получаем значение из созданной очереди по оканчании иди таймауту
-        new_contract_details = contract_details_queue.get(timeout=MAX_WAIT_SECONDS)
+        # Получаем значение из созданной очереди по получении первого контракта или таймауту
+        new_contract_details = contract_details_queue.get(timeout=MAX_WAIT_SECONDS, expected_count=1)
+        self.finish_contractdetails(reqId)
         # если есть ошибки то возвращаем их
 
-        while self.wrapper.is_error():
-            print("Wrapper error:", self.get_error())
+        self._print_errors(reqId)
 
         if contract_details_queue.timed_out():
             print("Exceeded maximum wait for wrapper to confirm finished - seems to be normal behaviour")
 
         if len(new_contract_details) == 0:
-            print("Failed to get additional contract details: returning unresolved contract")
-            return ibcontract
+            return None
 
         if len(new_contract_details) > 1:
             print("got multiple contracts using first one")
 
         new_contract_details = new_contract_details[0]
 
-        resolved_ibcontract = new_contract_details.summary
+        resolved_ibcontract = contract_from_details(new_contract_details)
         # print(resolved_ibcontract)
 
         return resolved_ibcontract
 
     def get_next_brokerorderid(self):
         """
-        Get next broker order id
+        Get next broker order id; allocated locally once IB has sent nextValidId, no round trip
         :return: broker order id, int; or TIME_OUT if unavailable
         """
 
-        # Make a place to store the data we're going to return
-        # REMOVED # orderid_q = self._my_orderid_data
-
-        self.reqIds(-1)  # -1 is irrelevant apparently (see IB API docs)
-
-        # Run until we get a valid contract(s) or get bored waiting
         MAX_WAIT_SECONDS = 10
-        try:
-            brokerorderid = self._my_orderid_data.get(timeout=MAX_WAIT_SECONDS)
-        except queue.Empty:
+        brokerorderid = self._my_order_manager.next_orderid(timeout=MAX_WAIT_SECONDS)
+        if brokerorderid is None:
             print("Wrapper timeout waiting for broker orderid")
             brokerorderid = TIME_OUT
 
-        while self.wrapper.is_error():
-            print("get_next_brokerorderid():", self.get_error(timeout=MAX_WAIT_SECONDS))
+        self._print_errors(caller="get_next_brokerorderid():")
 
         return brokerorderid
 
     def get_IB_historical_data(self, ibcontract, durationStr="1 D", barSizeSetting="5 mins",
-                               tickerid=DEFAULT_HISTORIC_DATA_ID):
+                               tickerid=None):
 
         """
         Returns historical prices for a contract, up to today
@@ -367,6 +718,33 @@ class TradeClient(EClient):
         :returns list of prices in 4 tuples: Open high low close volume
         """
 
+        return self.get_IB_historical_bars(ibcontract, durationStr=durationStr, barSizeSetting=barSizeSetting,
+                                           tickerid=tickerid).to_bar_tuples()
+
+    def get_IB_historical_bars(self, ibcontract, durationStr="1 D", barSizeSetting="5 mins", tickerid=None):
+        """
+        Like get_IB_historical_data, but the bars stay in typed arrays; pass the BarBuffer or its view() to
+        TradeLogic.cross_signal or BarStore.append_arrays without copying them
+        The same request made again within HISTORY_CACHE_SECONDS gets the same answer without asking IB
+        :returns BarBuffer, which must not be appended to as other callers may share it
+        """
+        history_key = (contract_key(ibcontract), durationStr, barSizeSetting)
+        bar_buffer = self._history_cache.get_or_load(
+            history_key, lambda: self._get_historical_data_from_server(ibcontract, durationStr, barSizeSetting,
+                                                                       tickerid))
+
+        if bar_buffer is None:
+            return BarBuffer(capacity=0)
+
+        return bar_buffer
+
+    def _get_historical_data_from_server(self, ibcontract, durationStr, barSizeSetting, tickerid=None):
+        """
+        :returns BarBuffer, or None if we didn't get any bars
+        """
+        if tickerid is None:
+            tickerid = self.allocate_reqid()
+
         ## Make a place to store the data we're going to return
         historic_data_queue = FinishableQueue(self.init_historicprices(tickerid))
 
@@ -388,24 +766,95 @@ class TradeClient(EClient):
         MAX_WAIT_SECONDS = 20
         print("Getting historical data from the server... could take %d seconds to complete " % MAX_WAIT_SECONDS)
 
-        historic_data = historic_data_queue.get(timeout=MAX_WAIT_SECONDS)
+        historic_data_queue.get(timeout=MAX_WAIT_SECONDS)
 
-        while self.wrapper.is_error():
-            print("get_IB_historical_data():", self.get_error())
+        self._print_errors(tickerid, caller="get_IB_historical_data():")
 
         if historic_data_queue.timed_out():
             print("Exceeded maximum wait for wrapper to confirm finished - seems to be normal behaviour")
 
         self.cancelHistoricalData(tickerid)
 
-        return historic_data
+        bar_buffer = self.get_bar_buffer(tickerid)
+        self.finish_historicprices(tickerid)
+        if len(bar_buffer) == 0:
+            return None
+
+        return bar_buffer
+
+    def subscribe_IB_historical_data(self, ibcontract, callback=None, durationStr="1 D", barSizeSetting="5 mins",
+                                     tickerid=None, aggregator=None):
+
+        """
+        Backfills history once, then keeps the request open and pushes only new or updated bars
+        callback is called with each bar tuple (date, open, high, low, close, volume), first for the backfill
+        and then from the reader thread as bars arrive. If an event dispatcher is set bars are published there too
+        aggregator, a MultiTimeframeAggregator for barSizeSetting bars, gets the backfill and then every bar as it
+        closes, so one subscription serves all its timeframes; their completed bars are published too
+        :returns BarStream, add more subscribers to it if you like
+        """
+        if tickerid is None:
+            tickerid = self.allocate_reqid()
 
-    def place_new_IB_order(self, ibcontract, order, orderid=None):
+        ## Make places to store the backfill and to receive updates; the stream must exist before we ask
+        historic_data_queue = FinishableQueue(self.init_historicprices(tickerid))
+        bar_stream = self.init_bar_stream(tickerid)
+        if callback is not None:
+            bar_stream.add_subscriber(callback)
+        if aggregator is not None:
+            self.init_timeframes(tickerid, bar_stream, aggregator)
 
-        ## We can eithier supply our own ID or ask IB to give us the next valid one
+        # Request historical data and keep it up to date. endDateTime must be blank with keepUpToDate
+        self.reqHistoricalData(
+            tickerid,  # tickerId,
+            ibcontract,  # contract,
+            "",  # endDateTime,
+            durationStr,  # durationStr,
+            barSizeSetting,  # barSizeSetting,
+            "MIDPOINT",  # whatToShow,
+            1,  # useRTH,
+            1,  # formatDate
+            True,  # KeepUpToDate
+            []  ## chartoptions not used
+        )
+
+        ## Wait for the backfill, an error, or get bored waiting
+        MAX_WAIT_SECONDS = 20
+        print("Getting historical data from the server for streaming... could take %d seconds to complete "
+              % MAX_WAIT_SECONDS)
+
+        historic_data_queue.get(timeout=MAX_WAIT_SECONDS)
+
+        self._print_errors(tickerid, caller="subscribe_IB_historical_data():")
+
+        if historic_data_queue.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished - seems to be normal behaviour")
+
+        bar_buffer = self.get_bar_buffer(tickerid)
+        self.finish_historicprices(tickerid)
+        if aggregator is not None:
+            aggregator.backfill(bar_buffer.view())
+        bar_stream.backfill(bar_buffer.to_bar_tuples())
+
+        return bar_stream
+
+    def cancel_IB_historical_data_stream(self, tickerid):
+        """
+        Stop streaming bars for a request opened with subscribe_IB_historical_data
+        """
+        self.cancelHistoricalData(tickerid)
+        self._my_bar_streams.pop(tickerid, None)
+
+    def place_new_IB_order(self, ibcontract, order, orderid=None, key=None):
+        """
+        :param orderid: our own id, or None for the next one from the order manager
+        :param key: what the order is for, see OrderManager.place_order; default the contract
+        :return: orderid; None if an order with the same key is still working, so this one wasn't placed
+        """
+
+        ## We can eithier supply our own ID or take the next one, allocated locally
 
         if orderid is None:
-            print("Getting orderid from IB...")
             orderid = self.get_next_brokerorderid()
 
             if orderid is TIME_OUT:
@@ -413,24 +862,80 @@ class TradeClient(EClient):
 
         print("Using order id:", orderid)
 
-        # Place the order
+        return self._place_IB_orders([(ibcontract, order)], [orderid], key)[0]
+
+    def place_new_IB_orders(self, contract_orders, key=None):
+        """
+        Place a batch of orders, eg a rebalance across several pairs, in one burst: the ids are allocated locally
+        in one go, so nothing waits for IB between one order and the next
+
+        :param contract_orders: list of (ibcontract, order); order None to skip that contract, eg from
+                                zip(contracts, TradeLogic.create_batch_orders(order_sizes))
+        :param key: shared by the whole batch if given; default each order's contract
+        :return: list of orderids, one per entry; None where there was no order, or it wasn't placed as one with the
+                 same key is still working
+        """
+        placed_indexes = [order_index for order_index, (ibcontract, order) in enumerate(contract_orders)
+                          if order is not None]
+        all_orderids = [None] * len(contract_orders)
+        if len(placed_indexes) == 0:
+            return all_orderids
+
+        orderids = self._my_order_manager.next_orderids(len(placed_indexes))
+        if orderids is None:
+            raise Exception("I couldn't get an orderid from IB")
+
+        placed_orderids = self._place_IB_orders([contract_orders[order_index] for order_index in placed_indexes],
+                                                orderids, key)
+        for order_index, orderid in zip(placed_indexes, placed_orderids):
+            all_orderids[order_index] = orderid
+
+        return all_orderids
+
+    def place_new_IB_bracket(self, ibcontract, bracket_orders, key=None):
+        """
+        Place a parent order and its children, eg from TradeLogic.create_bracket_order. The children get the
+        parent's id as parentId; all but the last have transmit=False, so TWS sends them on together
+
+        :param bracket_orders: list of Orders, parent first
+        :param key: default the contract, so nothing else is placed for it until the whole bracket is done
+        :return: list of orderids, parent first; all None if an order for the contract is still working
+        """
+        orderids = self._my_order_manager.next_orderids(len(bracket_orders))
+        if orderids is None:
+            raise Exception("I couldn't get an orderid from IB")
+
+        parent_orderid = orderids[0]
+        for child_order in bracket_orders[1:]:
+            child_order.parentId = parent_orderid
+
+        return self._place_IB_orders([(ibcontract, order) for order in bracket_orders], orderids, key)
+
+    def _place_IB_orders(self, contract_orders, orderids, key):
+        resolved_contract_orders = []
+        for orderid, (ibcontract, order) in zip(orderids, contract_orders):
+            # so fills reported by orderStatus can go straight into the position book
+            resolved_ibcontract = self._resolved_from_cache(ibcontract)
+            if resolved_ibcontract.conId:
+                self._my_position_book.register_order(orderid, resolved_ibcontract, order.action,
+                                                      order.totalQuantity)
+            resolved_contract_orders.append((resolved_ibcontract, order))
 
-        self.placeOrder(orderid, ibcontract, order)
+        # Place the orders, unless ones for the same thing are still working
 
-        return orderid
+        return self._my_order_manager.place_orders(resolved_contract_orders, key=key, orderids=orderids)
 
     def get_positions_dict(self, positions_list):
 
-        positions_dict = {positions_list[i][1]: positions_list[i][2] for i in range(0,
-                                                                                    len(positions_list))}
+        positions_dict = dict([(localSymbol, position) for account, localSymbol, position, avgCost in positions_list])
 
         return positions_dict
 
 
 class TradeApp(TradeWrapper, TradeClient):
-    def __init__(self, ipaddress, portid, clientid):
+    def __init__(self, ipaddress, portid, clientid, contract_cache_filename=None):
         TradeWrapper.__init__(self)
-        TradeClient.__init__(self, wrapper=self)
+        TradeClient.__init__(self, wrapper=self, contract_cache_filename=contract_cache_filename)
 
         self.connect(ipaddress, portid, clientid)
 
@@ -442,50 +947,37 @@ class TradeApp(TradeWrapper, TradeClient):
 
 if __name__ == '__main__':
 
-    app = TradeApp("127.0.0.1", 7497, 0)
+    app = TradeApp("127.0.0.1", 7497, 0, contract_cache_filename="contract_cache.json")
     tr = TradeLogic()
 
     ibcontract = tr.create_contract('EUR', 'GBP')
 
-    positions_list = app.get_current_positions()
+    position_book = app.subscribe_positions()
+    positions_list = position_book.as_list()
     if len(positions_list) != 0:
         accountName = positions_list[0][0]
-        accounting_values = app.get_accounting_values(accountName)
         accounting_updates = app.get_accounting_updates(accountName)
-        pos_dict = app.get_positions_dict(positions_list)
+        pos_dict = position_book.as_dict()
 
-        print(">> Balance:", accounting_values[18][1], accounting_values[18][2])
+        print(">> Balance:", app.get_account_value(accountName, *BALANCE_KEY), BALANCE_KEY[1])
         print('>> Current positions:')
         print(pos_dict)
 
     else:
         print("_______No start positions_____")
 
-    try:
-        while True:
-            positions_list = app.get_current_positions()
-            pos_dict = app.get_positions_dict(positions_list)
-            resolved_ibcontract = app.resolve_ib_contract(ibcontract)
-            historic_data = app.get_IB_historical_data(resolved_ibcontract)
-            signal = tr.cross_signal(historic_data)
-            pos = pos_dict.get(str(resolved_ibcontract.localSymbol), 0)
-
-            tr.trade_logic(pos, signal)
-
-            try:
+    # торгуем по событиям: решение принимается сразу после закрытия бара
+    runner = StrategyRunner(app, tr, ibcontract, bar_store=BarStore("bars"))
 
-                orderid1 = app.place_new_IB_order(ibcontract, tr.ib_order, orderid=None)
-                print("Placed market order, orderid is %d" % orderid1)
-                tr.ib_order = None
-            except AttributeError:
-                print("already placed")
-
-            finally:
-                time.sleep(30)
+    try:
+        runner.start()
+        runner.dispatcher.run()
 
     finally:
-        accounting_values = app.get_accounting_values(accountName)
-        print("acc balance:", accounting_values[18][1], accounting_values[18][2])
+        runner.stop()
+
+        print("acc balance:", app.get_account_value(accountName, *BALANCE_KEY), BALANCE_KEY[1])
+        app.unsubscribe_account()
 
         app.disconnect()
-        print('current positions:', '\n', pos_dict)
+        print('current positions:', '\n', position_book.as_dict())
@@ -0,0 +1,145 @@
+import time
+
+from events import BAR_CLOSED, BAR_UPDATE, EventDispatcher
+from metrics import BAR_CALLBACK, CALLBACK_TO_ORDER, CALLBACK_TO_SIGNAL, SIGNAL_LATENCY, SIGNAL_TO_ORDER
+
+
+class StrategyRunner(object):
+    """
+    Runs TradeLogic for one contract off events instead of polling
+
+    Bars come from a keepUpToDate stream, positions from the app's position book, and orders go through the app's
+    order manager, which allocates the ids. Trading decisions are made as soon as a bar closes.
+    """
+
+    def __init__(self, app, trade_logic, ibcontract, tickerid=None, dispatcher=None, bar_store=None):
+        """
+        :param app: TradeApp, connected
+        :param trade_logic: TradeLogic
+        :param ibcontract: partially formed contract, resolved in start()
+        :param tickerid: reqId to use for the bar stream, allocated if not given
+        :param dispatcher: EventDispatcher, shared if several runners use one connection
+        :param bar_store: BarStore or None; if given we warm start from it, only backfill the gap, and store new bars
+        """
+        self.app = app
+        self.trade_logic = trade_logic
+        self.ibcontract = ibcontract
+        self.resolved_ibcontract = None
+        self.bar_store = bar_store
+        self.barSizeSetting = None
+        ## bars not yet in bar_store, the last one may still be forming; written when a bar closes
+        self._unstored_bars = []
+
+        if tickerid is None:
+            tickerid = app.allocate_reqid()
+        self.tickerid = tickerid
+
+        if dispatcher is None:
+            dispatcher = EventDispatcher()
+        self.dispatcher = dispatcher
+
+        dispatcher.subscribe(BAR_UPDATE, self._on_bar_update)
+        dispatcher.subscribe(BAR_CLOSED, self._on_bar_closed)
+
+    def __repr__(self):
+        return "StrategyRunner for %s, ticker id %d" % (str(self.ibcontract.symbol), self.tickerid)
+
+    def start(self, durationStr="1 D", barSizeSetting="5 mins"):
+        """
+        Resolve the contract and open the subscriptions; events start flowing straight away
+        :return: nothing
+        """
+        app = self.app
+        app.set_event_dispatcher(self.dispatcher)
+
+        self.resolved_ibcontract = app.resolve_ib_contract(self.ibcontract)
+
+        # позиции приходят по подписке, при каждом изменении
+        app.subscribe_positions()
+
+        durationStr = self.warm_start(durationStr, barSizeSetting)
+
+        app.subscribe_IB_historical_data(self.resolved_ibcontract, durationStr=durationStr,
+                                         barSizeSetting=barSizeSetting, tickerid=self.tickerid)
+
+    def warm_start(self, durationStr, barSizeSetting):
+        """
+        Feed stored bars into TradeLogic before streaming starts
+
+        :return: str, duration to backfill from IB: only the gap since the last stored bar
+        """
+        self.barSizeSetting = barSizeSetting
+        bar_store = self.bar_store
+        if bar_store is None:
+            return durationStr
+
+        # memory mapped, and only the last window of closes gets read
+        stored_bars = bar_store.read(self.resolved_ibcontract, barSizeSetting)
+        self.trade_logic.cross_signal(stored_bars)
+
+        return bar_store.duration_since_last_bar(self.resolved_ibcontract, barSizeSetting,
+                                                 default_durationStr=durationStr)
+
+    def stop(self):
+        self.app.cancel_IB_historical_data_stream(self.tickerid)
+        ## the forming bar too; the store overwrites it when we next start
+        self._store_bars()
+
+    def position(self):
+        return self.app.get_position(self.resolved_ibcontract)
+
+    def _on_bar_update(self, data):
+        tickerid, bar = data
+        if tickerid != self.tickerid:
+            return
+
+        self.trade_logic.update_bar(bar)
+
+        if self.bar_store is None:
+            return
+
+        unstored_bars = self._unstored_bars
+        if len(unstored_bars) > 0 and unstored_bars[-1][0] == bar[0]:
+            ## a revision of the forming bar
+            unstored_bars[-1] = bar
+        else:
+            unstored_bars.append(bar)
+
+    def _store_bars(self):
+        """
+        One write for everything since the last bar closed, rather than one per update of the forming bar
+        """
+        if self.bar_store is None or len(self._unstored_bars) == 0:
+            return
+
+        self.bar_store.append(self.resolved_ibcontract, self.barSizeSetting, self._unstored_bars)
+        self._unstored_bars = []
+
+    def _on_bar_closed(self, data):
+        tickerid, bar = data
+        if tickerid != self.tickerid:
+            return
+
+        metrics = self.app.get_metrics()
+        callback_time = metrics.marked_time(BAR_CALLBACK, tickerid)
+
+        tr = self.trade_logic
+        signal = tr.sma_cross.signal()
+        tr.trade_logic(self.position(), signal)
+
+        signal_time = time.perf_counter()
+        metrics.observe_since(SIGNAL_LATENCY, CALLBACK_TO_SIGNAL, callback_time, now=signal_time)
+
+        if tr.ib_order is not None:
+            # not placed if our last order hasn't finished yet; the next bar will decide again
+            orderid = self.app.place_new_IB_order(self.resolved_ibcontract, tr.ib_order)
+            if orderid is not None:
+                order_time = time.perf_counter()
+                metrics.observe_since(SIGNAL_LATENCY, SIGNAL_TO_ORDER, signal_time, now=order_time)
+                metrics.observe_since(SIGNAL_LATENCY, CALLBACK_TO_ORDER, callback_time, now=order_time)
+                print("Placed market order, orderid is %d" % orderid)
+            tr.ib_order = None
+
+        ## the closed bar is the last unstored one, the next hasn't been published yet; written after the order so
+        ## it isn't on the signal path
+        self._store_bars()
@@ -0,0 +1,52 @@
+## add_arrays and add_bar must build the same bars: run with python -m pytest
+
+import numpy as np
+import pytest
+
+from bar_aggregator import CountBarAggregator, TimeBarAggregator, VolumeBarAggregator
+from bar_store import BAR_COLUMNS
+
+## 5 min bars, in units of 5 mins from a 15 min boundary, with gaps
+BAR_OFFSETS = [0, 1, 3, 4, 6, 7, 11, 12, 13, 14, 18, 20, 21, 22, 26]
+FIRST_BAR_TIME = 1700000100 - 1700000100 % 900
+
+
+def _base_bars():
+    random_state = np.random.RandomState(0)
+    bar_count = len(BAR_OFFSETS)
+    closes = 1.0 + np.cumsum(random_state.normal(0, 0.001, bar_count))
+
+    return dict(time=FIRST_BAR_TIME + np.array(BAR_OFFSETS, dtype=np.int64) * 300, open=closes - 0.0005,
+                high=closes + 0.001, low=closes - 0.001, close=closes,
+                volume=random_state.randint(1, 100, bar_count).astype(np.float64))
+
+
+def _rows(bar_arrays, start, end):
+    return dict([(column_name, column[start:end]) for column_name, column in bar_arrays.items()])
+
+
+def _completed_bars(aggregator):
+    bar_arrays = aggregator.bars.view()
+    return [tuple([bar_arrays[column_name][bar_index] for column_name, dtype in BAR_COLUMNS])
+            for bar_index in range(len(aggregator.bars))]
+
+
+@pytest.mark.parametrize("make_aggregator", [lambda: TimeBarAggregator("15 mins", "5 mins"),
+                                             lambda: CountBarAggregator(3),
+                                             lambda: VolumeBarAggregator(120)])
+def test_split_add_arrays_matches_add_bar(make_aggregator):
+    base_bars = _base_bars()
+    bar_count = len(BAR_OFFSETS)
+
+    one_at_a_time = make_aggregator()
+    for bar_index in range(bar_count):
+        one_at_a_time.add_bar(tuple([base_bars[column_name][bar_index] for column_name, dtype in BAR_COLUMNS]))
+    expected_bars = _completed_bars(one_at_a_time)
+
+    for split_index in range(bar_count + 1):
+        split_calls = make_aggregator()
+        split_calls.add_arrays(_rows(base_bars, 0, split_index))
+        split_calls.add_arrays(_rows(base_bars, split_index, bar_count))
+
+        assert _completed_bars(split_calls) == expected_bars, split_index
+        assert split_calls.forming_bar() == one_at_a_time.forming_bar(), split_index
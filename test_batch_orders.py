@@ -0,0 +1,53 @@
+## A batch from TradeLogic through TradeClient.place_new_IB_orders: run with python -m pytest
+
+import time
+
+import pytest
+
+from mock_tws import MockTWS
+from sma_cross_ibapi import TradeApp
+from trade_logic import TradeLogic
+
+
+@pytest.fixture
+def tws():
+    mock_tws = MockTWS()
+    mock_tws.start()
+    yield mock_tws
+    mock_tws.stop()
+
+
+@pytest.fixture
+def app(tws):
+    trade_app = TradeApp("127.0.0.1", tws.port, 1)
+    yield trade_app
+    trade_app.disconnect()
+
+
+def test_batch_with_nothing_to_do_for_some_symbols(tws, app):
+    trade_logic = TradeLogic()
+    contracts = [app.resolve_ib_contract(trade_logic.create_contract(symbol, "USD"))
+                 for symbol in ("EUR", "GBP", "AUD")]
+
+    orders = trade_logic.create_batch_orders([0.0, 5000.0, 0.0])
+    orderids = app.place_new_IB_orders(list(zip(contracts, orders)))
+
+    assert orderids[0] is None and orderids[2] is None
+    assert orderids[1] is not None
+
+    deadline = time.monotonic() + 5
+    while orderids[1] not in tws.orders and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert list(tws.orders.keys()) == [orderids[1]]
+    assert tws.orders[orderids[1]]["contract_name"] == "GBP.USD"
+    assert tws.orders[orderids[1]]["action"] == "BUY"
+    assert tws.orders[orderids[1]]["totalQuantity"] == 5000.0
+
+
+def test_batch_with_nothing_to_do(app):
+    trade_logic = TradeLogic()
+    ibcontract = app.resolve_ib_contract(trade_logic.create_contract("EUR", "USD"))
+
+    orders = trade_logic.create_batch_orders([0.0, 0.0])
+
+    assert app.place_new_IB_orders([(ibcontract, order) for order in orders]) == [None, None]
@@ -0,0 +1,121 @@
+## Errors from IB against a MockTWS: run with python -m pytest
+
+import asyncio
+import time
+from threading import Thread
+
+import pytest
+
+from error_log import ErrorRecord
+from mock_tws import MockTWS
+from order_manager import CREATED, INACTIVE, ORDER_REJECTED_CODE
+from sma_cross_ibapi import TradeApp
+from trade_logic import TradeLogic
+
+
+@pytest.fixture
+def tws():
+    ## contract details held back, so a request is still waiting when we send it an error
+    mock_tws = MockTWS(delays={"contractDetails": 10})
+    mock_tws.start()
+    yield mock_tws
+    mock_tws.stop()
+
+
+@pytest.fixture
+def app(tws):
+    trade_app = TradeApp("127.0.0.1", tws.port, 1)
+    yield trade_app
+    trade_app.disconnect()
+
+
+def test_warning_codes():
+    assert ErrorRecord(1, 2150, "").is_warning()
+    assert ErrorRecord(1, 10167, "").is_warning()
+
+    assert not ErrorRecord(1, 200, "").is_warning()
+    assert not ErrorRecord(1, 10182, "").is_warning()
+    assert not ErrorRecord(1, 10197, "").is_warning()
+
+
+def test_request_error_in_10000_range_fails_straight_away(app):
+    trade_logic = TradeLogic()
+    contract_details = []
+    request_thread = Thread(target=lambda: contract_details.append(
+        app.resolve_ib_contract(trade_logic.create_contract("EUR", "USD"))))
+    request_thread.start()
+
+    deadline = time.monotonic() + 5
+    while len(app._my_contract_details) == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    reqId = list(app._my_contract_details.keys())[0]
+
+    start_time = time.monotonic()
+    app.error(reqId, 10197, "No market data during competing live session")
+    request_thread.join(5)
+
+    assert not request_thread.is_alive()
+    assert time.monotonic() - start_time < 2
+    ## given back unresolved
+    assert contract_details[0].conId == 0
+
+
+def test_order_rejection_with_the_id_of_a_waiting_request(tws, app):
+    ## already resolved, so we don't wait on the delayed mock
+    trade_logic = TradeLogic()
+    ibcontract = trade_logic.create_contract("EUR", "USD")
+    ibcontract.conId = 1
+    ibcontract.localSymbol = "EUR.USD"
+
+    ## a limit order the mock leaves working
+    order = trade_logic.create_order("LMT", 5000, "BUY")
+    order.lmtPrice = 1.0
+    orderid = app.place_new_IB_order(ibcontract, order)
+    assert orderid is not None
+    assert app.allocate_reqid() > orderid
+
+    managed_order = app._my_order_manager.get_order(orderid)
+    deadline = time.monotonic() + 5
+    while managed_order.status != "Submitted" and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    ## a request with the same id, as if the two ranges overlapped
+    loop = asyncio.new_event_loop()
+    future = app._my_pending.register(orderid, loop)
+
+    app.error(orderid, ORDER_REJECTED_CODE, "Order rejected")
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    assert managed_order.status == INACTIVE
+    assert not app._my_order_manager.is_working(managed_order.key)
+    assert not future.done()
+
+    app._my_pending.abandon(orderid)
+    loop.close()
+
+
+def test_error_before_the_order_is_acknowledged_ends_it():
+    ## order status held back, so the order is still only Created when the error comes
+    mock_tws = MockTWS(delays={"orderStatus": 10})
+    mock_tws.start()
+    trade_app = TradeApp("127.0.0.1", mock_tws.port, 1)
+    try:
+        trade_logic = TradeLogic()
+        ibcontract = trade_logic.create_contract("EUR", "USD")
+        ibcontract.conId = 1
+        ibcontract.localSymbol = "EUR.USD"
+
+        order = trade_logic.create_order("LMT", 5000, "BUY")
+        order.lmtPrice = 1.00003
+        orderid = trade_app.place_new_IB_order(ibcontract, order)
+        managed_order = trade_app._my_order_manager.get_order(orderid)
+        assert managed_order.status == CREATED
+
+        trade_app.error(orderid, 110, "The price does not conform to the minimum price variation")
+
+        assert managed_order.status == INACTIVE
+        assert not trade_app._my_order_manager.is_working(managed_order.key)
+        assert trade_app.place_new_IB_order(ibcontract, trade_logic.create_order("MKT", 5000, "BUY")) is not None
+    finally:
+        trade_app.disconnect()
+        mock_tws.stop()
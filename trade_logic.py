@@ -1,15 +1,20 @@
 import numpy as np
-import pandas as pd
-import talib
 from ibapi.contract import Contract as IBcontract
 from ibapi.order import Order
 
+from backtest import sma
+from bar_buffer import BarBuffer
+from indicators import SMACross
+
 
 class TradeLogic(object):
-    def __init__(self):
+    def __init__(self, short_period=20, long_period=50):
         self.ib_order = None
         self.pos_volume = 5000
 
+        # скользящие средние считаются инкрементально, по одному новому бару
+        self.sma_cross = SMACross(short_period=short_period, long_period=long_period)
+
     def create_order(self, order_type, quantity, action):
         order = Order()
         order.orderType = order_type
@@ -19,6 +24,48 @@ class TradeLogic(object):
 
         return order
 
+    def create_bracket_order(self, quantity, action, take_profit_price, stop_loss_price, order_type="MKT",
+                             limit_price=None):
+        """
+        Parent order with a take profit limit and a stop loss to close it; IB cancels one child when the other fills.
+        Only the stop loss is transmitted, TWS sends the parent and both children together when it arrives.
+        Place with TradeClient.place_new_IB_bracket, which sets parentId
+
+        :param limit_price: for the parent, if order_type is LMT
+        :return: list of Orders: parent, take profit, stop loss
+        """
+        if action == "BUY":
+            exit_action = "SELL"
+        else:
+            exit_action = "BUY"
+
+        parent = self.create_order(order_type, quantity, action)
+        if limit_price is not None:
+            parent.lmtPrice = limit_price
+        parent.transmit = False
+
+        take_profit = self.create_order("LMT", quantity, exit_action)
+        take_profit.lmtPrice = take_profit_price
+        take_profit.transmit = False
+
+        stop_loss = self.create_order("STP", quantity, exit_action)
+        stop_loss.auxPrice = stop_loss_price
+
+        return [parent, take_profit, stop_loss]
+
+    def create_oca_orders(self, orders, oca_group, oca_type=1):
+        """
+        Put orders in one OCA group: once one fills, IB cancels the others
+
+        :param oca_type: 1 cancels the rest with block, 2 and 3 reduce them instead, see IB docs
+        :return: the same orders
+        """
+        for order in orders:
+            order.ocaGroup = oca_group
+            order.ocaType = oca_type
+
+        return orders
+
     def create_contract(self, symbol, currency):
 
         ibcontract = IBcontract()
@@ -30,19 +77,90 @@ class TradeLogic(object):
         return ibcontract
 
     def cross_signal(self, historic_data):
-        df = pd.DataFrame(historic_data, columns=('time',
-                                                  'open', 'hight',
-                                                  'low', 'close',
-                                                  'vol'))
-
-        data = np.array(df.close)
+        """
+        Feed any bars we haven't seen yet into the moving averages and return the crossover state
 
-        ma_short = talib.SMA(data, timeperiod=20)[-1]
-        ma_long = talib.SMA(data, timeperiod=50)[-1]
+        :param historic_data: list of (date, open, high, low, close, volume) tuples, oldest first; or a BarBuffer,
+                              or a dict of column arrays like BarBuffer.view, which are read without copying
+        :return: bool, True if short SMA is above long SMA
+        """
+        if isinstance(historic_data, BarBuffer):
+            self.sma_cross.add_arrays(historic_data.column("time"), historic_data.column("close"))
+        elif isinstance(historic_data, dict):
+            self.sma_cross.add_arrays(historic_data["time"], historic_data["close"])
+        else:
+            self.sma_cross.add_bars(historic_data)
 
-        allow = ma_short > ma_long
+        allow = self.sma_cross.signal()
         return allow
 
+    def batch_cross_signal(self, closes):
+        """
+        Crossover state for many symbols at once, with this TradeLogic's periods: what cross_signal would say for
+        each row. Only the last long_period closes of each row are used
+
+        :param closes: 2-D array, symbols x bars, oldest first; pad shorter histories at the start with NaN
+        :return: bool array, one per symbol, True if short SMA is above long SMA; False until both windows are full
+        """
+        closes = np.asarray(closes, dtype=np.float64)
+        short_period = self.sma_cross.short_ma.period
+        long_period = self.sma_cross.long_ma.period
+
+        window = closes[:, -max(short_period, long_period):]
+        ma_short = sma(window, short_period)[:, -1]
+        ma_long = sma(window, long_period)[:, -1]
+
+        # NaN compares False, as signal() is before the windows are full
+        return ma_short > ma_long
+
+    def batch_trade_logic(self, positions, signals, pos_volume=None):
+        """
+        trade_logic for many symbols at once: same rules, no printing, no orders created
+
+        :param positions: array of current positions, one per symbol
+        :param signals: bool array, eg from batch_cross_signal
+        :param pos_volume: number or array, one per symbol; default self.pos_volume
+        :return: float array of signed order sizes, positive to BUY, 0 where trade_logic wouldn't trade
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        signals = np.asarray(signals, dtype=bool)
+        if pos_volume is None:
+            pos_volume = self.pos_volume
+
+        # long signal: open long when flat, reverse a short; short signal: open short when flat, reverse a long
+        buy_sizes = np.where(signals & (positions <= 0), pos_volume - positions, 0.0)
+        sell_sizes = np.where(~signals & (positions >= 0), -(pos_volume + positions), 0.0)
+
+        return buy_sizes + sell_sizes
+
+    def create_batch_orders(self, order_sizes):
+        """
+        :param order_sizes: signed sizes, eg from batch_trade_logic
+        :return: list of MKT Orders, None where the size is 0; zip with the contracts for
+                 TradeClient.place_new_IB_orders, which skips the Nones
+        """
+        orders = []
+        for order_size in order_sizes:
+            if order_size > 0:
+                orders.append(self.create_order("MKT", float(order_size), "BUY"))
+            elif order_size < 0:
+                orders.append(self.create_order("MKT", float(-order_size), "SELL"))
+            else:
+                orders.append(None)
+
+        return orders
+
+    def update_bar(self, bar):
+        """
+        Feed a single new or revised bar
+
+        :param bar: tuple (date, open, high, low, close, volume)
+        :return: bool, crossover state after this bar
+        """
+        self.sma_cross.add_bar(bar)
+
+        return self.sma_cross.signal()
+
     def trade_logic(self, position, signal):
 
         print("allow: ", signal, '\n', 'position: ', position)